@@ -0,0 +1,104 @@
+from collections import OrderedDict
+import cPickle as pickle
+import threading
+import time
+
+from django.core.cache.backends.base import BaseCache
+
+# In-process cache backend that evicts the least recently used entries
+# once the total size of the stored (pickled) values goes over
+# OPTIONS['MAX_BYTES']. Unlike the locmem backend, this is suited to
+# large entries of very different sizes, such as /api/values responses.
+#
+#  CACHES = {
+#      'values': {
+#          'BACKEND': 'metrics.cache.LRUCache',
+#          'OPTIONS': { 'MAX_BYTES': 64 * 1024 * 1024 }
+#      }
+#  }
+class LRUCache(BaseCache):
+    def __init__(self, name, params):
+        BaseCache.__init__(self, params)
+        options = params.get('OPTIONS', {})
+        self._max_bytes = int(options.get('MAX_BYTES', 64 * 1024 * 1024))
+        # key => (expiry time, pickled value), least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _get_entry(self, key):
+        # Returns the pickled value, marking it as recently used; the lock
+        # must be held
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        expiry, pickled = entry
+        if expiry <= time.time():
+            self._size -= len(pickled)
+            return None
+        self._entries[key] = entry
+        return pickled
+
+    def _set_entry(self, key, value, timeout):
+        # The lock must be held
+        if timeout is None:
+            timeout = self.default_timeout
+        expiry = time.time() + timeout
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        self._delete_entry(key)
+        if len(pickled) > self._max_bytes:
+            return
+
+        self._entries[key] = (expiry, pickled)
+        self._size += len(pickled)
+        while self._size > self._max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+    def _delete_entry(self, key):
+        # The lock must be held
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    def add(self, key, value, timeout=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            if self._get_entry(key) is not None:
+                return False
+            self._set_entry(key, value, timeout)
+            return True
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            pickled = self._get_entry(key)
+        if pickled is None:
+            return default
+        return pickle.loads(pickled)
+
+    def set(self, key, value, timeout=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            self._set_entry(key, value, timeout)
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            self._delete_entry(key)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            return self._get_entry(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
@@ -1,4 +1,5 @@
 import ConfigParser
+import hashlib
 import os
 import re
 
@@ -8,6 +9,9 @@ class Configuration:
     def __init__(self):
         self.errors = []
         self.objects = {}
+        # Changes when the contents of the configuration files change
+        self.generation = None
+        self._digest = hashlib.md5()
 
     def _add_error(self, f, section, error):
         self.errors.append('%s [%s]: %s' % (f, section, error))
@@ -44,8 +48,15 @@ class Configuration:
             self.objects[clsname][name] = obj
 
     def _load_file(self, f):
+        path = os.path.join(settings.CONFIG_ROOT, f)
+        try:
+            with open(path) as fp:
+                self._digest.update(f + '\0' + fp.read() + '\0')
+        except IOError:
+            pass
+
         parser = ConfigParser.RawConfigParser()
-        parser.read(os.path.join(settings.CONFIG_ROOT, f))
+        parser.read(path)
 
         for section in parser.sections():
             if section.startswith('machine '):
@@ -69,7 +80,7 @@ class Configuration:
         self._load_file('metrics.conf')
         machinedir = os.path.join(settings.CONFIG_ROOT, 'machines')
         if os.path.exists(machinedir):
-            for f in os.listdir(machinedir):
+            for f in sorted(os.listdir(machinedir)):
                 if f.endswith('.conf'):
                     self._load_file(os.path.join('machines', f))
 
@@ -88,6 +99,8 @@ class Configuration:
             for name in bad_names:
                 del objs[name]
 
+        self.generation = self._digest.hexdigest()
+
 class ConfigObject(object):
     name_pattern = r'[a-zA-Z][a-zA-Z0-9_.-]+'
 
@@ -0,0 +1,51 @@
+# Largest-Triangle-Three-Buckets downsampling (Sveinn Steinarsson, 2013).
+#
+# Picks max_points of the points so that the line through them keeps the
+# shape of the full series: the first and last points are kept, the rest
+# are split into equal buckets, and from each bucket we keep the point
+# forming the largest triangle with the point kept from the previous
+# bucket and the average of the next bucket. Since only existing points
+# are kept, whatever else a point carries (such as its revision) stays
+# correct.
+#
+# points is a list of tuples, with the x and y coordinates at the given
+# indices; returns a new list.
+def lttb(points, max_points, x=0, y=1):
+    n = len(points)
+    if max_points >= n or max_points < 3:
+        return list(points)
+
+    result = [points[0]]
+    bucket_size = float(n - 2) / (max_points - 2)
+
+    a = 0
+    for i in xrange(max_points - 2):
+        # Average of the next bucket; for the last bucket, that's the
+        # last point
+        next_start = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        if next_start >= n - 1:
+            next_start, next_end = n - 1, n
+        count = next_end - next_start
+        avg_x = sum(points[k][x] for k in xrange(next_start, next_end)) / float(count)
+        avg_y = sum(points[k][y] for k in xrange(next_start, next_end)) / float(count)
+
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+
+        ax = points[a][x]
+        ay = points[a][y]
+        max_area = -1
+        chosen = start
+        for k in xrange(start, end):
+            area = abs((ax - avg_x) * (points[k][y] - ay) -
+                       (ax - points[k][x]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                chosen = k
+
+        result.append(points[chosen])
+        a = chosen
+
+    result.append(points[n - 1])
+    return result
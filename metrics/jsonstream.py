@@ -0,0 +1,170 @@
+import codecs
+import json
+import re
+
+# Encoding detection for JSON rfc4627, section 3. The RFC doesn't mention
+# the possibility of starting with a BOM, but in pratice that's likely
+# if the input data is UTF-16. Returns (encoding, has_bom)
+def detect_encoding(raw):
+    if raw[0:2] == '\xfe\xff':
+        return 'UTF-16BE', True
+    elif raw[0:2] == '\xff\xfe' and raw[0:4] != '\xff\xfe\x00\x00':
+        return 'UTF-16LE', True
+    elif raw[0:3] == '\xef\xbb\xbf':
+        return 'UTF-8', True
+    elif raw[0:4] == '\x00\x00\xfe\xff':
+        return 'UTF-32BE', True
+    elif raw[0:4] == '\xff\xfe\x00\x00':
+        return 'UTF-32LE', True
+    else:
+        null_patterns = {
+            'NNNX': 'UTF-32BE',
+            'NXNX': 'UTF-16BE',
+            'XNNN': 'UTF-32LE',
+            'XNXN': 'UTF-16LE'
+        };
+
+        nullPattern = re.sub(r'[^\x00]', 'X', raw[0:4])
+        nullPattern = re.sub(r'\x00', 'N', nullPattern)
+
+        if nullPattern in null_patterns:
+            return null_patterns[nullPattern], False
+        else:
+            return 'UTF-8', False
+
+_WHITESPACE = ' \t\n\r'
+_NUMBER_CHARS = '0123456789.eE+-'
+
+# Largest single value we'll buffer when parsing; the point of parsing
+# incrementally is to handle large arrays, not large values
+MAX_VALUE_SIZE = 16 * 1024 * 1024
+
+# Incremental parser for JSON read from a file-like object. Objects and
+# arrays can be walked member by member with iter_object() and
+# iter_array(); everything else is parsed whole with read_value(). Errors
+# are raised as ValueError, as for json.loads().
+#
+#    stream = JSONStreamReader(fp)
+#    for key in stream.iter_object():
+#        if key == 'records':
+#            for record in stream.iter_array():
+#                ...
+#        else:
+#            value = stream.read_value()
+#    stream.end()
+#
+# When iterating an object, the value for each key must be consumed
+# before asking for the next key.
+class JSONStreamReader(object):
+    def __init__(self, fp, chunk_size=32*1024):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._json_decoder = json.JSONDecoder()
+        self._decoder = None
+        self._buf = u''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        # Reads another chunk into the buffer; returns False at EOF
+        if self._eof:
+            return False
+
+        raw = self._fp.read(self._chunk_size)
+        if self._decoder is None:
+            # Need 4 bytes to detect the encoding
+            while len(raw) < 4:
+                more = self._fp.read(self._chunk_size)
+                if more == '':
+                    break
+                raw += more
+            encoding, bom = detect_encoding(raw)
+            self._decoder = codecs.getincrementaldecoder(encoding)()
+            text = self._decoder.decode(raw, final=(raw == ''))
+            if bom:
+                text = text[1:]
+        else:
+            text = self._decoder.decode(raw, final=(raw == ''))
+
+        if raw == '':
+            self._eof = True
+
+        if self._pos > self._chunk_size:
+            self._buf = self._buf[self._pos:] + text
+            self._pos = 0
+        else:
+            self._buf += text
+
+        return True
+
+    def _skip_whitespace(self):
+        # Returns the next non-whitespace character without consuming it,
+        # or '' at EOF
+        while True:
+            buf = self._buf
+            pos = self._pos
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            self._pos = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        c = self._skip_whitespace()
+        if c == '' or not c in chars:
+            raise ValueError("Expected one of '%s' at position %d" % (chars, self._pos))
+        self._pos += 1
+        return c
+
+    def peek(self):
+        return self._skip_whitespace()
+
+    def read_value(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buf, self._pos)
+                # A number at the end of the buffer might continue in the
+                # next chunk
+                if self._eof or (end < len(self._buf) and not self._buf[end] in _NUMBER_CHARS):
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+
+            if len(self._buf) - self._pos > MAX_VALUE_SIZE:
+                raise ValueError("Value at position %d is too large" % self._pos)
+            self._fill()
+
+    def iter_object(self):
+        self._expect('{')
+        if self._skip_whitespace() == '}':
+            self._pos += 1
+            return
+
+        while True:
+            key = self.read_value()
+            if not isinstance(key, basestring):
+                raise ValueError("Object key is not a string")
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+    def iter_array(self):
+        self._expect('[')
+        if self._skip_whitespace() == ']':
+            self._pos += 1
+            return
+
+        while True:
+            yield self.read_value()
+            if self._expect(',]') == ']':
+                return
+
+    def end(self):
+        if self._skip_whitespace() != '':
+            raise ValueError("Extra data at position %d" % self._pos)
@@ -0,0 +1,550 @@
+from collections import deque
+from datetime import datetime
+import gzip
+import itertools
+import json
+import os
+import re
+import struct
+import tempfile
+import zlib
+
+from django.conf import settings
+
+from jsonstream import JSONStreamReader
+
+def log_dir(target_name):
+    return os.path.join(settings.LOG_ROOT, target_name.replace('/', '-'))
+
+# Logs are stored gzip-compressed; logs uploaded before that are plain JSON
+def log_path(target_name, pull_time, revision):
+    return os.path.join(log_dir(target_name),
+                        pull_time.strftime('%Y-%m-%d-%H:%M:%S') + '-' + revision + '.json.gz')
+
+def _uncompressed_log_path(target_name, pull_time, revision):
+    return os.path.join(log_dir(target_name),
+                        pull_time.strftime('%Y-%m-%d-%H:%M:%S') + '-' + revision + '.json')
+
+# The record index for a log at path
+def index_path(path):
+    return path[:-len('.json.gz')] + '.idx'
+
+# Where the compressed rendering of a log at path in the given format
+# ('txt' or 'html') is cached
+def rendered_path(path, format):
+    return path[:-len('.json.gz')] + '.' + format + '.gz'
+
+# Files that are stored alongside the log at path and removed with it
+def sidecar_paths(path):
+    return [index_path(path), rendered_path(path, 'txt'), rendered_path(path, 'html')]
+
+# Returns a file object that reads the uncompressed JSON of the log
+def open_log(target_name, pull_time, revision):
+    try:
+        return gzip.open(log_path(target_name, pull_time, revision), 'rb')
+    except IOError:
+        return open(_uncompressed_log_path(target_name, pull_time, revision), 'rb')
+
+# Generator returning the contents of fp in chunks, closing it at the end
+def iter_file(fp, chunk_size=32*1024):
+    try:
+        while True:
+            buf = fp.read(chunk_size)
+            if buf == '':
+                break
+            yield buf
+    finally:
+        fp.close()
+
+# Records are indexed as the compressed block they are in, their offset
+# and length within the uncompressed data of the block, their time
+# (microseconds since the epoch), priority and the index of their
+# identifier in the identifier table. The index file is:
+#
+#   header: magic, version, number of blocks, number of records
+#   block offsets: u64 compressed offset of each block
+#   records: a _RECORD_STRUCT for each record
+#   identifiers: JSON array of identifier strings
+_INDEX_MAGIC = 'PWLI'
+_INDEX_VERSION = 1
+_INDEX_HEADER_STRUCT = struct.Struct('<4sIII')
+_BLOCK_STRUCT = struct.Struct('<Q')
+_RECORD_STRUCT = struct.Struct('<IIIqBI')
+
+# The range of times that fit in the index
+_MIN_TIME = -2**63
+_MAX_TIME = 2**63 - 1
+
+# We start a new compressed block, where decompression can start, after
+# this much uncompressed data, so getting at a record never requires
+# decompressing more than about this much
+_BLOCK_SIZE = 64 * 1024
+
+# Writes the records of a log out as a compressed JSON array, one record
+# at a time, into a temporary file in LOG_ROOT, along with an index of
+# the records. Once the report the log belongs to has been validated,
+# commit() moves the files into their final location; otherwise discard()
+# removes them.
+class LogWriter(object):
+    def __init__(self):
+        if not os.path.exists(settings.LOG_ROOT):
+            os.makedirs(settings.LOG_ROOT)
+        fd, self._temp_path = tempfile.mkstemp(prefix='.incoming-', suffix='.json.gz',
+                                               dir=settings.LOG_ROOT)
+        self._file = os.fdopen(fd, 'wb')
+        self._fp = gzip.GzipFile(fileobj=self._file, mode='wb', compresslevel=6)
+        self._fp.write('[')
+        self._count = 0
+
+        self._blocks = [self._file.tell()]
+        self._block_pos = 1
+        self._records = []
+        self._identifiers = {}
+
+    def write_record(self, record):
+        if self._block_pos >= _BLOCK_SIZE:
+            # A full flush resets the compression state, so
+            # decompression can start at the current position
+            self._fp.flush(zlib.Z_FULL_FLUSH)
+            self._blocks.append(self._file.tell())
+            self._block_pos = 0
+
+        if self._count > 0:
+            self._fp.write(',')
+            self._block_pos += 1
+
+        data = json.dumps(record)
+        self._fp.write(data)
+
+        identifier = record_identifier(record)
+        if identifier in self._identifiers:
+            identifier_index = self._identifiers[identifier]
+        else:
+            identifier_index = self._identifiers[identifier] = len(self._identifiers)
+
+        # Records that aren't well-formed journal records are still
+        # stored, they just don't have a usable time
+        time = record_time(record)
+        if not _MIN_TIME <= time <= _MAX_TIME:
+            time = 0
+
+        self._records.append(_RECORD_STRUCT.pack(len(self._blocks) - 1,
+                                                 self._block_pos,
+                                                 len(data),
+                                                 time,
+                                                 record_priority(record),
+                                                 identifier_index))
+
+        self._block_pos += len(data)
+        self._count += 1
+
+    def _write_index(self, path):
+        identifiers = [None] * len(self._identifiers)
+        for identifier, i in self._identifiers.iteritems():
+            identifiers[i] = identifier
+
+        with open(path, 'wb') as fp:
+            fp.write(_INDEX_HEADER_STRUCT.pack(_INDEX_MAGIC, _INDEX_VERSION, len(self._blocks), len(self._records)))
+            for offset in self._blocks:
+                fp.write(_BLOCK_STRUCT.pack(offset))
+            fp.write(''.join(self._records))
+            fp.write(json.dumps(identifiers))
+
+    def commit(self, path):
+        self._fp.write(']')
+        self._fp.close()
+        self._file.close()
+
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        # The index is written first, so we never have a log with a
+        # partial index
+        temp_index_path = index_path(self._temp_path)
+        self._write_index(temp_index_path)
+        os.rename(temp_index_path, index_path(path))
+        os.rename(self._temp_path, path)
+        self._temp_path = None
+
+    def discard(self):
+        # Safe to call after commit(), in which case it does nothing
+        if self._temp_path is None:
+            return
+
+        self._fp.close()
+        self._file.close()
+        for path in (self._temp_path, index_path(self._temp_path)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._temp_path = None
+
+class _LogIndex(object):
+    def __init__(self, fp):
+        self.fp = fp
+        header = fp.read(_INDEX_HEADER_STRUCT.size)
+        if len(header) != _INDEX_HEADER_STRUCT.size:
+            raise IOError("Truncated log index")
+        magic, version, n_blocks, n_records = _INDEX_HEADER_STRUCT.unpack(header)
+        if magic != _INDEX_MAGIC or version != _INDEX_VERSION:
+            raise IOError("Bad log index")
+
+        data = fp.read(n_blocks * _BLOCK_STRUCT.size)
+        self.blocks = [_BLOCK_STRUCT.unpack_from(data, i * _BLOCK_STRUCT.size)[0]
+                       for i in xrange(0, n_blocks)]
+        self.n_records = n_records
+        self.records_offset = fp.tell()
+        self._identifiers = None
+
+    def identifiers(self):
+        if self._identifiers is None:
+            self.fp.seek(self.records_offset + self.n_records * _RECORD_STRUCT.size)
+            self._identifiers = json.loads(self.fp.read())
+        return self._identifiers
+
+    def read_records(self, start, end):
+        # Returns a list of (index, block, offset, length, time, priority, identifier_index)
+        self.fp.seek(self.records_offset + start * _RECORD_STRUCT.size)
+        data = self.fp.read((end - start) * _RECORD_STRUCT.size)
+        return [(start + i,) + _RECORD_STRUCT.unpack_from(data, i * _RECORD_STRUCT.size)
+                for i in xrange(0, end - start)]
+
+# Returns the records selected by offset and limit out of records; a
+# negative offset counts from the end
+def _select(records, offset, limit):
+    if offset is not None and offset < 0:
+        records = deque(records, -offset)
+    elif offset is not None and offset > 0:
+        records = itertools.islice(records, offset, None)
+
+    if limit is not None:
+        records = itertools.islice(records, 0, limit)
+
+    return records
+
+def _iter_indexed_records(index, log_fp, offset, limit, priority, identifier):
+    if priority is None and identifier is None:
+        # We can go straight to the records we need
+        count = index.n_records
+        if offset is None:
+            start = 0
+        elif offset < 0:
+            start = max(count + offset, 0)
+        else:
+            start = min(offset, count)
+        end = count if limit is None else min(start + limit, count)
+        entries = index.read_records(start, end)
+    else:
+        identifier_index = None
+        if identifier is not None:
+            try:
+                identifier_index = index.identifiers().index(identifier)
+            except ValueError:
+                return
+
+        def matches(entry):
+            if priority is not None and entry[5] > priority:
+                return False
+            if identifier_index is not None and entry[6] != identifier_index:
+                return False
+            return True
+
+        entries = _select((e for e in index.read_records(0, index.n_records) if matches(e)),
+                          offset, limit)
+
+    current_block = None
+    for _, block, block_offset, length, _, _, _ in entries:
+        if block != current_block:
+            current_block = block
+            log_fp.seek(index.blocks[block])
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = ''
+
+        while len(data) < block_offset + length:
+            compressed = log_fp.read(16 * 1024)
+            if compressed == '':
+                raise IOError("Log is truncated")
+            data += decompressor.decompress(compressed)
+
+        yield json.loads(data[block_offset:block_offset + length])
+
+def _iter_indexed_log(index_fp, log_fp, offset, limit, priority, identifier):
+    try:
+        index = _LogIndex(index_fp)
+        for record in _iter_indexed_records(index, log_fp, offset, limit, priority, identifier):
+            yield record
+    finally:
+        log_fp.close()
+        index_fp.close()
+
+def _iter_unindexed_log(fp, offset, limit, priority, identifier):
+    # No index, we have to go through the whole log
+    try:
+        records = JSONStreamReader(fp).iter_array()
+        if priority is not None:
+            records = (r for r in records if record_priority(r) <= priority)
+        if identifier is not None:
+            records = (r for r in records if record_identifier(r) == identifier)
+        for record in _select(records, offset, limit):
+            yield record
+    finally:
+        fp.close()
+
+# Returns an iterator over the records of a log that have priority <=
+# priority (if not None) and SYSLOG_IDENTIFIER (or _COMM) equal to
+# identifier (if not None). Out of those, offset records (from the end,
+# if negative) are skipped and then at most limit records returned.
+# Raises IOError if the log doesn't exist.
+def iter_log_records(target_name, pull_time, revision,
+                     offset=None, limit=None, priority=None, identifier=None):
+    path = log_path(target_name, pull_time, revision)
+    try:
+        index_fp = open(index_path(path), 'rb')
+    except IOError:
+        fp = open_log(target_name, pull_time, revision)
+        return _iter_unindexed_log(fp, offset, limit, priority, identifier)
+
+    try:
+        log_fp = open(path, 'rb')
+    except IOError:
+        index_fp.close()
+        raise
+
+    return _iter_indexed_log(index_fp, log_fp, offset, limit, priority, identifier)
+
+_PRIORITY_RE = re.compile('^[0-7]$')
+_LINE_RE = re.compile('^([^\n]*(?:\n[^\n]*){2})\n')
+_ESCAPE_RE = re.compile(r'\0x1b[0-9;]+m')
+# C0 and C1 control characters, DEL, except for \t\n
+_UNICODE_CONTROL_RE = re.compile(r'[\x00-\x08\x0A-\x1F\x7F-\x9F]')
+
+def escape_character(m):
+    c = m.group(0)
+    if c == '\n':
+        return '\\n'
+    elif c == '\r':
+        return '\\r'
+    else:
+        return '\\x%02x' % ord(c)
+
+# Time of the record in microseconds since the epoch, or 0 if it
+# doesn't have one we can parse
+def record_time(record):
+    if not isinstance(record, dict):
+        return 0
+    try:
+        time = long(record['_SOURCE_REALTIME_TIMESTAMP'])
+    except (KeyError, TypeError, ValueError):
+        time = 0
+    if time == 0:
+        cursor = record.get('__CURSOR', '')
+        if not isinstance(cursor, basestring):
+            return 0
+        for f in cursor.split(';'):
+            if f.startswith('t='):
+                try:
+                    time = long(f[2:], 16)
+                except ValueError:
+                    pass
+    return time
+
+def record_priority(record):
+    priority = 6 # Info
+    try:
+        priority_str = record['PRIORITY']
+        if _PRIORITY_RE.match(priority_str):
+            priority = int(priority_str)
+    except (KeyError, TypeError):
+        pass
+    return priority
+
+def record_identifier(record):
+    if not isinstance(record, dict):
+        return ''
+    try:
+        identifier = record['SYSLOG_IDENTIFIER']
+    except KeyError:
+        identifier = record.get('_COMM', '')
+    if not isinstance(identifier, basestring):
+        return ''
+    return identifier
+
+# Formats a single journal record as a line of text, appending the
+# pieces to out. format is 'txt' or 'html'
+def format_record(record, format, out):
+    # We write out log records in roughly the same format as
+    # the journalctl -o iso-short format
+    dt = datetime.utcfromtimestamp(record_time(record)/1000000)
+    # This is like journalctl -o short-iso; default is '%b %d %H:%M:%S'
+    out.append(dt.strftime('%Y-%m-%dT%H:%M:%S%z '))
+
+    # journalctl shows the hostname here - that isn't interesting for us
+    #
+    # try:
+    #    out.append(record['_HOSTNAME'])
+    # except KeyError:
+    #    pass
+    #
+    # out.append(' ')
+
+    out.append(record_identifier(record))
+
+    pid = None
+    try:
+        pid = record['_PID']
+    except KeyError:
+        try:
+            pid = record['_SYSLOG_PID']
+        except KeyError:
+            pass
+    if pid != None:
+        out.append('[')
+        out.append(pid)
+        out.append(']')
+
+    out.append(': ')
+
+    message = record['MESSAGE']
+
+    # If the message was an escaped blob, try to convert it to text
+    if type(message) == list:
+        message = ''.join((chr(x) for x in message))
+        try:
+            message = unicode(message, 'UTF-8')
+        except UnicodeDecodeError:
+            # journalctl falls back to printing the bytes, this seems more useful
+            message = repr(message)[1:-1]
+
+    # 300 characters or 3 lines, whichever is less; journalctl does
+    # a more sophisticated approach to ellipsization where it ellipsizes
+    # middle lines
+    if len(message) > 300:
+        message = message[0:300] + "..."
+    m = _LINE_RE.match(message)
+    if m:
+        message = m.group(1) + "..."
+
+    # For multi-line log messages, journalctl indents subsequent lines
+    # with spaces to have the same indent as the first line has
+    # pre-message text, but multi-line log messages are quite rare
+    # so we skip that
+
+    # Remove ANSI color escapes and replace tabs with 8 spaces
+    message = _ESCAPE_RE.sub('', message)
+    message = message.replace("\t", "        ")
+
+    # Escape control characters; again journalctl would just print
+    # the message as bytes
+    message = _UNICODE_CONTROL_RE.sub(escape_character, message)
+
+    # For HTML mode, use bold/red to mark different priorities
+    if format == 'html':
+        priority = record_priority(record)
+        if priority <= 3: # error
+            out.append('<span class="error">');
+            out.append(message)
+            out.append('</span>')
+        elif priority <= 5:  #notice
+            out.append('<span class="notice">');
+            out.append(message)
+            out.append('</span>')
+        else:
+            out.append(message)
+    else:
+        out.append(message)
+
+    out.append('\n')
+
+def _html_header(title):
+    return '''<!DOCTYPE html><html>
+<head>
+  <title>%s</title>
+  <style type="text/css">
+     .error { color: red; }
+     .notice { font-weight: bold; }
+  </style>
+</head>
+<body><pre>''' % title
+
+_HTML_FOOTER = '</pre></body></html>'
+
+# Size of the chunks of rendered output we hand to the web server
+_RENDER_CHUNK_SIZE = 32 * 1024
+
+# Generator that renders records as text or HTML, returning UTF-8
+# encoded chunks. Records are formatted one at a time, so memory use
+# doesn't depend on the number of records.
+def iter_rendered_records(records, format, title):
+    out = []
+    if format == 'html':
+        out.append(_html_header(title))
+    size = 0
+
+    for record in records:
+        start = len(out)
+        format_record(record, format, out)
+        for piece in out[start:]:
+            size += len(piece)
+        if size >= _RENDER_CHUNK_SIZE:
+            yield u''.join(out).encode('UTF-8')
+            out = []
+            size = 0
+
+    if format == 'html':
+        out.append(_HTML_FOOTER)
+    if len(out) > 0:
+        yield u''.join(out).encode('UTF-8')
+
+# Renders the records read from a log file object, parsing them one
+# at a time. If cache_path is not None, the rendered output is also saved
+# there, compressed, once it has all been generated.
+def iter_rendered_log(fp, format, title, cache_path=None):
+    cache_file = None
+    cache_fp = None
+    try:
+        if cache_path is not None:
+            fd, temp_path = tempfile.mkstemp(prefix='.incoming-', suffix='.' + format + '.gz',
+                                             dir=os.path.dirname(cache_path))
+            cache_file = os.fdopen(fd, 'wb')
+            cache_fp = gzip.GzipFile(fileobj=cache_file, mode='wb', compresslevel=6)
+
+        for chunk in iter_rendered_records(JSONStreamReader(fp).iter_array(), format, title):
+            if cache_fp is not None:
+                cache_fp.write(chunk)
+            yield chunk
+
+        if cache_fp is not None:
+            cache_fp.close()
+            cache_file.close()
+            cache_fp = None
+            os.rename(temp_path, cache_path)
+    finally:
+        fp.close()
+        # We didn't get to the end, because of an error or because the
+        # client went away
+        if cache_fp is not None:
+            cache_fp.close()
+            cache_file.close()
+            os.remove(temp_path)
+
+# Generator returning records as a JSON array
+def iter_json_records(records):
+    out = ['[']
+    size = 0
+    first = True
+    for record in records:
+        if first:
+            first = False
+        else:
+            out.append(',')
+        data = json.dumps(record)
+        out.append(data)
+        size += len(data)
+        if size >= _RENDER_CHUNK_SIZE:
+            yield ''.join(out)
+            out = []
+            size = 0
+    out.append(']')
+    yield ''.join(out)
@@ -1,46 +1,274 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 
 import os
 import re
+import stat
 import sys
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
 
-LOG_RE = re.compile(r'^(\d{4}-\d\d-\d\d-\d\d:\d\d:\d\d)-[a-f0-9]+.json$')
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
-# Number of logs to retain for each target
-NUM_RETAIN = 5
+from metrics import config
+from metrics.models import bump_data_version, refresh_statuses, Report, Target
+
+LOG_RE = re.compile(r'^(\d{4}-\d\d-\d\d-\d\d:\d\d:\d\d)-([a-f0-9]+).json(?:\.gz)?$')
+SIDECAR_RE = re.compile(r'^(.*)\.(?:idx|txt\.gz|html\.gz)$')
+# Temporary files for uploads and renderings in progress; see
+# metrics.logs. They're left behind if the process dies.
+TEMP_RE = re.compile(r'^\.incoming-')
+
+# Temporary files older than this are taken to be left behind
+TEMP_MAX_AGE = timedelta(days=1)
+
+# Format of the time at the start of the log filenames; these sort in
+# time order as strings
+TIME_FORMAT = "%Y-%m-%d-%H:%M:%S"
+
+class Log(object):
+    def __init__(self, target, filename, time, revision):
+        self.target = target
+        self.filename = filename
+        self.time = time
+        self.revision = revision
+        self.size = 0
+        # The log file and the files stored alongside it
+        self.paths = []
+
+def _list_dir(path):
+    # Returns a list of (name, size, is_dir)
+    result = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir():
+                result.append((entry.name, 0, True))
+            else:
+                result.append((entry.name, entry.stat().st_size, False))
+    else:
+        for name in os.listdir(path):
+            st = os.stat(os.path.join(path, name))
+            if stat.S_ISDIR(st.st_mode):
+                result.append((name, 0, True))
+            else:
+                result.append((name, st.st_size, False))
+
+    return result
+
+def _stale_temp_paths(path, names):
+    # Returns the paths of the temporary files out of the names in the
+    # directory path that are old enough to have been left behind
+    cutoff = time.time() - TEMP_MAX_AGE.total_seconds()
+    result = []
+    for name in names:
+        if TEMP_RE.match(name):
+            temp_path = os.path.join(path, name)
+            try:
+                if os.stat(temp_path).st_mtime < cutoff:
+                    result.append(temp_path)
+            except OSError:
+                # Renamed into place or removed meanwhile
+                pass
+    return result
+
+def _scan_target(target):
+    # Returns (logs, stale temporary file paths, warnings), with the logs
+    # for the target sorted newest first
+    target_dir = os.path.join(settings.LOG_ROOT, target)
+
+    logs = {}
+    sidecars = []
+    temp_names = []
+    warnings = []
+    for name, size, is_dir in _list_dir(target_dir):
+        if TEMP_RE.match(name):
+            temp_names.append(name)
+            continue
+
+        m = LOG_RE.match(name)
+        if m:
+            base = name[:name.index('.json')]
+            log = logs.get(base, None)
+            if log is None:
+                log = logs[base] = Log(target, name, m.group(1), m.group(2))
+            else:
+                log.filename = name
+            log.size += size
+            log.paths.append(os.path.join(target_dir, name))
+            continue
+
+        m = SIDECAR_RE.match(name)
+        if m:
+            sidecars.append((m.group(1), name, size))
+            continue
+
+        warnings.append("Log file " + name + " doesn't match pattern")
+
+    for base, name, size in sidecars:
+        log = logs.get(base, None)
+        if log is not None:
+            log.size += size
+            log.paths.append(os.path.join(target_dir, name))
+
+    result = logs.values()
+    result.sort(key=lambda log: log.time, reverse=True)
+
+    return result, _stale_temp_paths(target_dir, temp_names), warnings
 
 class Command(BaseCommand):
     help = 'Clean up old log files'
 
+    option_list = BaseCommand.option_list + (
+        make_option('--jobs', '-j',
+                    type='int',
+                    dest='jobs',
+                    default=4,
+                    help='Number of targets to scan in parallel'),
+        make_option('--dry-run', '-n',
+                    action='store_true',
+                    dest='dry_run',
+                    default=False,
+                    help="Show what would be removed, but don't remove it"),
+        make_option('--delete-reports',
+                    action='store_true',
+                    dest='delete_reports',
+                    default=False,
+                    help='Also delete the error reports of removed logs from the database'),
+    )
+
+    def _select(self, target_logs):
+        # Returns the logs to remove, given a list of (target, logs) with
+        # the logs sorted newest first. The newest log of a target is only
+        # removed for age, since it's what the target page links to.
+        remove = []
+        keep = []
+
+        if settings.LOG_MAX_AGE_DAYS is not None:
+            cutoff = (timezone.now() - timedelta(days=settings.LOG_MAX_AGE_DAYS)).strftime(TIME_FORMAT)
+        else:
+            cutoff = None
+
+        for target, logs in target_logs:
+            target_size = 0
+            for i, log in enumerate(logs):
+                target_size += log.size
+                if cutoff is not None and log.time < cutoff:
+                    remove.append(log)
+                elif i == 0:
+                    keep.append(log)
+                elif settings.LOG_RETAIN_COUNT is not None and i >= settings.LOG_RETAIN_COUNT:
+                    remove.append(log)
+                elif settings.LOG_MAX_TARGET_BYTES is not None and target_size > settings.LOG_MAX_TARGET_BYTES:
+                    remove.append(log)
+                else:
+                    keep.append(log)
+
+        if settings.LOG_MAX_TOTAL_BYTES is not None:
+            newest = set(id(logs[0]) for target, logs in target_logs if len(logs) > 0)
+            total_size = sum(log.size for log in keep)
+            keep.sort(key=lambda log: log.time)
+            for log in keep:
+                if total_size <= settings.LOG_MAX_TOTAL_BYTES:
+                    break
+                if id(log) in newest:
+                    continue
+                remove.append(log)
+                total_size -= log.size
+
+        return remove
+
+    def _delete_report(self, log, target_names):
+        # Returns the name of the target, or None if the report can't be found
+        target_name = target_names.get(log.target, None)
+        if target_name is None:
+            return None
+
+        pull_time = datetime.strptime(log.time, TIME_FORMAT).replace(tzinfo=timezone.utc)
+        Report.objects.filter(target__name=target_name,
+                              pull_time=pull_time,
+                              revision=log.revision) \
+                      .exclude(error='') \
+                      .delete()
+
+        return target_name
+
     def handle(self, *args, **options):
-        first = True
-        for target in os.listdir(settings.LOG_ROOT):
-            if not os.path.isdir(target):
+        if not os.path.isdir(settings.LOG_ROOT):
+            return
+
+        entries = _list_dir(settings.LOG_ROOT)
+        targets = [name for name, size, is_dir in entries if is_dir]
+        targets.sort()
+        # Uploaded logs are written to LOG_ROOT before being moved into
+        # the target's directory
+        temp_paths = _stale_temp_paths(settings.LOG_ROOT,
+                                       [name for name, size, is_dir in entries if not is_dir])
+
+        pool = ThreadPool(max(options['jobs'], 1))
+        try:
+            scanned = pool.map(_scan_target, targets)
+        finally:
+            pool.close()
+
+        target_logs = []
+        for target, (logs, target_temp_paths, warnings) in zip(targets, scanned):
+            for warning in warnings:
+                print >>sys.stderr, target + ": " + warning
+            target_logs.append((target, logs))
+            temp_paths.extend(target_temp_paths)
+
+        for path in temp_paths:
+            print "Removing stale temporary file: " + path
+            if options['dry_run']:
                 continue
 
-            target_dir = os.path.join(settings.LOG_ROOT, target)
+            try:
+                os.remove(path)
+            except OSError, e:
+                print >>sys.stderr, "Can't remove %s: %s" % (path, e.strerror)
 
-            to_sort = []
-            for f in os.listdir(target_dir):
-                m = LOG_RE.match(f)
-                if not m:
-                    print >>sys.stderr, "Log file " + f + " doesn't match pattern"
-                    continue
-                date = datetime.strptime(m.group(1), "%Y-%m-%d-%H:%M:%S")
-                to_sort.append((date, f))
+        remove = self._select(target_logs)
+        remove.sort(key=lambda log: (log.target, log.time))
 
-            to_sort.sort(lambda a, b: cmp(a[0], b[0]))
-            if len(to_sort) <= NUM_RETAIN:
+        # Log directories are named after the target with / replaced by -
+        target_names = dict((t.name.replace('/', '-'), t.name) for t in config.Target.all())
+
+        changed_targets = set()
+        last_target = None
+        for log in remove:
+            if log.target != last_target:
+                if last_target is not None:
+                    print
+                print log.target + ":"
+                last_target = log.target
+
+            print "Removing: " + log.filename
+            if options['dry_run']:
                 continue
 
-            if first:
-                first = False
-            else:
-                print
+            for path in log.paths:
+                try:
+                    os.remove(path)
+                except OSError, e:
+                    print >>sys.stderr, "Can't remove %s: %s" % (path, e.strerror)
+
+            if options['delete_reports']:
+                target_name = self._delete_report(log, target_names)
+                if target_name is not None:
+                    changed_targets.add(target_name)
 
-            print target + ":"
-            for (date, f) in to_sort[:len(to_sort)-NUM_RETAIN]:
-                print "Removing: " + f
-                os.remove(os.path.join(target_dir, f))
+        if len(changed_targets) > 0:
+            target_ids = list(Target.objects.filter(name__in=changed_targets).values_list('id', flat=True))
+            with transaction.commit_on_success():
+                refresh_statuses(target_ids)
+            bump_data_version(target_ids)
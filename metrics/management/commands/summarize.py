@@ -1,8 +1,48 @@
+from optparse import make_option
+
 from django.core.management.base import BaseCommand, CommandError
-from metrics.views import resummarize
+from metrics.views import resummarize, resummarize_dirty
+from metrics import rebuild
 
 class Command(BaseCommand):
     help = 'Recompute time-range summaries and save the results to the database'
 
+    option_list = BaseCommand.option_list + (
+        make_option('--dirty-only',
+                    action='store_true',
+                    dest='dirty_only',
+                    default=False,
+                    help='Only recompute saved summaries invalidated by late-arriving values'),
+        make_option('--rebuild',
+                    action='store_true',
+                    dest='rebuild',
+                    default=False,
+                    help='Discard all saved summaries and recompute them from the values (requires NumPy)'),
+        make_option('--processes',
+                    type='int',
+                    dest='processes',
+                    default=1,
+                    help='Number of worker processes for --rebuild, each rebuilding a share of the targets'),
+        make_option('--resume',
+                    action='store_true',
+                    dest='resume',
+                    default=False,
+                    help='Continue an interrupted --rebuild, skipping the targets it finished'),
+    )
+
     def handle(self, *args, **options):
-        resummarize()
+        if options['processes'] < 1:
+            raise CommandError("--processes must be positive")
+        if (options['processes'] > 1 or options['resume']) and not options['rebuild']:
+            raise CommandError("--processes and --resume only apply to --rebuild")
+
+        if options['rebuild']:
+            if rebuild.np is None:
+                raise CommandError("--rebuild requires NumPy")
+            rebuild.rebuild_summaries(processes=options['processes'],
+                                      resume=options['resume'],
+                                      verbose=int(options['verbosity']) > 0)
+        elif options['dirty_only']:
+            resummarize_dirty()
+        else:
+            resummarize()
@@ -0,0 +1,124 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction, DatabaseError
+
+import os
+from optparse import make_option
+
+from metrics import models
+from metrics.models import refresh_statuses, save_pending_summaries, Target, TargetStatus, Value, SummaryHour6, SummaryDay, SummaryWeek, SummaryMonth
+
+# The models with indexes in sql/<model>.sql; syncdb creates these for
+# new tables, but not for tables that already exist
+INDEXED_MODELS = (Value, SummaryHour6, SummaryDay, SummaryWeek, SummaryMonth)
+
+SUMMARY_MODELS = (SummaryHour6, SummaryDay, SummaryWeek, SummaryMonth)
+
+def _index_exists_error(e):
+    # Whether e is the error for creating an index that's already there:
+    # SQLite and PostgreSQL say "... already exists", MySQL "Duplicate key
+    # name ..."
+    message = str(e).lower()
+    return 'already exists' in message or 'duplicate key name' in message
+
+class Command(BaseCommand):
+    help = 'Bring a database created by an earlier version up to date; syncdb should be run first'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+                    type='int',
+                    dest='batch_size',
+                    default=100000,
+                    help='Number of values to fill in per transaction'),
+    )
+
+    def _execute(self, sql, params=()):
+        with transaction.commit_on_success():
+            cursor = connection.cursor()
+            cursor.execute(sql, params)
+            transaction.set_dirty()
+
+    def _add_columns(self, model, names):
+        # Columns are added as nullable, since existing rows have no values
+        # for them. Value.target and Value.pull_time are filled in below;
+        # the summary sum_squares and histogram stay null until the
+        # summaries are recomputed
+        qn = connection.ops.quote_name
+        table = model._meta.db_table
+        cursor = connection.cursor()
+        columns = [row[0] for row in connection.introspection.get_table_description(cursor, table)]
+
+        for name in names:
+            field = model._meta.get_field(name)
+            if field.column in columns:
+                continue
+            print "Adding %s.%s" % (table, field.column)
+            self._execute("ALTER TABLE %s ADD COLUMN %s %s NULL" %
+                          (qn(table), qn(field.column), field.db_type(connection=connection)))
+
+    def _fill_value_columns(self, batch_size):
+        qn = connection.ops.quote_name
+        value_table = qn(Value._meta.db_table)
+        report_table = qn(models.Report._meta.db_table)
+
+        cursor = connection.cursor()
+        cursor.execute("SELECT MIN(id), MAX(id) FROM %s WHERE target_id IS NULL OR pull_time IS NULL" % value_table)
+        first, last = cursor.fetchone()
+        if first is None:
+            return
+
+        for start in xrange(first, last + 1, batch_size):
+            print "Filling in values %d-%d of %d" % (start, min(start + batch_size, last + 1) - 1, last)
+            self._execute(("UPDATE %(value)s SET "
+                           "target_id = (SELECT target_id FROM %(report)s WHERE %(report)s.id = %(value)s.report_id), "
+                           "pull_time = (SELECT pull_time FROM %(report)s WHERE %(report)s.id = %(value)s.report_id) "
+                           "WHERE id >= %%s AND id < %%s AND (target_id IS NULL OR pull_time IS NULL)") %
+                          { 'value': value_table, 'report': report_table },
+                          (start, start + batch_size))
+
+    def _fill_statuses(self):
+        # Uploads create the status of a target they find without one, but
+        # targets that aren't uploading need theirs created here
+        target_ids = list(Target.objects.exclude(id__in=TargetStatus.objects.values('target')) \
+                                        .values_list('id', flat=True))
+        for target_id in target_ids:
+            print "Computing status of target %d" % target_id
+            with transaction.commit_on_success():
+                refresh_statuses([target_id])
+
+    def _save_pending_summaries(self):
+        # From now on uploads keep the summaries up to date
+        print "Saving summaries"
+        with transaction.commit_on_success():
+            save_pending_summaries()
+
+    def _create_indexes(self):
+        sql_dir = os.path.join(os.path.dirname(models.__file__), 'sql')
+        for model in INDEXED_MODELS:
+            with open(os.path.join(sql_dir, model._meta.object_name.lower() + '.sql')) as f:
+                statements = [s.strip() for s in f.read().split(';')]
+
+            for statement in statements:
+                if statement == '':
+                    continue
+                # There's no portable way to ask whether an index exists,
+                # so we try to create it and see
+                try:
+                    self._execute(statement)
+                    print statement
+                except DatabaseError, e:
+                    if not _index_exists_error(e):
+                        raise CommandError("%s failed: %s" % (statement, e))
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive")
+
+        self._add_columns(Value, ('target', 'pull_time'))
+        for model in SUMMARY_MODELS:
+            self._add_columns(model, ('sum_squares', 'histogram'))
+        self._fill_value_columns(options['batch_size'])
+        self._create_indexes()
+        self._fill_statuses()
+        if settings.INCREMENTAL_SUMMARIES:
+            self._save_pending_summaries()
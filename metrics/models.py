@@ -1,8 +1,28 @@
 from datetime import datetime, timedelta
-from django.db import models
+from django.conf import settings
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import Count, F, Max, Min, Q, Sum
 from django.utils import timezone
+import hashlib
 import sys
 
+from cache import LRUCache
+from sketch import LogHistogram
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# timedelta.total_seconds added in 2.7
+if hasattr(timedelta, 'total_seconds'):
+    def unix_time(dt):
+        return int(round((dt - _EPOCH).total_seconds()))
+else:
+    def unix_time(dt):
+        td = dt - _EPOCH
+        return int(round(float(td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10**6))
+
+def from_unix_time(t):
+    return _EPOCH + timedelta(seconds=t)
+
 class Metric(models.Model):
     name = models.CharField(max_length=255)
 
@@ -23,31 +43,440 @@ class Value(models.Model):
     report = models.ForeignKey(Report)
     metric = models.ForeignKey(Metric)
     value = models.FloatField()
+    # Copied from the report, so that queries don't need to join it;
+    # see sql/value.sql for the index
+    target = models.ForeignKey(Target)
+    pull_time = models.DateTimeField()
 
     @staticmethod
     def filter_and_order(qs, start=None, end=None, metric=None, target=None):
         if start is not None:
-            qs = qs.filter(report__pull_time__gte=start)
+            qs = qs.filter(pull_time__gte=start)
         if end is not None:
-            qs = qs.filter(report__pull_time__lt=end)
+            qs = qs.filter(pull_time__lt=end)
         if metric is not None:
-            qs = qs.filter(metric__name=metric.name)
+            qs = qs.filter(metric=_object_id(Metric, metric.name))
         if target is not None:
-            qs = qs.filter(report__target__name=target.name)
+            qs = qs.filter(target=_object_id(Target, target.name))
+
+        # Summaries add up values in this order, so ties are broken by id
+        # to make the rounding the same each time
+        return qs.order_by('metric', 'target', 'pull_time', 'id') \
+                 .select_related('report', 'target', 'metric')
+
+def _object_id(cls, name):
+    # Returns the id of the Metric or Target with the given name, so
+    # queries can filter on it without joining; -1 matches nothing
+    ids = list(cls.objects.filter(name=name).values_list('id', flat=True)[:1])
+    return ids[0] if len(ids) > 0 else -1
+
+def _save_new(obj):
+    # Saves a new row that has a unique key, in a savepoint; returns False,
+    # without saving it, if a concurrent transaction created a row with the
+    # key first. The caller can then update that row instead.
+    sid = transaction.savepoint()
+    try:
+        obj.save()
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        return False
+    transaction.savepoint_commit(sid)
+    return True
+
+# Row queries: for loops over many rows, these return plain tuples
+# rather than model instances, with times as seconds since the epoch.
+#
+# Value rows are (metric_id, target_id, time, value, revision, id)
+# Summary rows are (metric_id, target_id, time, avg, min, max, count,
+#                   sum of squares, encoded histogram, id)
+
+_VALUE_ROW_FIELDS = ('metric', 'target', 'pull_time', 'value', 'report__revision', 'id')
+_SUMMARY_ROW_FIELDS = ('metric', 'target', 'time', 'avg_value', 'min_value', 'max_value', 'count',
+                       'sum_squares', 'histogram', 'id')
+
+def _epoch_sql(column):
+    # (SQL, params) for the seconds since the epoch of a datetime column,
+    # or None if we don't know how for the database. Datetimes are stored
+    # in UTC. extra() takes any %s in the SQL as a parameter, so the
+    # strftime() format has to be passed as one.
+    if connection.vendor == 'sqlite':
+        return "CAST(strftime(%%s, %s) AS INTEGER)" % column, ('%s',)
+    elif connection.vendor == 'postgresql':
+        return "CAST(EXTRACT(EPOCH FROM %s) AS BIGINT)" % column, ()
+    elif connection.vendor == 'mysql':
+        return "TIMESTAMPDIFF(SECOND, '1970-01-01 00:00:00', %s)" % column, ()
+    else:
+        return None
+
+def _row_query(qs, fields, time_field, time_column):
+    # Returns (rows_qs, convert), where convert() turns an iterable of
+    # rows from rows_qs into rows with the time in seconds
+    index = fields.index(time_field)
+    epoch_sql = _epoch_sql(time_column)
+    if epoch_sql is not None:
+        fields = fields[:index] + ('time_epoch',) + fields[index + 1:]
+        rows_qs = qs.extra(select={ 'time_epoch': epoch_sql[0] }, select_params=epoch_sql[1]) \
+                    .values_list(*fields)
+        return rows_qs, lambda rows: rows
+    else:
+        def convert(rows):
+            for row in rows:
+                yield row[:index] + (unix_time(row[index]),) + row[index + 1:]
+        return qs.values_list(*fields), convert
+
+def _iter_rows(qs, fields, time_field, time_column, chunk_size):
+    rows_qs, convert = _row_query(qs, fields, time_field, time_column)
+    if chunk_size is None:
+        for row in convert(rows_qs.iterator()):
+            yield row
+        return
+
+    # Fetch chunk_size rows at a time, in order of time; each chunk
+    # continues from the (time, id) of the last row of the previous one
+    index = fields.index(time_field)
+    last = None
+    while True:
+        chunk_qs = rows_qs
+        if last is not None:
+            chunk_qs = chunk_qs.filter(Q(**{ time_field + '__gt': last[0] }) |
+                                       Q(**{ time_field: last[0], 'id__gt': last[1] }))
+        chunk = list(convert(chunk_qs.order_by(time_field, 'id')[:chunk_size]))
+        for row in chunk:
+            yield row
+
+        if len(chunk) < chunk_size:
+            return
+        last = (from_unix_time(chunk[-1][index]), chunk[-1][-1])
+
+def iter_value_rows(qs, chunk_size=None):
+    # Yields value rows for a Value queryset, in the queryset's order; or
+    # if chunk_size is given, in order of time, chunk_size rows at a time
+    return _iter_rows(qs, _VALUE_ROW_FIELDS, 'pull_time',
+                      Value._meta.db_table + '.pull_time', chunk_size)
+
+def iter_time_value_rows(qs):
+    # Yields just (time, value) for a Value queryset, in the queryset's
+    # order, without joining the reports
+    return _iter_rows(qs, ('pull_time', 'value'), 'pull_time',
+                      Value._meta.db_table + '.pull_time', None)
+
+def iter_summary_rows(qs, chunk_size=None):
+    # The same, for a queryset of a Summary subclass
+    return _iter_rows(qs, _SUMMARY_ROW_FIELDS, 'time',
+                      qs.model._meta.db_table + '.time', chunk_size)
+
+def summary_row(summary):
+    # The row for a Summary object
+    return (summary.metric_id, summary.target_id, unix_time(summary.time),
+            summary.avg_value, summary.min_value, summary.max_value,
+            summary.count, summary.sum_squares, summary.histogram, summary.id)
+
+# Counter bumped whenever the reports or summaries for a target change,
+# so views can tell whether their output might have changed without
+# looking at the reports and values themselves
+class DataVersion(models.Model):
+    target = models.ForeignKey(Target, unique=True)
+    version = models.IntegerField()
+    modified = models.DateTimeField()
+
+def bump_data_version(target_ids=None):
+    # target_ids=None bumps every target
+    if target_ids is None:
+        target_ids = Target.objects.values_list('id', flat=True)
 
-        return qs.order_by('metric', 'report__target', 'report__pull_time') \
-                 .select_related('report__target', 'metric')
+    now = timezone.now()
+    for target_id in set(target_ids):
+        while True:
+            updated = DataVersion.objects.filter(target=target_id) \
+                                         .update(version=F('version') + 1, modified=now)
+            if updated > 0 or _save_new(DataVersion(target_id=target_id, version=1, modified=now)):
+                break
+
+def get_data_version(target_name=None):
+    # Returns (tag, modified) for the target, or for all targets if
+    # target_name is None; or None if nothing has been recorded yet.
+    # Versions only go up, so the sum changes whenever any target changes
+    qs = DataVersion.objects.all()
+    if target_name is not None:
+        qs = qs.filter(target__name=target_name)
+    result = qs.aggregate(count=Count('id'), version=Sum('version'), modified=Max('modified'))
+    if result['modified'] is None:
+        return None
+
+    return '%d.%d' % (result['count'], result['version']), result['modified']
+
+# Counter bumped whenever values or summaries within a month are written,
+# per target; cached /api/values responses are keyed on the counters for
+# the months they cover. For all targets together, the counters of the
+# month are added up when read, so that uploads for different targets
+# don't all update the same row.
+class ValuesGeneration(models.Model):
+    target = models.ForeignKey(Target)
+    month = models.DateTimeField()
+    generation = models.IntegerField()
+
+def bump_values_generations(target_times):
+    # target_times is an iterable of (target_id, time) for the values
+    # written; the summaries for a value can start in an earlier month
+    # than the value itself, so we bump the months of those too
+    keys = set()
+    for target_id, time in target_times:
+        for t in [time] + [cls.time_truncate(time) for cls in _SUMMARY_LEVELS]:
+            month = SummaryMonth.time_truncate(t)
+            keys.add((target_id, month))
+
+    for target_id, month in keys:
+        updated = ValuesGeneration.objects.filter(target=target_id, month=month) \
+                                          .update(generation=F('generation') + 1)
+        if updated == 0:
+            ValuesGeneration(target_id=target_id, month=month, generation=1).save()
+
+def get_values_generations(target_name, start, end):
+    # Returns a sorted list of (month, generation) for the months in
+    # [start, end) that have been written to; None is all targets, or
+    # an open end of the range
+    qs = ValuesGeneration.objects.all()
+    if target_name is not None:
+        qs = qs.filter(target__name=target_name)
+    if start is not None:
+        qs = qs.filter(month__gte=SummaryMonth.time_truncate(start))
+    if end is not None:
+        qs = qs.filter(month__lt=end)
+
+    # Two uploads can race to create the same row; that's harmless as
+    # long as we add up the duplicates
+    qs = qs.values('month').annotate(total=Sum('generation')).order_by()
+    return sorted((row['month'], row['total']) for row in qs)
+
+# Per-target rollup of the reports, kept up to date as reports are
+# stored, so that pages don't have to look through the Report table
+class TargetStatus(models.Model):
+    target = models.ForeignKey(Target, unique=True)
+    # Range of pull times of the reports without errors
+    first_good_time = models.DateTimeField(null=True)
+    last_good_time = models.DateTimeField(null=True)
+    # The most recent report, with or without errors
+    last_report_time = models.DateTimeField(null=True)
+    last_revision = models.CharField(max_length=64)
+    last_error_report = models.ForeignKey(Report, null=True, on_delete=models.SET_NULL)
+    last_error_time = models.DateTimeField(null=True)
+    good_count = models.IntegerField(default=0)
+    error_count = models.IntegerField(default=0)
+
+# The same, rolled up over the targets of a machine
+class MachineStatus(models.Model):
+    machine = models.CharField(max_length=32, unique=True)
+    last_report_time = models.DateTimeField(null=True)
+    report_count = models.IntegerField(default=0)
+
+def _compute_target_status(status):
+    # Fills in status from the Report table
+    reports = Report.objects.filter(target=status.target_id)
+    good = reports.filter(error='').aggregate(min=Min('pull_time'), max=Max('pull_time'), count=Count('id'))
+    status.first_good_time = good['min']
+    status.last_good_time = good['max']
+    status.good_count = good['count']
+    status.error_count = reports.exclude(error='').count()
+
+    status.last_report_time = None
+    status.last_revision = ''
+    for pull_time, revision in reports.order_by('-pull_time', '-id').values_list('pull_time', 'revision')[:1]:
+        status.last_report_time = pull_time
+        status.last_revision = revision
+
+    status.last_error_report = None
+    status.last_error_time = None
+    for error_report in reports.exclude(error='').order_by('-pull_time', '-id')[:1]:
+        status.last_error_report = error_report
+        status.last_error_time = error_report.pull_time
+
+def _update_machine_statuses(machines):
+    for machine in set(machines):
+        rollup = TargetStatus.objects.filter(target__machine=machine) \
+                                     .aggregate(last=Max('last_report_time'),
+                                                good=Sum('good_count'),
+                                                errors=Sum('error_count'))
+        while True:
+            try:
+                status = MachineStatus.objects.select_for_update().get(machine=machine)
+            except MachineStatus.DoesNotExist:
+                status = MachineStatus(machine=machine)
+            status.last_report_time = rollup['last']
+            status.report_count = (rollup['good'] or 0) + (rollup['errors'] or 0)
+            if status.id is not None:
+                status.save()
+            elif not _save_new(status):
+                # Created by a concurrent upload; update that row
+                continue
+            break
+
+def refresh_statuses(target_ids=None):
+    # Recomputes the statuses of the targets from their reports;
+    # target_ids=None does every target
+    if target_ids is None:
+        target_ids = Target.objects.values_list('id', flat=True)
+
+    machines = []
+    for target in Target.objects.filter(id__in=set(target_ids)):
+        while True:
+            try:
+                status = TargetStatus.objects.select_for_update().get(target=target)
+            except TargetStatus.DoesNotExist:
+                status = TargetStatus(target=target)
+            _compute_target_status(status)
+            if status.id is not None:
+                status.save()
+            elif not _save_new(status):
+                # Created concurrently; update that row
+                continue
+            break
+        machines.append(target.machine)
+
+    _update_machine_statuses(machines)
+
+def _merge_reports(status, reports):
+    # Updates status for reports, which it doesn't include yet
+    for report in reports:
+        if report.error == '':
+            status.good_count += 1
+            if status.first_good_time is None or report.pull_time < status.first_good_time:
+                status.first_good_time = report.pull_time
+            if status.last_good_time is None or report.pull_time > status.last_good_time:
+                status.last_good_time = report.pull_time
+        else:
+            status.error_count += 1
+            if status.last_error_time is None or report.pull_time >= status.last_error_time:
+                status.last_error_report = report
+                status.last_error_time = report.pull_time
+        if status.last_report_time is None or report.pull_time >= status.last_report_time:
+            status.last_report_time = report.pull_time
+            status.last_revision = report.revision
+
+def update_statuses(reports):
+    # Merges newly stored reports into the statuses of their targets
+    by_target = {}
+    for report in reports:
+        by_target.setdefault(report.target_id, []).append(report)
+
+    for target_id, target_reports in by_target.iteritems():
+        while True:
+            try:
+                status = TargetStatus.objects.select_for_update().get(target=target_id)
+            except TargetStatus.DoesNotExist:
+                # The reports are already stored, so this picks them up,
+                # along with any from before statuses were kept
+                status = TargetStatus(target_id=target_id)
+                _compute_target_status(status)
+                if not _save_new(status):
+                    # A concurrent upload created it without seeing our
+                    # reports, so merge them into its row
+                    continue
+                break
+
+            _merge_reports(status, target_reports)
+            status.save()
+            break
+
+    _update_machine_statuses(Target.objects.filter(id__in=by_target.keys()).values_list('machine', flat=True))
 
 def resummarize():
     # We give machines a 6 hours grace period to update results
     now = timezone.now()
     cutoff = now - timedelta(hours=6)
 
+    resummarize_dirty()
+
     SummaryHour6.save_summaries(cutoff)
     SummaryDay.save_summaries(cutoff)
     SummaryWeek.save_summaries(cutoff)
     SummaryMonth.save_summaries(cutoff)
 
+    # Saving summaries doesn't change what queries return, since unsaved
+    # summaries are computed on the fly, so there's no version to bump;
+    # resummarize_dirty() bumps the targets whose summaries it changed
+
+def save_pending_summaries():
+    # Saves every summary up to now that hasn't been saved yet. Uploads
+    # with INCREMENTAL_SUMMARIES only update the buckets their values fall
+    # in, so when it's turned on for a database with values, this has to
+    # be run before accepting uploads to save the buckets since the last
+    # 'manage.py summarize'
+    for cls in _SUMMARY_LEVELS:
+        cls._do_summarize(start=cls._max_summary_end(), end=None)
+        cls.store_summary_end()
+
+def mark_dirty_summaries(values):
+    # Records the saved summaries that values arriving late (after the
+    # summary for their time was saved) have invalidated, so that
+    # resummarize_dirty() can recompute them. values is a list of
+    # (target_id, metric_id, pull_time, value)
+    for cls in _SUMMARY_LEVELS:
+        last_summary_end = cls.last_summary_end()
+        if last_summary_end is None:
+            continue
+
+        buckets = set()
+        for target_id, metric_id, time, value in values:
+            if time < last_summary_end:
+                buckets.add((target_id, metric_id, cls.time_truncate(time)))
+
+        for target_id, metric_id, time in buckets:
+            if not DirtySummary.objects.filter(level=cls.level,
+                                               target=target_id,
+                                               metric=metric_id,
+                                               time=time).exists():
+                DirtySummary(level=cls.level,
+                             target_id=target_id,
+                             metric_id=metric_id,
+                             time=time).save()
+
+def resummarize_dirty():
+    # Finer levels first, since each level is computed from the next
+    # finer level
+    for cls in _SUMMARY_LEVELS:
+        with transaction.commit_on_success():
+            dirty = DirtySummary.objects.filter(level=cls.level).select_related('target', 'metric')
+            done = set()
+            dirty_ids = []
+            for d in dirty:
+                dirty_ids.append(d.id)
+                key = (d.target_id, d.metric_id, d.time)
+                if key in done:
+                    continue
+                done.add(key)
+                cls.resummarize_bucket(d.target, d.metric, d.time)
+
+            # Entries added while we were working are left for next time
+            DirtySummary.objects.filter(id__in=dirty_ids).delete()
+
+            if len(done) > 0:
+                bump_data_version(target_id for target_id, metric_id, time in done)
+                bump_values_generations((target_id, time) for target_id, metric_id, time in done)
+
+def update_summaries(values):
+    # Merges newly uploaded values into the saved summaries at every
+    # level; values is a list of (target_id, metric_id, pull_time, value)
+    for cls in _SUMMARY_LEVELS:
+        cls.add_values(values)
+
+# (values generation, summary tuples) for buckets that haven't been saved
+# yet, keyed by _unsaved_key(); see Summary._get_unsaved(). The summaries
+# are kept as tuples of _UNSAVED_FIELDS rather than model instances, which
+# are much slower to pickle. The least recently used buckets are dropped
+# once it gets big.
+_unsaved_summaries = LRUCache('unsaved-summaries', {
+    'TIMEOUT': 24 * 3600,
+    'OPTIONS': { 'MAX_BYTES': 16 * 1024 * 1024 }
+})
+
+_UNSAVED_FIELDS = ('target_id', 'metric_id', 'time', 'min_value', 'max_value', 'avg_value', 'count',
+                   'sum_squares', 'histogram')
+
+def _unsaved_key(level, last_summary_end, target_name, metric_name, time):
+    # Once summaries are saved, last_summary_end changes and the
+    # remembered ones are no longer used
+    return hashlib.sha1(repr((level, last_summary_end, target_name, metric_name, time))).hexdigest()
+
 class Summary(models.Model):
     time = models.DateTimeField()
     target = models.ForeignKey(Target)
@@ -56,20 +485,60 @@ class Summary(models.Model):
     max_value = models.FloatField()
     avg_value = models.FloatField()
     count = models.IntegerField()
+    # For the standard deviation and quantiles. These are null for
+    # summaries saved before they were added, and then for the summaries
+    # computed from those
+    sum_squares = models.FloatField(null=True)
+    histogram = models.TextField(null=True)
 
     class Meta:
         abstract = True
 
     @classmethod
-    def last_summary_end(cls):
+    def _max_summary_end(cls):
         last_summary_start = cls.objects.aggregate(models.Max('time'))['time__max']
         if last_summary_start is not None:
             return cls.time_next(last_summary_start)
         else:
             return None
 
+    @classmethod
+    def last_summary_end(cls):
+        # The end of the last saved bucket, or None. It's kept in
+        # SummaryEnd by whatever saves summaries, so that uploads don't
+        # have to look through the table for it
+        try:
+            return SummaryEnd.objects.get(level=cls.level).time
+        except SummaryEnd.DoesNotExist:
+            return cls._max_summary_end()
+
+    @classmethod
+    def store_summary_end(cls):
+        end = cls._max_summary_end()
+        updated = SummaryEnd.objects.filter(level=cls.level).update(time=end)
+        if updated == 0:
+            SummaryEnd(level=cls.level, time=end).save()
+
+    @classmethod
+    def _extend_summary_end(cls, end):
+        # Only writes when a bucket past the stored end is created
+        SummaryEnd.objects.filter(Q(time__isnull=True) | Q(time__lt=end), level=cls.level) \
+                          .update(time=end)
+
     @classmethod
     def get_summaries(cls, start, end, target=None, metric=None):
+        result = list(cls.get_saved_summaries(start, end, target=target, metric=metric))
+        result.extend(cls.get_unsaved_summaries(start, end, target=target, metric=metric))
+
+        # The unsaved summaries have to be merged into order with the
+        # saved ones
+        result.sort(key=lambda summary: (summary.metric_id, summary.target_id, summary.time))
+
+        return result
+
+    @classmethod
+    def truncate_range(cls, start, end):
+        # Returns the start and end of the buckets covering [start, end)
         if start is not None:
             start_truncated = cls.time_truncate(start)
         else:
@@ -82,37 +551,230 @@ class Summary(models.Model):
         else:
             end_truncated = None
 
-        qs = cls.filter_and_order(cls.objects.all(),
-                                  start=start_truncated, end=end_truncated,
-                                  target=target, metric=metric)
+        return start_truncated, end_truncated
 
-        result = list(qs)
+    @classmethod
+    def get_saved_summaries(cls, start, end, target=None, metric=None):
+        start_truncated, end_truncated = cls.truncate_range(start, end)
+        return cls.filter_and_order(cls.objects.all(),
+                                    start=start_truncated, end=end_truncated,
+                                    target=target, metric=metric)
 
-        if start_truncated is not None:
-            last_summary_end = cls.last_summary_end()
-            if last_summary_end is not None:
+    @classmethod
+    def get_unsaved_summaries(cls, start, end, target=None, metric=None):
+        # Returns a list of the summaries for [start, end) that haven't
+        # been saved yet, in the same order as filter_and_order()
+
+        # When uploads update the summaries, the saved summaries are
+        # already current and there's nothing unsaved to add
+        if settings.INCREMENTAL_SUMMARIES:
+            return []
+
+        start_truncated, end_truncated = cls.truncate_range(start, end)
+
+        # There's nothing to summarize after the current bucket, and
+        # walking a far-off end bucket by bucket would be slow
+        now_end = cls.time_next(cls.time_truncate(timezone.now()))
+        if end_truncated is not None:
+            end_truncated = min(end_truncated, now_end)
+
+        last_summary_end = cls.last_summary_end()
+        if last_summary_end is not None:
+            if start_truncated is not None:
                 start_truncated = max(start_truncated, last_summary_end)
+            else:
+                start_truncated = last_summary_end
+
+        if start_truncated is None or end_truncated is None:
+            # No bounds to split into buckets
+            result = []
+            cls._do_summarize(start=start_truncated,
+                              end=end_truncated,
+                              target=target,
+                              metric=metric,
+                              append_unsaved=result)
+            return result
+
+        result = cls._get_unsaved(start_truncated, end_truncated,
+                                  target, metric, last_summary_end)
+        result.sort(key=lambda summary: (summary.metric_id, summary.target_id, summary.time))
+
+        return result
 
-        cls._do_summarize(start=start_truncated,
-                          end=end_truncated,
-                          target=target,
-                          metric=metric,
-                          append_unsaved=result)
+    @classmethod
+    def _get_unsaved(cls, start, end, target, metric, last_summary_end):
+        # Computing unsaved summaries means summarizing the finer levels
+        # all the way down to the values, so we remember the result for
+        # each bucket until values are written to it
+        target_name = target.name if target is not None else None
+        metric_name = metric.name if metric is not None else None
+
+        generations = dict(get_values_generations(target_name, start, end))
+
+        result = []
+        missing = []
+        time = start
+        while time < end:
+            generation = generations.get(SummaryMonth.time_truncate(time), 0)
+            remembered = _unsaved_summaries.get(_unsaved_key(cls.level, last_summary_end,
+                                                             target_name, metric_name, time))
+            if remembered is not None and remembered[0] == generation:
+                result.extend(cls(**dict(zip(_UNSAVED_FIELDS, values))) for values in remembered[1])
+            else:
+                missing.append((time, generation))
+            time = cls.time_next(time)
+
+        # Summarize each run of consecutive missing buckets in one pass
+        i = 0
+        while i < len(missing):
+            run_start = missing[i][0]
+            run_end = cls.time_next(run_start)
+            j = i + 1
+            while j < len(missing) and missing[j][0] == run_end:
+                run_end = cls.time_next(run_end)
+                j += 1
+
+            summaries = []
+            cls._do_summarize(start=run_start, end=run_end,
+                              target=target, metric=metric,
+                              append_unsaved=summaries)
+            result.extend(summaries)
+
+            by_time = dict((time, []) for time, generation in missing[i:j])
+            for summary in summaries:
+                by_time[summary.time].append(tuple(getattr(summary, name) for name in _UNSAVED_FIELDS))
+            for time, generation in missing[i:j]:
+                _unsaved_summaries.set(_unsaved_key(cls.level, last_summary_end,
+                                                    target_name, metric_name, time),
+                                       (generation, by_time[time]))
+
+            i = j
 
         return result
 
     @classmethod
     def save_summaries(cls, cutoff):
-        cls._do_summarize(start=cls.last_summary_end(),
+        cls._do_summarize(start=cls._max_summary_end(),
                             end=cls.time_truncate(cutoff))
+        cls.store_summary_end()
+
+    @classmethod
+    def resummarize_bucket(cls, target, metric, time):
+        cls.objects.filter(target=target, metric=metric, time=time).delete()
+        cls._do_summarize(start=time, end=cls.time_next(time),
+                          target=target, metric=metric)
+
+    @classmethod
+    def add_values(cls, values):
+        # Combine the new values per bucket first, so we only touch
+        # each summary row once. The values must already be stored.
+        buckets = {}
+        for target_id, metric_id, time, value in values:
+            key = (target_id, metric_id, cls.time_truncate(time))
+            if key in buckets:
+                (min_value, max_value, total_value, count, sum_squares, histogram) = buckets[key]
+                buckets[key] = (min(min_value, value), max(max_value, value),
+                                total_value + value, count + 1,
+                                sum_squares + value * value, histogram)
+            else:
+                histogram = LogHistogram()
+                buckets[key] = (value, value, value, 1, value * value, histogram)
+            histogram.add(value)
+
+        for (target_id, metric_id, time), (min_value, max_value, total_value, count, sum_squares, histogram) \
+                in buckets.iteritems():
+            while True:
+                try:
+                    summary = cls.objects.select_for_update().get(target=target_id,
+                                                                  metric=metric_id,
+                                                                  time=time)
+                except cls.DoesNotExist:
+                    # Values from before this one may be in the bucket
+                    # without having been summarized (the finer level
+                    # can't be trusted to have them either), so we start
+                    # from all the stored values, these included
+                    summary = cls.summary_from_values(target_id, metric_id, time)
+                    if not _save_new(summary):
+                        # Its values aren't visible to us, so merge into it
+                        continue
+                    cls._extend_summary_end(cls.time_next(time))
+                    break
+
+                merged_total = total_value + summary.avg_value * summary.count
+                summary.min_value = min(summary.min_value, min_value)
+                summary.max_value = max(summary.max_value, max_value)
+                summary.count += count
+                summary.avg_value = merged_total / summary.count
+                if summary.sum_squares is not None:
+                    summary.sum_squares += sum_squares
+                if summary.histogram is not None:
+                    merged_histogram = LogHistogram.decode(summary.histogram)
+                    merged_histogram.merge(histogram)
+                    summary.histogram = merged_histogram.encode()
+                summary.save()
+                break
+
+    @classmethod
+    def summary_from_values(cls, target_id, metric_id, time):
+        # The summary of the stored values in a bucket, or None if there
+        # are none
+        qs = Value.objects.filter(target=target_id, metric=metric_id,
+                                  pull_time__gte=time, pull_time__lt=cls.time_next(time))
+
+        summary = cls(time=time, target_id=target_id, metric_id=metric_id, count=0)
+        total_value = 0.
+        sum_squares = 0.
+        histogram = LogHistogram()
+        for value in qs.order_by('pull_time', 'id').values_list('value', flat=True).iterator():
+            if summary.count == 0:
+                summary.min_value = summary.max_value = value
+            else:
+                summary.min_value = min(summary.min_value, value)
+                summary.max_value = max(summary.max_value, value)
+            total_value += value
+            sum_squares += value * value
+            histogram.add(value)
+            summary.count += 1
+
+        if summary.count == 0:
+            return None
+        summary.avg_value = total_value / summary.count
+        summary.sum_squares = sum_squares
+        summary.histogram = histogram.encode()
+        return summary
 
     @classmethod
     def _do_summarize(cls, start, end, target=None, metric=None, append_unsaved=None):
+        # Rows are (metric_id, target_id, time, min, max, avg, count,
+        # sum of squares, histogram); the histogram is a LogHistogram
+        # for a value, and encoded for a summary
         if append_unsaved is not None and cls.finer != Value:
-            qs = cls.finer.get_summaries(start, end, target=target, metric=metric)
+            rows = [(s.metric_id, s.target_id, s.time, s.min_value, s.max_value, s.avg_value, s.count,
+                     s.sum_squares, s.histogram)
+                    for s in cls.finer.get_summaries(start, end, target=target, metric=metric)]
         else:
             qs = cls.finer.filter_and_order(cls.finer.objects.all(),
                                             start=start, end=end, target=target, metric=metric)
+            if cls.finer == Value:
+                rows = ((metric_id, target_id, time, value, value, value, 1, value * value, value)
+                        for metric_id, target_id, time, value
+                        in qs.values_list('metric', 'target', 'pull_time', 'value').iterator())
+            else:
+                rows = qs.values_list('metric', 'target', 'time',
+                                      'min_value', 'max_value', 'avg_value', 'count',
+                                      'sum_squares', 'histogram').iterator()
+
+        def make_summary():
+            return cls(time=last_truncated,
+                       target_id=last_target,
+                       metric_id=last_metric,
+                       min_value=total_min_value,
+                       max_value=total_max_value,
+                       avg_value=(total_value/total_count),
+                       count=total_count,
+                       sum_squares=total_sum_squares,
+                       histogram=total_histogram.encode() if total_histogram is not None else None)
+
         last_metric = None
         last_target  = None
         last_truncated  = None
@@ -120,31 +782,14 @@ class Summary(models.Model):
         total_max_value = None
         total_value = None
         total_count = 0
+        total_sum_squares = None
+        total_histogram = None
 
-        for row in qs:
-            if cls.finer == Value:
-                target = row.report.target
-                time = row.report.pull_time
-                min_value = max_value = avg_value = row.value
-                count = 1
-            else:
-                target = row.target
-                time = row.time
-                min_value = row.min_value
-                max_value = row.max_value
-                avg_value = row.avg_value
-                count = row.count
-
+        for metric_id, target_id, time, min_value, max_value, avg_value, count, sum_squares, histogram in rows:
             truncated = cls.time_truncate(time)
-            if last_metric != row.metric or last_target != target or truncated != last_truncated:
+            if last_metric != metric_id or last_target != target_id or truncated != last_truncated:
                 if total_count > 0:
-                    summary = cls(time=last_truncated,
-                                  target=last_target,
-                                  metric=last_metric,
-                                  min_value=total_min_value,
-                                  max_value=total_max_value,
-                                  avg_value=(total_value/total_count),
-                                  count=total_count)
+                    summary = make_summary()
                     if append_unsaved is not None:
                         append_unsaved.append(summary)
                     else:
@@ -154,23 +799,30 @@ class Summary(models.Model):
                 total_max_value = max_value
                 total_value = avg_value * count
                 total_count = count
-                last_metric = row.metric
-                last_target = target
+                total_sum_squares = sum_squares
+                total_histogram = LogHistogram()
+                last_metric = metric_id
+                last_target = target_id
                 last_truncated = truncated
             else:
                 total_min_value = min(total_min_value, min_value)
                 total_max_value = max(total_max_value, max_value)
                 total_value += avg_value * count
                 total_count += count
+                if total_sum_squares is not None:
+                    total_sum_squares = sum_squares + total_sum_squares if sum_squares is not None else None
+
+            # Once any of the inputs has no histogram, the result can't have one
+            if total_histogram is not None:
+                if histogram is None:
+                    total_histogram = None
+                elif cls.finer == Value:
+                    total_histogram.add(histogram)
+                else:
+                    total_histogram.merge(LogHistogram.decode(histogram))
 
         if total_count > 0:
-            summary = cls(time=last_truncated,
-                          target=last_target,
-                          metric=last_metric,
-                          min_value=total_min_value,
-                          max_value=total_max_value,
-                          avg_value=(total_value/total_count),
-                          count=total_count)
+            summary = make_summary()
             if append_unsaved is not None:
                 append_unsaved.append(summary)
             else:
@@ -183,14 +835,16 @@ class Summary(models.Model):
         if end is not None:
             qs = qs.filter(time__lt=end)
         if metric is not None:
-            qs = qs.filter(metric__name=metric.name)
+            qs = qs.filter(metric=_object_id(Metric, metric.name))
         if target is not None:
-            qs = qs.filter(target__name=target.name)
+            qs = qs.filter(target=_object_id(Target, target.name))
 
         return qs.order_by('target', 'metric', 'time') \
-                 .select_related('report__target', 'metric')
+                 .select_related('target', 'metric')
 
 class SummaryHour6(Summary):
+    level = 'hour6'
+
     @staticmethod
     def time_truncate(dt):
         return dt.replace(hour=dt.hour-dt.hour%6, minute=0, second=0, microsecond=0)
@@ -202,6 +856,8 @@ class SummaryHour6(Summary):
     finer = Value
 
 class SummaryDay(Summary):
+    level = 'day'
+
     @staticmethod
     def time_truncate(dt):
         return dt.replace(hour=0, minute=0, second=0, microsecond=0)
@@ -213,6 +869,8 @@ class SummaryDay(Summary):
     finer = SummaryHour6
 
 class SummaryWeek(Summary):
+    level = 'week'
+
     @staticmethod
     def time_truncate(dt):
         tmp =  dt.replace(hour=0, minute=0, second=0, microsecond=0)
@@ -226,6 +884,8 @@ class SummaryWeek(Summary):
     finer = SummaryDay
 
 class SummaryMonth(Summary):
+    level = 'month'
+
     @staticmethod
     def time_truncate(dt):
         return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
@@ -239,3 +899,25 @@ class SummaryMonth(Summary):
 
     # A month isn't exactly 4 weeks, so we have to summarize from days
     finer = SummaryDay
+
+# A saved summary that needs to be recomputed because values arrived
+# for its time range after it was saved
+class DirtySummary(models.Model):
+    level = models.CharField(max_length=16)
+    target = models.ForeignKey(Target)
+    metric = models.ForeignKey(Metric)
+    time = models.DateTimeField()
+
+# The end of the saved summaries of each level (null if there are none),
+# kept up to date by Summary.store_summary_end() and add_values(); see
+# Summary.last_summary_end(). Without a row, it's computed from the table.
+class SummaryEnd(models.Model):
+    level = models.CharField(max_length=16, unique=True)
+    time = models.DateTimeField(null=True)
+
+# A target whose summaries 'summarize --rebuild' has finished rebuilding,
+# so that an interrupted rebuild can be resumed; see rebuild.py
+class RebuildCheckpoint(models.Model):
+    target = models.ForeignKey(Target, unique=True)
+
+_SUMMARY_LEVELS = (SummaryHour6, SummaryDay, SummaryWeek, SummaryMonth)
@@ -0,0 +1,269 @@
+from datetime import timedelta
+import multiprocessing
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from models import *
+from models import _SUMMARY_LEVELS
+from sketch import bucket_key, LogHistogram, LOG_GAMMA
+
+# Rebuilding the summary tables from scratch, with the work done on NumPy
+# arrays a (target, metric) series at a time, optionally spread over a
+# pool of processes by target. The results are the same as from
+# Summary._do_summarize(), down to the rounding (see RebuildTest): each
+# level is computed from the next finer one as it is there, and sums are
+# added up in the same order.
+
+_BATCH_SIZE = 100
+
+def _bucket_starts(cls, times):
+    # The vectorized equivalent of cls.time_truncate(), for times in
+    # seconds since the epoch
+    if cls is SummaryHour6:
+        return times - times % (6 * 3600)
+    elif cls is SummaryDay:
+        return times - times % (24 * 3600)
+    elif cls is SummaryWeek:
+        # Monday as week start; 1970-01-01 was a Thursday
+        days = times // (24 * 3600)
+        return (days - (days + 3) % 7) * (24 * 3600)
+    elif cls is SummaryMonth:
+        return times.astype('datetime64[s]').astype('datetime64[M]') \
+                    .astype('datetime64[s]').astype(np.int64)
+
+def _segment_starts(keys):
+    # Indices where each run of equal keys starts
+    return np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+
+def _sequential_sums(values, starts):
+    # Sums each segment from left to right, rather than pairwise as
+    # np.add.reduceat() can, so that the rounding matches
+    lengths = np.diff(np.concatenate((starts, [len(values)])))
+    sums = values[starts].copy()
+    for k in range(1, lengths.max() if len(lengths) > 0 else 0):
+        mask = lengths > k
+        sums[mask] += values[starts[mask] + k]
+    return sums
+
+def _histogram_keys(values):
+    # Returns (valid, signs, indices), the bucket each value goes into as
+    # LogHistogram.add() computes it; NaNs aren't counted
+    valid = ~np.isnan(values)
+    signs = np.sign(np.where(valid, values, 0)).astype(np.int64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.log(np.abs(values)) / LOG_GAMMA
+        # np.log() isn't guaranteed to round the same as math.log(); where
+        # that could move a value into the next bucket, ask bucket_key()
+        near = (signs != 0) & (np.abs(x - np.rint(x)) < 1e-9)
+    indices = np.where(signs != 0, np.ceil(x), 0).astype(np.int64)
+
+    for i in np.flatnonzero(near):
+        indices[i] = bucket_key(float(values[i]))[1]
+
+    return valid, signs, indices
+
+def _histograms(segments, valid, signs, indices, n_segments):
+    # Returns the encoded histogram of each segment, given the segment
+    # number of each value
+    histograms = [LogHistogram() for i in range(n_segments)]
+
+    segments = segments[valid]
+    signs = signs[valid]
+    indices = indices[valid]
+    order = np.lexsort((indices, signs, segments))
+    keys = np.column_stack((segments[order], signs[order], indices[order]))
+    if len(keys) > 0:
+        starts = _segment_starts_2d(keys)
+        counts = np.diff(np.concatenate((starts, [len(keys)])))
+        for start, count in zip(starts, counts):
+            segment, sign, index = keys[start]
+            histogram = histograms[segment]
+            histogram.counts[(int(sign), int(index))] = int(count)
+            histogram.total += int(count)
+
+    return [histogram.encode() for histogram in histograms]
+
+def _segment_starts_2d(keys):
+    # Like _segment_starts(), for rows of keys
+    return np.flatnonzero(np.concatenate(([True], np.any(keys[1:] != keys[:-1], axis=1))))
+
+class _Level(object):
+    # The summaries of one level for a series, as arrays
+    pass
+
+def _summarize_level(cls, finer, value_times, histogram_keys):
+    # Computes cls's summaries from those of the finer level (or from the
+    # values, as a _Level with count 1 each); value_times are the times of
+    # the values, for the histograms
+    buckets = _bucket_starts(cls, finer.times)
+    starts = _segment_starts(buckets)
+
+    level = _Level()
+    level.times = buckets[starts]
+    level.min_values = np.minimum.reduceat(finer.min_values, starts)
+    level.max_values = np.maximum.reduceat(finer.max_values, starts)
+    level.counts = np.add.reduceat(finer.counts, starts)
+    total_values = _sequential_sums(finer.avg_values * finer.counts, starts)
+    level.avg_values = total_values / level.counts
+    level.sum_squares = _sequential_sums(finer.sum_squares, starts)
+
+    # Merging histograms just adds up the counts, so each level's
+    # histograms are the histograms of its values
+    value_buckets = _bucket_starts(cls, value_times)
+    segments = np.searchsorted(level.times, value_buckets)
+    level.histograms = _histograms(segments, histogram_keys[0], histogram_keys[1], histogram_keys[2],
+                                   len(level.times))
+
+    return level
+
+def _summarize_series(times, values):
+    # Returns { cls: _Level } for the values of a series, sorted by time
+    base = _Level()
+    base.times = times
+    base.min_values = values
+    base.max_values = values
+    base.avg_values = values
+    base.counts = np.ones(len(values), dtype=np.int64)
+    base.sum_squares = values * values
+
+    histogram_keys = _histogram_keys(values)
+
+    levels = {}
+    levels[SummaryHour6] = _summarize_level(SummaryHour6, base, times, histogram_keys)
+    levels[SummaryDay] = _summarize_level(SummaryDay, levels[SummaryHour6], times, histogram_keys)
+    levels[SummaryWeek] = _summarize_level(SummaryWeek, levels[SummaryDay], times, histogram_keys)
+    levels[SummaryMonth] = _summarize_level(SummaryMonth, levels[SummaryDay], times, histogram_keys)
+
+    return levels
+
+def _save_level(cls, target_id, metric_id, level, end):
+    summaries = []
+    for i in xrange(len(level.times)):
+        time = int(level.times[i])
+        if end is not None and time >= end:
+            break
+        summaries.append(cls(time=from_unix_time(time),
+                             target_id=target_id,
+                             metric_id=metric_id,
+                             min_value=float(level.min_values[i]),
+                             max_value=float(level.max_values[i]),
+                             avg_value=float(level.avg_values[i]),
+                             count=int(level.counts[i]),
+                             sum_squares=float(level.sum_squares[i]),
+                             histogram=level.histograms[i]))
+
+    for i in xrange(0, len(summaries), _BATCH_SIZE):
+        cls.objects.bulk_create(summaries[i:i + _BATCH_SIZE])
+
+def _rebuild_target(args):
+    # Rebuilds all the levels for one target, in one transaction that
+    # also records the checkpoint; returns (target_id, number of values).
+    # This runs in the worker processes.
+    target_id, ends = args
+    n_values = 0
+    with transaction.commit_on_success():
+        for cls in _SUMMARY_LEVELS:
+            cls.objects.filter(target=target_id).delete()
+
+        metric_ids = Value.objects.filter(target=target_id) \
+                                  .values_list('metric', flat=True).order_by('metric').distinct()
+        for metric_id in metric_ids:
+            # In the order Summary._do_summarize() adds them up
+            qs = Value.filter_and_order(Value.objects.filter(target=target_id, metric=metric_id))
+            rows = list(iter_time_value_rows(qs))
+            times = np.array([row[0] for row in rows], dtype=np.int64)
+            values = np.array([row[1] for row in rows], dtype=np.float64)
+            n_values += len(rows)
+            del rows
+
+            levels = _summarize_series(times, values)
+            for cls in _SUMMARY_LEVELS:
+                _save_level(cls, target_id, metric_id, levels[cls], ends[cls.level])
+
+        RebuildCheckpoint(target_id=target_id).save()
+
+    return target_id, n_values
+
+def _init_worker():
+    # Each worker needs its own connection rather than the one inherited
+    # from the parent process
+    connection.close()
+
+def rebuild_summaries(processes=1, resume=False, verbose=False):
+    # Replaces all the saved summaries with ones computed from the values.
+    # As with resummarize(), when uploads don't update the summaries, only
+    # summaries ending 6 hours before now are saved.
+    #
+    # Targets are independent, so they're shared out among the given
+    # number of worker processes. Each finished target is checkpointed;
+    # with resume, an interrupted rebuild carries on with the targets not
+    # yet done.
+    if settings.INCREMENTAL_SUMMARIES:
+        ends = dict((cls.level, None) for cls in _SUMMARY_LEVELS)
+    else:
+        cutoff = timezone.now() - timedelta(hours=6)
+        ends = dict((cls.level, unix_time(cls.time_truncate(cutoff))) for cls in _SUMMARY_LEVELS)
+
+    with transaction.commit_on_success():
+        if not resume:
+            for cls in _SUMMARY_LEVELS:
+                cls.objects.all().delete()
+            DirtySummary.objects.all().delete()
+            RebuildCheckpoint.objects.all().delete()
+            # Until the rebuild is done, the end comes from the tables
+            SummaryEnd.objects.all().delete()
+        else:
+            # The workers only replace the summaries of targets with
+            # values, so those of targets without values any more have to
+            # go here. This has to be done before starting rather than
+            # after, since with INCREMENTAL_SUMMARIES uploads during the
+            # rebuild can add summaries for targets that had no values
+            for cls in _SUMMARY_LEVELS:
+                cls.objects.exclude(target__in=Value.objects.values('target')).delete()
+
+    done = set(RebuildCheckpoint.objects.values_list('target', flat=True))
+    target_ids = [target_id
+                  for target_id in Value.objects.values_list('target', flat=True).order_by('target').distinct()
+                  if target_id not in done]
+    target_names = dict(Target.objects.values_list('id', 'name'))
+
+    if processes > 1:
+        # Don't let the workers inherit the open connection
+        connection.close()
+        pool = multiprocessing.Pool(processes, initializer=_init_worker)
+        results = pool.imap_unordered(_rebuild_target, [(target_id, ends) for target_id in target_ids])
+    else:
+        pool = None
+        results = (_rebuild_target((target_id, ends)) for target_id in target_ids)
+
+    try:
+        for i, (target_id, n_values) in enumerate(results):
+            if verbose:
+                print "Rebuilt %s, %d values (%d/%d)" % (target_names.get(target_id, target_id), n_values,
+                                                         len(done) + i + 1, len(done) + len(target_ids))
+    except:
+        # Don't wait for the other workers to finish their targets
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    with transaction.commit_on_success():
+        RebuildCheckpoint.objects.all().delete()
+        for cls in _SUMMARY_LEVELS:
+            cls.store_summary_end()
+
+    bump_data_version()
+    ValuesGeneration.objects.update(generation=F('generation') + 1)
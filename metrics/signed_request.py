@@ -1,13 +1,17 @@
 import hashlib
 import base64
+import os
 import re
 import urllib
 
-from M2Crypto import RSA
+from M2Crypto import BIO, RSA
 
 class BadSignature(Exception):
     pass
 
+class BodyTooLarge(Exception):
+    pass
+
 def _dequote(str):
     m = re.match(r'^\"((?:\\.|[^\"\\])+)\"$', str)
     if m is not None:
@@ -15,6 +19,32 @@ def _dequote(str):
     else:
         return str
 
+# Parsed public keys, keyed by machine name. Keys are loaded from
+# <key_dir>/<machine>.pubkey, and reloaded when the file's mtime changes
+class PublicKeyRegistry(object):
+    def __init__(self, key_dir):
+        self.key_dir = key_dir
+        self._keys = {}
+
+    def get(self, machine_name):
+        path = os.path.join(self.key_dir, machine_name + '.pubkey')
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError, e:
+            raise BadSignature("No public key for machine '%s'" % machine_name)
+
+        cached = self._keys.get(machine_name, None)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        try:
+            pub = RSA.load_pub_key(path)
+        except (RSA.RSAError, BIO.BIOError), e:
+            raise BadSignature("Can't load public key for machine '%s'" % machine_name)
+
+        self._keys[machine_name] = (mtime, pub)
+        return pub
+
 # This defines a method of signing an HTTP request using an RSA
 # public/private key pair. This is vaguely inspired by OAuth 1.0 signed requests
 # but, among other things:
@@ -25,7 +55,9 @@ def _dequote(str):
 #  * We don't include the Authorization: header in the signature
 #  * We use SHA256 rather than SHA1
 #
-def check_signature(request, public_key_file):
+# Returns the sent signature and a digest that has been fed everything
+# but the body
+def _start_signature_check(request):
     if not 'HTTP_X_GNOME_PERF_SIGNATURE' in request.META:
         raise BadSignature("X-GNOME-Perf-Signature header missing")
 
@@ -58,10 +90,53 @@ def check_signature(request, public_key_file):
 
     d = hashlib.sha256()
     d.update(signature_data)
-    d.update(request.raw_post_data)
 
-    pub = RSA.load_pub_key(public_key_file)
+    return sent_signature, d
+
+def _finish_signature_check(sent_signature, d, public_key):
     try:
-        pub.verify(d.digest(), sent_signature, 'sha256')
+        if not public_key.verify(d.digest(), sent_signature, 'sha256'):
+            raise BadSignature("Signature doesn't match")
     except RSA.RSAError, e:
         raise BadSignature(e.message)
+
+# A file-like object that reads the body of a signed request, computing
+# the digest as it goes, so that the body never has to be held in memory
+# just for the signature check. verify() must be called once the caller
+# is done with the body and before it trusts anything read; the request
+# body can't be accessed in any other way. If max_bytes is given, reading
+# more of the body than that raises BodyTooLarge, whatever the request
+# claimed its length was.
+class SignedBodyReader(object):
+    def __init__(self, request, public_key, max_bytes=None):
+        self._sent_signature, self._digest = _start_signature_check(request)
+        self._request = request
+        self._public_key = public_key
+        self._max_bytes = max_bytes
+        self._bytes_read = 0
+
+    def read(self, size=-1):
+        if self._max_bytes is not None:
+            # Reading a byte past the limit tells us the body is over it
+            limit = self._max_bytes + 1 - self._bytes_read
+            if size < 0 or size > limit:
+                size = limit
+
+        if size < 0:
+            buf = self._request.read()
+        else:
+            buf = self._request.read(size)
+
+        self._bytes_read += len(buf)
+        if self._max_bytes is not None and self._bytes_read > self._max_bytes:
+            raise BodyTooLarge("Body is larger than %d bytes" % self._max_bytes)
+
+        self._digest.update(buf)
+        return buf
+
+    def verify(self):
+        # Anything the caller didn't read still has to be hashed
+        while self.read(32*1024) != '':
+            pass
+
+        _finish_signature_check(self._sent_signature, self._digest, self._public_key)
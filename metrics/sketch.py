@@ -0,0 +1,112 @@
+import math
+
+# Histogram with logarithmically sized buckets, for estimating quantiles
+# of the values summarized in a bucket of time. Each bucket covers values
+# within RELATIVE_ACCURACY of each other, so any quantile is estimated to
+# within that relative error; and since the bucket boundaries are fixed,
+# two histograms are merged by adding up their counts.
+#
+# Histograms are stored in the database as text: comma-separated
+# <bucket>:<count>, where the bucket is prefixed with '+' for positive
+# values and '-' for negative values, or is '0' for zeros.
+
+RELATIVE_ACCURACY = 0.01
+
+_GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+# Bucket index i covers magnitudes in (gamma^(i-1), gamma^i]
+LOG_GAMMA = math.log(_GAMMA)
+
+def bucket_key(value):
+    # The (sign, index) of the bucket value goes into, sign being 1, -1, or
+    # 0 for zero; or None for NaN
+    if value > 0:
+        return (1, int(math.ceil(math.log(value) / LOG_GAMMA)))
+    elif value < 0:
+        return (-1, int(math.ceil(math.log(-value) / LOG_GAMMA)))
+    elif value == 0:
+        return (0, 0)
+    else:
+        return None
+
+class LogHistogram(object):
+    def __init__(self):
+        # bucket_key() => count
+        self.counts = {}
+        self.total = 0
+
+    def add(self, value, count=1):
+        key = bucket_key(value)
+        if key is None:
+            return
+        self.counts[key] = self.counts.get(key, 0) + count
+        self.total += count
+
+    def merge(self, other):
+        for key, count in other.counts.iteritems():
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.total += other.total
+
+    @staticmethod
+    def _bucket_value(key):
+        # The value the bucket stands for, within RELATIVE_ACCURACY of any
+        # value in it
+        sign, index = key
+        if sign == 0:
+            return 0.
+        return sign * 2 * _GAMMA ** index / (_GAMMA + 1)
+
+    @staticmethod
+    def _order(key):
+        sign, index = key
+        return (sign, sign * index)
+
+    def quantile(self, q):
+        # Returns the estimated q-quantile, or None if the histogram is empty
+        if self.total == 0:
+            return None
+
+        rank = q * (self.total - 1)
+        seen = 0
+        for key in sorted(self.counts, key=self._order):
+            seen += self.counts[key]
+            if seen > rank:
+                return self._bucket_value(key)
+
+        return self._bucket_value(max(self.counts, key=self._order))
+
+    def encode(self):
+        parts = []
+        for key in sorted(self.counts, key=self._order):
+            sign, index = key
+            if sign == 0:
+                parts.append('0:%d' % self.counts[key])
+            else:
+                parts.append('%s%d:%d' % ('+' if sign > 0 else '-', index, self.counts[key]))
+        return ','.join(parts)
+
+    @classmethod
+    def decode(cls, text):
+        histogram = cls()
+        if text == '':
+            return histogram
+
+        for part in text.split(','):
+            bucket, count = part.split(':')
+            count = int(count)
+            if bucket == '0':
+                key = (0, 0)
+            elif bucket[0] == '+':
+                key = (1, int(bucket[1:]))
+            else:
+                key = (-1, int(bucket[1:]))
+            histogram.counts[key] = histogram.counts.get(key, 0) + count
+            histogram.total += count
+
+        return histogram
+
+def stddev(count, avg_value, sum_squares):
+    # Standard deviation of count values from their average and sum of
+    # squares, or None if the sum of squares isn't known
+    if sum_squares is None or count == 0:
+        return None
+    return math.sqrt(max(sum_squares / count - avg_value * avg_value, 0.))
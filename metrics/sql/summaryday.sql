@@ -0,0 +1 @@
+CREATE UNIQUE INDEX metrics_summaryday_target_metric_time ON metrics_summaryday (target_id, metric_id, time);
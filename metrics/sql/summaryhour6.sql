@@ -0,0 +1 @@
+CREATE UNIQUE INDEX metrics_summaryhour6_target_metric_time ON metrics_summaryhour6 (target_id, metric_id, time);
@@ -0,0 +1 @@
+CREATE UNIQUE INDEX metrics_summarymonth_target_metric_time ON metrics_summarymonth (target_id, metric_id, time);
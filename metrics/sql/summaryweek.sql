@@ -0,0 +1 @@
+CREATE UNIQUE INDEX metrics_summaryweek_target_metric_time ON metrics_summaryweek (target_id, metric_id, time);
@@ -0,0 +1 @@
+CREATE INDEX metrics_value_metric_target_time ON metrics_value (metric_id, target_id, pull_time);
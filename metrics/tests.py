@@ -1,16 +1,1069 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+import base64
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+import gzip
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import urllib
 
-Replace this with more appropriate tests for your application.
-"""
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, DatabaseError, IntegrityError
+from django.http import HttpResponse
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone, unittest
 
-from django.test import TestCase
+from M2Crypto import RSA
 
+from metrics import views, rebuild
+from metrics.downsample import lttb
+from metrics.jsonstream import JSONStreamReader
+from metrics.logs import iter_log_records, format_record, iter_rendered_log, log_path, LogWriter
+from metrics.management.commands import upgradedb
+from metrics.models import *
+from metrics.models import _SUMMARY_LEVELS, _epoch_sql, _unsaved_summaries
+from metrics.signed_request import BadSignature, PublicKeyRegistry, BodyTooLarge, SignedBodyReader
+from metrics.sketch import LogHistogram, RELATIVE_ACCURACY
+from metrics.views import upload_batch, upload, _compressed_file_response, _write_log, ParsedReport
+from metrics.views import log, values, ValuesQuery, _resolve_auto_group
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+# Shared fixtures
+
+def _create_target(machine='machine', testset='testset'):
+    # A target that isn't in the configuration
+    return Target.objects.create(name='%s/partition/tree/%s' % (machine, testset), machine=machine,
+                                 partition='partition', tree='tree', testset=testset)
+
+def _create_values(target, metrics, start, count, step):
+    # Creates a report every step from start, with a random value for each
+    # metric; returns the reports
+    rng = random.Random(42)
+    reports = []
+    for i in xrange(count):
+        pull_time = start + i * step
+        report = Report.objects.create(target=target, revision='%040x' % i, pull_time=pull_time, error='')
+        for metric in metrics:
+            Value.objects.create(report=report, metric=metric, target=target, pull_time=pull_time,
+                                 value=rng.choice([0., rng.uniform(-5, 5), rng.lognormvariate(0, 3)]))
+        reports.append(report)
+    return reports
+
+def _value_tuples(reports):
+    # The values of reports, as update_summaries() takes them
+    return [(report.target_id, value.metric_id, report.pull_time, value.value)
+            for report in reports for value in report.value_set.order_by('id')]
+
+def _summary_rows(cls):
+    return list(cls.objects.order_by('target', 'metric', 'time')
+                           .values_list('target', 'metric', 'time', 'min_value', 'max_value', 'avg_value',
+                                        'count', 'sum_squares', 'histogram'))
+
+def _quietly(func, *args, **kwargs):
+    # Calls func, throwing away what it prints
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        sys.stdout = stdout
+
+# Uploads
+
+_TARGET_NAME = 'tartini/ext4-ssd/buildmaster-x86_64/x11'
+
+def _report_data(i, error=None, log=None):
+    # A report for the target in the configuration
+    data = {
+        'machine': 'tartini',
+        'partition': 'ext4-ssd',
+        'tree': 'gnome-continuous/buildmaster/x86_64-runtime',
+        'testset': 'x11',
+        'revision': '%064x' % i,
+        'pullTime': (datetime(2014, 1, 1) + timedelta(hours=i)).strftime('%Y-%m-%d %H:%M:%S')
+    }
+    if error is not None:
+        data['error'] = error
+        data['log'] = log
+    else:
+        data['metrics'] = [{'name': 'timeToDesktop', 'value': i * 1000.},
+                           {'name': 'geditStartTime', 'value': i * 10.}]
+    return data
+
+class _FakeKeyRegistry(object):
+    def __init__(self, key):
+        self.key = key
+
+    def get(self, machine_name):
+        return self.key
+
+def _signed_post(key, path, body):
+    d = hashlib.sha256('POST&' + urllib.quote('http://testserver' + path, '~') + '&&' + body)
+    signature = base64.b64encode(key.sign(d.digest(), 'sha256'))
+    return RequestFactory().post(path, body, content_type='application/json',
+                                 HTTP_X_GNOME_PERF_SIGNATURE='RSA-SHA256 ' + signature)
+
+# A TransactionTestCase, to see what's rolled back
+class BatchUploadTest(TransactionTestCase):
+    def setUp(self):
+        self.log_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(LOG_ROOT=self.log_root)
+        self.settings_override.enable()
+        self.key = RSA.gen_key(1024, 65537, callback=lambda *args: None)
+        self.public_keys = views._public_keys
+        views._public_keys = _FakeKeyRegistry(self.key)
+
+    def tearDown(self):
+        views._public_keys = self.public_keys
+        self.settings_override.disable()
+        shutil.rmtree(self.log_root)
+
+    def _upload_batch(self, reports):
+        return upload_batch(_signed_post(self.key, '/api/upload_batch?machine=tartini', json.dumps(reports)))
+
+    def test_upload_batch(self):
+        log = [{'MESSAGE': 'failed', 'PRIORITY': '3'}]
+        reports = [_report_data(0), _report_data(1), _report_data(2, error='failed', log=log),
+                   # The same report twice gets two rows
+                   _report_data(3), _report_data(3),
+                   dict(_report_data(4), revision='bad')]
+        response = self._upload_batch(reports)
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)['results']
+        self.assertEqual([r['status'] for r in results], ['ok'] * 5 + ['error'])
+
+        stored = list(Report.objects.order_by('id'))
+        self.assertEqual([r.revision for r in stored], [r['revision'] for r in reports[:5]])
+        for report, data in zip(stored, reports):
+            # Each report got its own values
+            self.assertEqual(sorted(report.value_set.values_list('metric__name', 'value')),
+                             sorted((m['name'], m['value']) for m in data.get('metrics', [])))
+        self.assertEqual(stored[2].error, 'failed')
+        self.assertEqual(list(iter_log_records(_TARGET_NAME, stored[2].pull_time, stored[2].revision)), log)
+        self.assertEqual(TargetStatus.objects.get().last_error_report_id, stored[2].id)
+
+    def test_store_failure(self):
+        # If storing fails, nothing is stored, the logs written are removed
+        # again, and each report says so
+        bulk_create = views._bulk_create
+        def fail_values(cls, objs):
+            if cls is Value:
+                raise DatabaseError("failed")
+            bulk_create(cls, objs)
+        views._bulk_create = fail_values
+        try:
+            response = self._upload_batch([_report_data(0),
+                                           _report_data(1, error='failed', log=[{'MESSAGE': 'm'}]),
+                                           dict(_report_data(2), revision='bad')])
+        finally:
+            views._bulk_create = bulk_create
+
+        self.assertEqual(response.status_code, 500)
+        results = json.loads(response.content)['results']
+        self.assertEqual([r['status'] for r in results], ['error'] * 3)
+        self.assertTrue('failed' in results[0]['error'])
+        self.assertEqual(Report.objects.count(), 0)
+        self.assertEqual([files for _, _, files in os.walk(self.log_root) if files], [])
+
+    def test_rollback_removes_logs(self):
+        def fail(values):
+            raise RuntimeError("failed")
+        mark_dirty_summaries = views.mark_dirty_summaries
+        views.mark_dirty_summaries = fail
+        try:
+            with self.settings(INCREMENTAL_SUMMARIES=False):
+                self.assertRaises(RuntimeError, self._upload_batch,
+                                  [_report_data(0), _report_data(1, error='failed', log=[{'MESSAGE': 'm'}])])
+        finally:
+            views.mark_dirty_summaries = mark_dirty_summaries
+
+        self.assertEqual(Report.objects.count(), 0)
+        self.assertEqual([files for _, _, files in os.walk(self.log_root) if files], [])
+
+# Summaries
+
+@override_settings(INCREMENTAL_SUMMARIES=True)
+class IncrementalSummaryTest(TestCase):
+    def setUp(self):
+        self.target = _create_target()
+        self.metric = Metric.objects.create(name='metric')
+        self.start = datetime(2014, 1, 1, tzinfo=timezone.utc)
+
+    def _create_reports(self, start_index, count):
+        return _create_values(self.target, [self.metric], self.start + start_index * timedelta(hours=1),
+                              count, timedelta(hours=1))
+
+    def test_matches_summarize(self):
+        # Uploads in batches, not in order of time, end up with the same
+        # summaries as summarizing all the values at once, up to rounding
+        for start_index, count, step in ((100, 60, 5), (0, 30, 31), (53, 40, 3)):
+            reports = _create_values(self.target, [self.metric], self.start + timedelta(hours=start_index),
+                                     count, timedelta(hours=step))
+            update_summaries(_value_tuples(reports))
+
+        updated = dict((cls, _summary_rows(cls)) for cls in _SUMMARY_LEVELS)
+        for cls in _SUMMARY_LEVELS:
+            cls.objects.all().delete()
+        for cls in _SUMMARY_LEVELS:
+            cls._do_summarize(start=None, end=None)
+
+        for cls in _SUMMARY_LEVELS:
+            expected = _summary_rows(cls)
+            self.assertTrue(len(expected) > 1)
+            self.assertEqual(len(updated[cls]), len(expected))
+            for row, expected_row in zip(updated[cls], expected):
+                for i, (value, expected_value) in enumerate(zip(row, expected_row)):
+                    # The average and the sum of squares are added up in
+                    # a different order, so only agree up to rounding
+                    if i in (5, 7):
+                        self.assertTrue(abs(value - expected_value) <= 1e-9 * max(1., abs(expected_value)))
+                    else:
+                        self.assertEqual(value, expected_value)
+
+    def test_new_bucket_includes_earlier_values(self):
+        # Values stored before uploads updated the summaries are counted
+        # when an upload creates their bucket
+        self._create_reports(0, 3)
+        update_summaries(_value_tuples(self._create_reports(3, 2)))
+
+        for cls in _SUMMARY_LEVELS:
+            summary = cls.objects.get()
+            self.assertEqual(summary.count, 5)
+            self.assertEqual(summary.min_value, min(Value.objects.values_list('value', flat=True)))
+            self.assertEqual(summary.max_value, max(Value.objects.values_list('value', flat=True)))
+            self.assertEqual(LogHistogram.decode(summary.histogram).total, 5)
+
+        # Later uploads merge into the bucket
+        update_summaries(_value_tuples(self._create_reports(5, 1)))
+        for cls in _SUMMARY_LEVELS:
+            self.assertEqual(cls.objects.get().count, 6)
+
+    def test_concurrent_create(self):
+        # If another upload creates the bucket between our looking for it
+        # and creating it, we merge into its row instead
+        reports = self._create_reports(0, 2)
+        summary_from_values = SummaryDay.summary_from_values
+        def create_concurrently(target_id, metric_id, time):
+            other = summary_from_values(target_id, metric_id, time)
+            other.save()
+            return summary_from_values(target_id, metric_id, time)
+
+        SummaryDay.summary_from_values = staticmethod(create_concurrently)
+        try:
+            SummaryDay.add_values(_value_tuples(reports[1:]))
+        finally:
+            SummaryDay.summary_from_values = summary_from_values
+
+        # The other upload's row already had both values, and we added ours
+        self.assertEqual(SummaryDay.objects.get().count, 3)
+
+class UpgradeDbTest(TransactionTestCase):
+    # upgradedb changes the schema, which commits on SQLite
+
+    def setUp(self):
+        self.target = _create_target()
+        self.metric = Metric.objects.create(name='metric')
+        self.start = datetime(2014, 1, 1, tzinfo=timezone.utc)
+
+    def _upgradedb(self):
+        _quietly(upgradedb.Command().handle, batch_size=100)
+
+    def test_create_indexes(self):
+        cursor = connection.cursor()
+        cursor.execute("DROP INDEX metrics_summaryday_target_metric_time")
+        self._upgradedb()
+        # Already there is fine
+        self._upgradedb()
+        SummaryDay.objects.create(target=self.target, metric=self.metric, time=self.start,
+                                  min_value=0., max_value=0., avg_value=0., count=1)
+        self.assertRaises(IntegrityError,
+                          SummaryDay.objects.create, target=self.target, metric=self.metric, time=self.start,
+                          min_value=0., max_value=0., avg_value=0., count=1)
+
+        # Other failures are reported
+        cursor.execute("DROP INDEX metrics_summaryday_target_metric_time")
+        SummaryDay.objects.create(target=self.target, metric=self.metric, time=self.start,
+                                  min_value=0., max_value=0., avg_value=0., count=1)
+        self.assertRaises(CommandError, self._upgradedb)
+
+    def test_save_pending_summaries(self):
+        # Turning INCREMENTAL_SUMMARIES on, upgradedb saves the summaries
+        # that hadn't been saved yet
+        _create_values(self.target, [self.metric], self.start, 40, timedelta(hours=5))
+        with self.settings(INCREMENTAL_SUMMARIES=False):
+            for cls in _SUMMARY_LEVELS:
+                cls.save_summaries(self.start + timedelta(days=4))
+        saved_count = SummaryHour6.objects.count()
+
+        with self.settings(INCREMENTAL_SUMMARIES=True):
+            self._upgradedb()
+        self.assertTrue(SummaryHour6.objects.count() > saved_count)
+
+        # The same as summarizing everything at once
+        upgraded = dict((cls, _summary_rows(cls)) for cls in _SUMMARY_LEVELS)
+        for cls in _SUMMARY_LEVELS:
+            cls.objects.all().delete()
+        for cls in _SUMMARY_LEVELS:
+            cls._do_summarize(start=None, end=None)
+            self.assertEqual(_summary_rows(cls), upgraded[cls])
+
+class SummaryEndTest(TestCase):
+    def setUp(self):
+        self.target = _create_target()
+        self.metric = Metric.objects.create(name='metric')
+        self.start = datetime(2014, 1, 1, tzinfo=timezone.utc)
+        _create_values(self.target, [self.metric], self.start, 100, timedelta(hours=5))
+
+    def _check_ends(self):
+        for cls in _SUMMARY_LEVELS:
+            self.assertEqual(SummaryEnd.objects.get(level=cls.level).time, cls._max_summary_end())
+
+    @override_settings(INCREMENTAL_SUMMARIES=False)
+    def test_mark_dirty(self):
+        resummarize()
+        self._check_ends()
+
+        # A late value only needs the stored ends, not the summary tables
+        time = self.start + timedelta(hours=1)
+        connection.use_debug_cursor = True
+        try:
+            n_queries = len(connection.queries)
+            mark_dirty_summaries([(self.target.id, self.metric.id, time, 1.)])
+            queries = [q['sql'] for q in connection.queries[n_queries:]]
+        finally:
+            connection.use_debug_cursor = False
+        self.assertFalse([sql for sql in queries if 'MAX(' in sql])
+        self.assertEqual(sorted(DirtySummary.objects.values_list('level', flat=True)),
+                         sorted(cls.level for cls in _SUMMARY_LEVELS))
+
+    @override_settings(INCREMENTAL_SUMMARIES=True)
+    def test_incremental(self):
+        resummarize()
+        # New buckets past the end extend it
+        reports = _create_values(self.target, [self.metric], self.start + timedelta(days=100),
+                                 1, timedelta(hours=1))
+        update_summaries(_value_tuples(reports))
+        self._check_ends()
+
+# Signed uploads
+
+class PublicKeyRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.key_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.key_dir, 'machine.pubkey')
+
+    def tearDown(self):
+        shutil.rmtree(self.key_dir)
+
+    def _write_key(self, mtime):
+        key = RSA.gen_key(1024, 65537, callback=lambda *args: None)
+        key.save_pub_key(self.path)
+        os.utime(self.path, (mtime, mtime))
+        return key
+
+    def test_reload(self):
+        registry = PublicKeyRegistry(self.key_dir)
+        now = time.time()
+        first = self._write_key(now - 10)
+        self.assertEqual(registry.get('machine').pub(), first.pub())
+        # The parsed key is kept while the file doesn't change
+        self.assertTrue(registry.get('machine') is registry.get('machine'))
+
+        second = self._write_key(now)
+        self.assertEqual(registry.get('machine').pub(), second.pub())
+
+        os.remove(self.path)
+        self.assertRaises(BadSignature, registry.get, 'machine')
+
+class UploadTest(TestCase):
+    def setUp(self):
+        self.log_root = tempfile.mkdtemp()
+        self.body = json.dumps({'error': 'failed', 'log': [{'MESSAGE': 'm'}]})
+
+    def tearDown(self):
+        shutil.rmtree(self.log_root)
+
+    def _request(self, **extra):
+        return RequestFactory().post('/api/upload?machine=tartini', self.body,
+                                     content_type='application/json', **extra)
+
+    def _upload(self, **extra):
+        with self.settings(LOG_ROOT=self.log_root):
+            return upload(self._request(**extra))
+
+    def test_too_large(self):
+        with self.settings(UPLOAD_MAX_BYTES=len(self.body) - 1):
+            self.assertEqual(self._upload().status_code, 413)
+
+    def test_too_large_body(self):
+        # The limit applies to what is read, whatever the Content-Length says
+        request = self._request(HTTP_X_GNOME_PERF_SIGNATURE='RSA-SHA256 ' + base64.b64encode('x' * 128))
+        request.read = StringIO(self.body).read
+        reader = SignedBodyReader(request, None, max_bytes=len(self.body) - 1)
+        self.assertRaises(BodyTooLarge, reader.read)
+
+        request.read = StringIO(self.body).read
+        reader = SignedBodyReader(request, None, max_bytes=len(self.body))
+        self.assertEqual(reader.read(), self.body)
+
+    def test_bad_signature(self):
+        # Nothing is written to LOG_ROOT for a body that isn't signed
+        writer_init = LogWriter.__init__
+        def fail_init(writer):
+            self.fail("LogWriter created")
+        LogWriter.__init__ = fail_init
+        try:
+            response = self._upload(HTTP_X_GNOME_PERF_SIGNATURE='RSA-SHA256 ' + base64.b64encode('x' * 256))
+        finally:
+            LogWriter.__init__ = writer_init
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(os.listdir(self.log_root), [])
+
+class JSONStreamTest(unittest.TestCase):
+    def _reader(self, data, chunk_size=3):
+        return JSONStreamReader(StringIO(data), chunk_size=chunk_size)
+
+    def test_stream(self):
+        data = {'a': [1, 2.5e10, -3, {'b': None}], 'c': u'\u00e9t\u00e9', 'd': 12345678901234567890, 'e': []}
+        text = json.dumps(data, sort_keys=True)
+        for encoding in ('utf-8', 'utf-16-le', 'utf-16', 'utf-32-be'):
+            stream = self._reader(text.encode(encoding))
+            result = {}
+            for key in stream.iter_object():
+                if key in ('a', 'e'):
+                    result[key] = list(stream.iter_array())
+                else:
+                    result[key] = stream.read_value()
+            stream.end()
+            self.assertEqual(result, data)
+
+    def test_errors(self):
+        def parse(text):
+            stream = self._reader(text)
+            for item in stream.iter_array():
+                pass
+            stream.end()
+        for text in ('[1, 2', '[1 2]', '[1] 2', '{"a": 1}', '[{"a" 1}]', ''):
+            self.assertRaises(ValueError, parse, text)
+
+    def test_empty(self):
+        stream = self._reader(' { } ')
+        self.assertEqual(list(stream.iter_object()), [])
+        stream.end()
+
+# Logs
+
+class LogViewTest(TestCase):
+    def setUp(self):
+        self.log_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(LOG_ROOT=self.log_root)
+        self.settings_override.enable()
+
+        target = Target.objects.create(name=_TARGET_NAME, machine='tartini', partition='ext4-ssd',
+                                       tree='gnome-continuous/buildmaster/x86_64-runtime', testset='x11')
+        self.report = Report.objects.create(target=target, revision='%064x' % 0,
+                                            pull_time=datetime(2014, 1, 1, tzinfo=timezone.utc), error='failed')
+        self.records = [{'MESSAGE': 'message %d' % i, 'PRIORITY': '6'} for i in xrange(10)]
+        writer = LogWriter()
+        for record in self.records:
+            writer.write_record(record)
+        self.path = log_path(_TARGET_NAME, self.report.pull_time, self.report.revision)
+        writer.commit(self.path)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.log_root)
+
+    def _get(self, format, **extra):
+        request = RequestFactory().get('/log', **extra)
+        return log(request, 'tartini', 'ext4-ssd', 'buildmaster-x86_64', 'x11', str(self.report.id), format)
+
+    def test_gzip_passthrough(self):
+        response = self._get('json', HTTP_ACCEPT_ENCODING='deflate, gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        with open(self.path, 'rb') as f:
+            self.assertEqual(''.join(response), f.read())
+
+        # Refused with q=0, or not asked for
+        for accept_encoding in ('gzip;q=0, deflate', ''):
+            response = self._get('json', HTTP_ACCEPT_ENCODING=accept_encoding)
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertEqual(json.loads(''.join(response)), self.records)
+            self.assertTrue('Accept-Encoding' in response['Vary'])
+
+    @override_settings(LOG_SENDFILE_HEADER='X-Accel-Redirect', LOG_SENDFILE_ROOT='/logs')
+    def test_missing_file_sendfile(self):
+        # log() falls back to rendering the log on IOError, whichever way
+        # the file would be served
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip')
+        path = os.path.join(settings.LOG_ROOT, 'no-such-log.txt.gz')
+        self.assertRaises(IOError, _compressed_file_response, request, path, 'text/plain')
+
+class RenderLogTest(unittest.TestCase):
+    def test_streamed(self):
+        # Records are rendered as they are read, and handed on in chunks
+        records = [{'MESSAGE': 'message %d' % i, 'PRIORITY': str(i % 8), '_COMM': 'test',
+                    '_SOURCE_REALTIME_TIMESTAMP': str(1388534400000000 + i * 1000000)}
+                   for i in xrange(5000)]
+        for format in ('txt', 'html'):
+            chunks = list(iter_rendered_log(StringIO(json.dumps(records)), format, 'title'))
+            self.assertTrue(len(chunks) > 1)
+
+            out = []
+            for record in records:
+                format_record(record, format, out)
+            rendered = u''.join(out).encode('UTF-8')
+            if format == 'txt':
+                self.assertEqual(''.join(chunks), rendered)
+            else:
+                self.assertTrue(chunks[0].startswith('<!DOCTYPE html>'))
+                self.assertTrue(rendered in ''.join(chunks))
+                self.assertTrue(chunks[-1].endswith('</html>'))
+
+class LogWriterTest(TestCase):
+    def setUp(self):
+        self.log_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(LOG_ROOT=self.log_root)
+        self.settings_override.enable()
+        self.pull_time = datetime(2014, 1, 1, tzinfo=timezone.utc)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.log_root)
+
+    def _write(self, records):
+        writer = LogWriter()
+        for record in records:
+            writer.write_record(record)
+        writer.commit(log_path('target', self.pull_time, 'revision'))
+
+    def _read(self, **selection):
+        return list(iter_log_records('target', self.pull_time, 'revision', **selection))
+
+    def test_malformed_records(self):
+        records = [
+            ['not', 'an', 'object'],
+            'string',
+            {'__CURSOR': 's=1;t=xyz', 'MESSAGE': 'bad cursor'},
+            {'__CURSOR': 't=' + 'f' * 20, 'MESSAGE': 'time too big'},
+            {'_SOURCE_REALTIME_TIMESTAMP': [], 'SYSLOG_IDENTIFIER': ['x'], 'MESSAGE': 'bad fields'},
+            {'SYSLOG_IDENTIFIER': 'good', 'PRIORITY': '3', 'MESSAGE': 'good'},
+        ]
+        self._write(records)
+        self.assertEqual(self._read(), records)
+        self.assertEqual(self._read(identifier='good'), records[-1:])
+        self.assertEqual(self._read(priority=3), records[-1:])
+
+    def test_many_identifiers(self):
+        records = [{'SYSLOG_IDENTIFIER': 'id%d' % i, 'MESSAGE': 'm'} for i in xrange(70000)]
+        self._write(records)
+        self.assertEqual(self._read(identifier='id69999'), records[-1:])
+
+    def test_batch_log_failure(self):
+        parsed = ParsedReport()
+        parsed.target_name = 'target'
+        parsed.pull_time = self.pull_time
+        parsed.revision = 'revision'
+        parsed.log = [{'MESSAGE': 'm'}, {'MESSAGE': object()}]
+        self.assertRaises(TypeError, _write_log, parsed)
+        self.assertEqual(os.listdir(self.log_root), [])
+
+class PruneLogsTest(TestCase):
+    def setUp(self):
+        self.log_root = tempfile.mkdtemp()
+        self.target_dir = os.path.join(self.log_root, 'machine-partition-tree-testset')
+        os.mkdir(self.target_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.log_root)
+
+    def _create(self, path, age=timedelta(0)):
+        open(path, 'wb').close()
+        mtime = time.time() - age.total_seconds()
+        os.utime(path, (mtime, mtime))
+
+    @override_settings(LOG_RETAIN_COUNT=None, LOG_MAX_AGE_DAYS=None,
+                       LOG_MAX_TARGET_BYTES=None, LOG_MAX_TOTAL_BYTES=None)
+    def test_prunelogs(self):
+        logs = ['2014-01-%02d-00:00:00-%040x.json.gz' % (i + 1, i) for i in xrange(3)]
+        for name in logs:
+            self._create(os.path.join(self.target_dir, name))
+        stale = [os.path.join(self.log_root, '.incoming-abc.json.gz'),
+                 os.path.join(self.target_dir, '.incoming-def.txt.gz')]
+        fresh = [os.path.join(self.log_root, '.incoming-ghi.json.gz'),
+                 os.path.join(self.target_dir, '.incoming-jkl.html.gz')]
+        for path in stale:
+            self._create(path, timedelta(days=2))
+        for path in fresh:
+            self._create(path)
+
+        with self.settings(LOG_ROOT=self.log_root):
+            _quietly(call_command, 'prunelogs')
+
+        # No retention limit keeps every log
+        self.assertEqual(sorted(os.listdir(self.target_dir)), sorted(logs + ['.incoming-jkl.html.gz']))
+        self.assertEqual(sorted(os.listdir(self.log_root)),
+                         ['.incoming-ghi.json.gz', 'machine-partition-tree-testset'])
+
+# Values
+
+def _get_values(params, **extra):
+    response = values(RequestFactory().get('/api/values', params, **extra))
+    return response, ''.join(response)
+
+def _decode_json_values(data):
+    result = json.loads(data)
+    group = result['group']
+    revisions = dict((t['name'], t['revisions']) for t in result.get('targets', []))
+    series = []
+    for metric in result['metrics']:
+        for target in metric['targets']:
+            points = target['values']
+            times = [point['time'] for point in points]
+            if group == 'none':
+                columns = {'value': [point['value'] for point in points],
+                           'revision': [revisions[target['name']][str(time)] for time in times]}
+            else:
+                columns = dict((name, [point[name] for point in points]) for name in views._SUMMARY_COLUMNS)
+            series.append((metric['name'], target['name'], times, columns))
+    return group, series
+
+def _decode_columnar_values(data):
+    result = json.loads(data)
+    series = []
+    for s in result['series']:
+        times = []
+        time = 0
+        for delta in s['times']:
+            time += delta
+            times.append(time)
+        if result['group'] == 'none':
+            columns = {'value': s['values'],
+                       'revision': [result['revisions'][i] for i in s['revisions']]}
+        else:
+            columns = dict((name, s[name]) for name in views._SUMMARY_COLUMNS)
+        series.append((s['metric'], s['target'], times, columns))
+    return result['group'], series
+
+def _decode_binary_values(data):
+    assert data[:4] == 'PWV2'
+
+    def read_block(pos):
+        (length,) = struct.unpack_from('<I', data, pos)
+        assert (pos + 4 + length) % 8 == 0
+        return json.loads(data[pos + 4:pos + 4 + length]), pos + 4 + length
+
+    header, pos = read_block(4)
+    revisions = []
+    series = []
+    while struct.unpack_from('<I', data, pos)[0] != 0:
+        s, pos = read_block(pos)
+        n = s['count']
+        times = list(struct.unpack_from('<%dq' % n, data, pos))
+        pos += 8 * n
+        columns = {}
+        for name in s['columns']:
+            columns[name] = [None if math.isnan(v) else v for v in struct.unpack_from('<%dd' % n, data, pos)]
+            pos += 8 * n
+        if 'revisions' in s:
+            revisions.extend(s['revisions'])
+            columns['revision'] = [revisions[i] for i in struct.unpack_from('<%dI' % n, data, pos)]
+            pos += 4 * n + (-4 * n) % 8
+        series.append((s['metric'], s['target'], times, columns))
+    assert pos + 8 == len(data)
+
+    return header['group'], series
+
+class ValuesFormatTest(TestCase):
+    def setUp(self):
+        targets = [_create_target(testset='testset%d' % i) for i in xrange(2)]
+        metrics = [Metric.objects.create(name='metric%d' % i) for i in xrange(2)]
+        for target in targets:
+            _create_values(target, metrics, datetime(2014, 1, 1, tzinfo=timezone.utc), 60, timedelta(hours=5))
+        save_pending_summaries()
+
+    def _get(self, group, format):
+        response, body = _get_values({'group': group, 'format': format})
+        self.assertEqual(response.status_code, 200)
+        return body
+
+    def test_formats(self):
+        for group in ('none', 'day'):
+            expected = _decode_json_values(self._get(group, 'json'))
+            self.assertEqual(expected[0], group)
+            self.assertEqual(len(expected[1]), 4)
+            self.assertEqual(_decode_columnar_values(self._get(group, 'columnar')), expected)
+            self.assertEqual(_decode_binary_values(self._get(group, 'binary')), expected)
+
+class ValuesResponseTest(TestCase):
+    def test_vary_accept(self):
+        self._check_vary_accept()
+
+    @override_settings(VALUES_CACHE='default')
+    def test_vary_accept_cached(self):
+        # The cache key covers the format picked by the Accept header
+        self._check_vary_accept()
+
+    def _check_vary_accept(self):
+        json_response, _ = _get_values({'group': 'none'})
+        binary_response, _ = _get_values({'group': 'none'}, HTTP_ACCEPT='application/octet-stream')
+        self.assertEqual(json_response['Content-Type'], 'application/json')
+        self.assertEqual(binary_response['Content-Type'], 'application/octet-stream')
+        for response in (json_response, binary_response):
+            self.assertTrue('Accept' in [h.strip() for h in response['Vary'].split(',')])
+
+    @override_settings(VALUES_CACHE='default')
+    def test_cache_size_limit(self):
+        _create_values(_create_target(), [Metric.objects.create(name='metric')],
+                       datetime(2014, 1, 1, tzinfo=timezone.utc), 50, timedelta(hours=1))
+
+        for max_bytes, cached in ((None, True), (100, False)):
+            get_cache('default').clear()
+            with self.settings(VALUES_CACHE_MAX_BYTES=max_bytes):
+                response, body = _get_values({'group': 'none'})
+                self.assertTrue(len(body) > 100)
+                # Cached responses are sent with Vary: Accept-Encoding
+                self.assertFalse(response.has_header('Vary') and 'Accept-Encoding' in response['Vary'])
+                response, cached_body = _get_values({'group': 'none'})
+                self.assertEqual(cached_body, body)
+                self.assertEqual('Accept-Encoding' in response['Vary'], cached)
+
+class ConditionalValuesTest(TestCase):
+    def test_not_modified(self):
+        target = _create_target()
+        _create_values(target, [Metric.objects.create(name='metric')],
+                       datetime(2014, 1, 1, tzinfo=timezone.utc), 5, timedelta(hours=1))
+        bump_data_version([target.id])
+
+        response, body = _get_values({'group': 'none'})
+        self.assertEqual(response.status_code, 200)
+        for extra in ({'HTTP_IF_NONE_MATCH': response['ETag']},
+                      {'HTTP_IF_MODIFIED_SINCE': response['Last-Modified']}):
+            self.assertEqual(_get_values({'group': 'none'}, **extra)[0].status_code, 304)
+
+        # Storing reports for the target changes the ETag
+        bump_data_version([target.id])
+        self.assertEqual(_get_values({'group': 'none'}, HTTP_IF_NONE_MATCH=response['ETag'])[0].status_code, 200)
+
+    def test_summarize_keeps_version(self):
+        # Saving summaries doesn't change the result, so it doesn't change
+        # the ETag either
+        target = _create_target()
+        _create_values(target, [Metric.objects.create(name='metric')],
+                       datetime(2014, 1, 1, tzinfo=timezone.utc), 5, timedelta(hours=1))
+        bump_data_version([target.id])
+        version = get_data_version()
+        with self.settings(INCREMENTAL_SUMMARIES=False):
+            resummarize()
+        self.assertEqual(get_data_version(), version)
+
+class ValuesGenerationTest(TestCase):
+    def test_generations(self):
+        targets = [_create_target(testset='testset%d' % i) for i in xrange(2)]
+        january = datetime(2014, 1, 1, tzinfo=timezone.utc)
+        february = datetime(2014, 2, 1, tzinfo=timezone.utc)
+        bump_values_generations([(targets[0].id, january + timedelta(days=10)),
+                                 (targets[1].id, january + timedelta(days=20))])
+        bump_values_generations([(targets[0].id, february + timedelta(days=10))])
+
+        self.assertEqual(get_values_generations(targets[0].name, None, None), [(january, 1), (february, 1)])
+        self.assertEqual(get_values_generations(targets[1].name, None, None), [(january, 1)])
+        self.assertEqual(get_values_generations(None, None, None), [(january, 2), (february, 1)])
+        self.assertEqual(get_values_generations(None, february, None), [(february, 1)])
+
+@override_settings(INCREMENTAL_SUMMARIES=False)
+class UnsavedSummaryTest(TestCase):
+    def setUp(self):
+        _unsaved_summaries.clear()
+        self.target = _create_target()
+        self.metric = Metric.objects.create(name='metric')
+        self.start = SummaryDay.time_truncate(timezone.now()) - timedelta(days=3)
+        _create_values(self.target, [self.metric], self.start, 20, timedelta(hours=3))
+
+    def _unsaved(self, end):
+        return [summary_row(s) for s in SummaryHour6.get_unsaved_summaries(self.start, end)]
+
+    def test_far_end(self):
+        # The end is clamped to now, and only buckets up to then are
+        # remembered
+        expected = []
+        SummaryHour6._do_summarize(start=self.start, end=None, append_unsaved=expected)
+        expected = [summary_row(s) for s in expected]
+
+        self.assertEqual(self._unsaved(datetime(2100, 1, 1, tzinfo=timezone.utc)), expected)
+        self.assertTrue(len(_unsaved_summaries._entries) <= 4 * 4)
+        # Now from the remembered summaries
+        self.assertEqual(self._unsaved(datetime(2100, 1, 1, tzinfo=timezone.utc)), expected)
+
+class LTTBTest(unittest.TestCase):
+    def test_short(self):
+        points = [(i, i * i) for i in xrange(10)]
+        self.assertEqual(lttb(points, 10), points)
+        self.assertEqual(lttb(points, 2), points)
+
+    def test_downsample(self):
+        rng = random.Random(1)
+        points = [(i, rng.uniform(0, 1), 'r%d' % i) for i in xrange(1000)]
+        points[500] = (500, 100., 'spike')
+        result = lttb(points, 50)
+        self.assertEqual(len(result), 50)
+        self.assertEqual(result[0], points[0])
+        self.assertEqual(result[-1], points[-1])
+        # Only existing points, in order, and the spike survives
+        self.assertEqual(result, sorted(set(result), key=lambda point: point[0]))
+        self.assertTrue(set(result) <= set(points))
+        self.assertTrue((500, 100., 'spike') in result)
+
+    def test_columns(self):
+        # The coordinates can be anywhere in the points
+        points = [('a', 'b', i, (i % 7) * 1.) for i in xrange(100)]
+        xy_result = lttb([(point[2], point[3]) for point in points], 20)
+        self.assertEqual(lttb(points, 20, x=2, y=3), [points[x] for x, y in xy_result])
+
+class AutoGroupTest(TestCase):
+    def test_partial_month(self):
+        _create_values(_create_target(), [Metric.objects.create(name='metric')],
+                       datetime(2014, 1, 1, tzinfo=timezone.utc), 31 * 24, timedelta(hours=1))
+        save_pending_summaries()
+
+        query = ValuesQuery()
+        query.target = None
+        query.metric = None
+        query.group = 'auto'
+        # 3 days of the month's 744 values fit in 100 points
+        query.start = datetime(2014, 1, 1, tzinfo=timezone.utc)
+        query.end = datetime(2014, 1, 4, tzinfo=timezone.utc)
+        query.max_points = 100
+        _resolve_auto_group(query)
+        self.assertEqual(query.group, 'none')
+
+        query.group = 'auto'
+        query.end = datetime(2014, 1, 6, tzinfo=timezone.utc)
+        _resolve_auto_group(query)
+        self.assertEqual(query.group, 'hour6')
+
+class ChunkedValuesTest(TestCase):
+    def test_chunk_boundaries(self):
+        # However the rows are split into chunks, each comes once, in order
+        target = _create_target()
+        metric = Metric.objects.create(name='metric')
+        start = datetime(2014, 1, 1, tzinfo=timezone.utc)
+        _create_values(target, [metric], start, 10, timedelta(hours=1))
+        # Values at the same time, which the chunks tell apart by id
+        _create_values(target, [metric], start + timedelta(hours=3), 3, timedelta(0))
+        save_pending_summaries()
+
+        expected = dict((group, _get_values({'group': group})[1]) for group in ('none', 'hour6'))
+        self.assertEqual(len(json.loads(expected['none'])['metrics'][0]['targets'][0]['values']), 13)
+        chunk_size = views._QUERY_CHUNK_SIZE
+        try:
+            for views._QUERY_CHUNK_SIZE in (1, 2, 3):
+                for group in ('none', 'hour6'):
+                    self.assertEqual(_get_values({'group': group})[1], expected[group])
+        finally:
+            views._QUERY_CHUNK_SIZE = chunk_size
+
+class RowQueryTest(TestCase):
+    def setUp(self):
+        self.target = _create_target()
+        self.metric = Metric.objects.create(name='metric')
+        self.reports = _create_values(self.target, [self.metric],
+                                      datetime(2013, 1, 1, tzinfo=timezone.utc), 7, timedelta(hours=1))
+
+    def test_value_rows(self):
+        qs = Value.objects.order_by('pull_time', 'id')
+        expected = [(self.metric.id, self.target.id, unix_time(value.pull_time), value.value,
+                     value.report.revision, value.id)
+                    for value in qs]
+        self.assertEqual(len(expected), 7)
+        self.assertEqual(list(iter_value_rows(qs)), expected)
+        # Chunks that don't divide the rows evenly, and that do
+        self.assertEqual(list(iter_value_rows(qs, chunk_size=3)), expected)
+        self.assertEqual(list(iter_value_rows(qs, chunk_size=7)), expected)
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', "Not using SQLite")
+    def test_sqlite_epoch(self):
+        # The times are computed by the database, including before 1970
+        self.assertNotEqual(_epoch_sql('pull_time'), None)
+        _create_values(self.target, [self.metric], datetime(1969, 12, 31, 23, 59, 58, tzinfo=timezone.utc),
+                       2, timedelta(seconds=1))
+        qs = Value.objects.order_by('pull_time', 'id')
+        self.assertEqual([row[2] for row in iter_value_rows(qs)], [unix_time(value.pull_time) for value in qs])
+        self.assertEqual([row[0] for row in iter_time_value_rows(qs)][:2], [-2, -1])
+
+    def test_summary_rows(self):
+        resummarize()
+        qs = SummaryHour6.objects.order_by('time', 'id')
+        expected = [summary_row(summary) for summary in qs]
+        self.assertEqual(len(expected), 2)
+        self.assertEqual(list(iter_summary_rows(qs, chunk_size=1)), expected)
+
+class LogHistogramTest(unittest.TestCase):
+    def test_quantiles(self):
+        rng = random.Random(1)
+        values = [rng.lognormvariate(0, 2) * rng.choice([1, -1]) for i in xrange(2000)] + [0.] * 100
+        histogram = LogHistogram()
+        for value in values:
+            histogram.add(value)
+        histogram.add(float('nan'))
+        self.assertEqual(histogram.total, len(values))
+
+        values.sort()
+        for q in (0., 0.1, 0.5, 0.9, 1.):
+            exact = values[int(q * (len(values) - 1))]
+            self.assertTrue(abs(histogram.quantile(q) - exact) <= abs(exact) * RELATIVE_ACCURACY * 1.0001)
+
+    def test_encode_merge(self):
+        a = LogHistogram()
+        b = LogHistogram()
+        both = LogHistogram()
+        for i, value in enumerate([0., 1., -2.5, 1000., 1e-6, 1., -2.5]):
+            (a if i % 2 else b).add(value)
+            both.add(value)
+        self.assertEqual(LogHistogram.decode(a.encode()).counts, a.counts)
+        self.assertEqual(LogHistogram.decode('').total, 0)
+        self.assertEqual(LogHistogram().quantile(0.5), None)
+        a.merge(b)
+        self.assertEqual(a.counts, both.counts)
+        self.assertEqual(a.total, both.total)
+
+class RebuildTest(TestCase):
+    def setUp(self):
+        self.targets = [_create_target(testset='testset%d' % i) for i in xrange(2)]
+        self.metrics = [Metric.objects.create(name='metric%d' % i) for i in xrange(2)]
+        start = datetime(2013, 12, 20, 1, 2, 3, tzinfo=timezone.utc)
+        # 400 reports 5h 17m apart cover hour6 buckets with 0-2 values,
+        # and day, week and month buckets across the end of the year
+        for target in self.targets:
+            _create_values(target, self.metrics, start, 400, timedelta(hours=5, minutes=17))
+
+    @unittest.skipIf(rebuild.np is None, "NumPy isn't installed")
+    @override_settings(INCREMENTAL_SUMMARIES=False)
+    def test_rebuild_matches_resummarize(self):
+        resummarize()
+        expected = dict((cls, _summary_rows(cls)) for cls in _SUMMARY_LEVELS)
+        for cls in _SUMMARY_LEVELS:
+            self.assertTrue(len(expected[cls]) > 0)
+
+        call_command('summarize', rebuild=True, verbosity=0)
+        for cls in _SUMMARY_LEVELS:
+            self.assertEqual(_summary_rows(cls), expected[cls])
+
+    def _target_rows(self, cls, target):
+        return [row for row in _summary_rows(cls) if row[0] == target.id]
+
+    @unittest.skipIf(rebuild.np is None, "NumPy isn't installed")
+    @override_settings(INCREMENTAL_SUMMARIES=False)
+    def test_resume(self):
+        resummarize()
+        expected = dict((cls, _summary_rows(cls)) for cls in _SUMMARY_LEVELS)
+
+        # As if interrupted after the first target: that target is
+        # skipped, so a change to its summaries stays; the second target's
+        # partial summaries are replaced; and the summaries of a target
+        # without values are removed
+        RebuildCheckpoint.objects.create(target=self.targets[0])
+        SummaryDay.objects.filter(target=self.targets[0]).update(count=999)
+        SummaryWeek.objects.filter(target=self.targets[1])[0].delete()
+        SummaryMonth.objects.filter(target=self.targets[1]).update(avg_value=0.)
+        other = _create_target(machine='other')
+        SummaryHour6.objects.create(target=other, metric=self.metrics[0], time=datetime(2014, 1, 1, tzinfo=timezone.utc),
+                                    min_value=1., max_value=1., avg_value=1., count=1)
+
+        rebuild.rebuild_summaries(resume=True)
+        self.assertEqual(set(SummaryDay.objects.filter(target=self.targets[0]).values_list('count', flat=True)),
+                         set([999]))
+        for cls in _SUMMARY_LEVELS:
+            if cls is not SummaryDay:
+                self.assertEqual(_summary_rows(cls), expected[cls])
+            self.assertEqual(self._target_rows(cls, self.targets[1]),
+                             [row for row in expected[cls] if row[0] == self.targets[1].id])
+        self.assertEqual(RebuildCheckpoint.objects.count(), 0)
+
+    @unittest.skipIf(rebuild.np is None, "NumPy isn't installed")
+    @override_settings(INCREMENTAL_SUMMARIES=True)
+    def test_uploads_during_rebuild(self):
+        # With INCREMENTAL_SUMMARIES, a target whose first values arrive
+        # while the rebuild runs keeps the summaries they create
+        other = _create_target(machine='other')
+        rebuild_target = rebuild._rebuild_target
+        def upload_then_rebuild_target(args):
+            if not Value.objects.filter(target=other).exists():
+                reports = _create_values(other, self.metrics[:1], datetime(2014, 2, 1, tzinfo=timezone.utc),
+                                         1, timedelta(hours=1))
+                update_summaries(_value_tuples(reports))
+            return rebuild_target(args)
+
+        rebuild._rebuild_target = upload_then_rebuild_target
+        try:
+            rebuild.rebuild_summaries()
+        finally:
+            rebuild._rebuild_target = rebuild_target
+
+        for cls in _SUMMARY_LEVELS:
+            self.assertEqual(cls.objects.filter(target=other).count(), 1)
+
+class StatusTest(TestCase):
+    def test_update_statuses(self):
+        # Statuses updated upload by upload come out the same as computed
+        # from all the reports at once
+        targets = [_create_target(testset='testset%d' % i) for i in xrange(2)]
+        start = datetime(2014, 1, 1, tzinfo=timezone.utc)
+        def report(target, hours, error=''):
+            return Report.objects.create(target=target, revision='%040x' % hours,
+                                         pull_time=start + timedelta(hours=hours), error=error)
+
+        update_statuses([report(targets[0], 1), report(targets[0], 2, 'failed'), report(targets[1], 3)])
+        update_statuses([report(targets[0], 0), report(targets[0], 4, 'failed'), report(targets[0], 5)])
+
+        status = TargetStatus.objects.get(target=targets[0])
+        self.assertEqual((status.good_count, status.error_count), (3, 2))
+        self.assertEqual((status.first_good_time, status.last_good_time),
+                         (start, start + timedelta(hours=5)))
+        self.assertEqual(status.last_error_time, start + timedelta(hours=4))
+        self.assertEqual((status.last_report_time, status.last_revision),
+                         (start + timedelta(hours=5), '%040x' % 5))
+        machine = MachineStatus.objects.get(machine='machine')
+        self.assertEqual((machine.report_count, machine.last_report_time), (6, start + timedelta(hours=5)))
+
+        def statuses():
+            return (list(TargetStatus.objects.order_by('target').values_list(
+                        'target', 'first_good_time', 'last_good_time', 'last_report_time', 'last_revision',
+                        'last_error_report', 'last_error_time', 'good_count', 'error_count')),
+                    list(MachineStatus.objects.values_list('machine', 'last_report_time', 'report_count')))
+        updated = statuses()
+        refresh_statuses()
+        self.assertEqual(statuses(), updated)
+
+class PageCacheTest(TestCase):
+    @override_settings(PAGE_CACHE='default', PAGE_MAX_AGE=60)
+    def test_cached_page(self):
+        get_cache('default').clear()
+        rendered = []
+        def page(request):
+            rendered.append(request.path)
+            return HttpResponse('page %d' % len(rendered), content_type='text/plain')
+        view = views._cached_page(lambda request: 'etag', lambda request: None)(page)
+
+        factory = RequestFactory()
+        for i in xrange(2):
+            response = view(factory.get('/page'))
+            self.assertEqual(response.content, 'page 1')
+            self.assertEqual(response['Content-Type'], 'text/plain')
+            self.assertEqual(sorted(response['Cache-Control'].split(', ')), ['max-age=60', 'public'])
+        self.assertEqual(rendered, ['/page'])
+
+        response = view(factory.get('/page', HTTP_IF_NONE_MATCH='"etag"'))
+        self.assertEqual(response.status_code, 304)
+        self.assertTrue('max-age=60' in response['Cache-Control'])
@@ -1,44 +1,143 @@
+from array import array
 from datetime import datetime
+from functools import wraps
+import errno
+import gzip
+import hashlib
 import json
+import math
 import os
 import re
+import struct
 import sys
+import tempfile
+import zlib
 
 from django.conf import settings
+from django.core.cache import get_cache
+from django.db import connection, transaction, DatabaseError
 from django.db.models import Min, Max
 from django.core.exceptions import ObjectDoesNotExist
 from django.template import Context, loader
 from django.http import HttpResponse, HttpResponseNotFound, HttpResponseBadRequest
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Before Django 1.5, HttpResponse streams content passed as an iterator
+    StreamingHttpResponse = HttpResponse
 from django.utils import timezone
-from django.views.decorators.http import require_POST
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import available_attrs
+from django.views.decorators.http import condition, require_POST
+from django.views.decorators.vary import vary_on_headers
 from django.views.decorators.csrf import csrf_exempt
 
 import config
+from downsample import lttb
+from jsonstream import detect_encoding, JSONStreamReader
+from logs import iter_file, iter_json_records, iter_log_records, iter_rendered_log, iter_rendered_records
+from logs import log_path, open_log, rendered_path, sidecar_paths, LogWriter
 from models import *
-from signed_request import check_signature, BadSignature
-
-_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
-
-# timedelta.total_seconds added in 2.7
-if hasattr(timedelta, 'total_seconds'):
-    def unix_time(dt):
-        return int(round((dt - _EPOCH).total_seconds()))
-else:
-    def unix_time(dt):
-        td = dt - _EPOCH
-        return int(round(float(td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10**6))
+from sketch import LogHistogram, stddev
+from signed_request import BadSignature, BodyTooLarge, PublicKeyRegistry, SignedBodyReader
+
+def _data_version(request, target_name=None):
+    # Returns get_data_version(target_name), looking it up only once per
+    # request, since it's wanted for both the ETag and Last-Modified
+    if not hasattr(request, '_data_versions'):
+        request._data_versions = {}
+    if not target_name in request._data_versions:
+        request._data_versions[target_name] = get_data_version(target_name)
+    return request._data_versions[target_name]
+
+# The pages show the configuration as well as the data
+def _page_etag(request, target_name=None):
+    version = _data_version(request, target_name)
+    if version is None:
+        return None
+    return settings.CONFIG.generation + '-' + version[0]
+
+def _page_last_modified(request, target_name=None):
+    version = _data_version(request, target_name)
+    return version[1] if version is not None else None
+
+# alias => cache backend
+_caches = {}
+
+def _get_cache(alias):
+    # get_cache() creates a new backend object each time, which would
+    # throw away the contents of an in-process cache
+    if not alias in _caches:
+        _caches[alias] = get_cache(alias)
+    return _caches[alias]
+
+def _cached_page(etag_func, last_modified_func):
+    # Decorator for the pages: handles conditional requests like
+    # condition(), keeps the rendered page in PAGE_CACHE under its URL and
+    # ETag, and adds Cache-Control headers for front-end proxies. The
+    # ETag covers the configuration and the data, so a cached page is
+    # current as long as its ETag is.
+    def decorator(view):
+        def cached_view(request, *args, **kwargs):
+            etag = etag_func(request, *args, **kwargs)
+            if settings.PAGE_CACHE is None or etag is None:
+                return view(request, *args, **kwargs)
+
+            cache = _get_cache(settings.PAGE_CACHE)
+            key = 'page:' + hashlib.md5(request.path.encode('utf-8') + ' ' + etag).hexdigest()
+            cached = cache.get(key)
+            if cached is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                cached = (response['Content-Type'], response.content)
+                cache.set(key, cached)
+
+            return HttpResponse(cached[1], content_type=cached[0])
+
+        conditional_view = condition(etag_func=etag_func, last_modified_func=last_modified_func)(cached_view)
+
+        def page_view(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            if settings.PAGE_MAX_AGE is not None:
+                patch_cache_control(response, public=True, max_age=settings.PAGE_MAX_AGE)
+            return response
+
+        return wraps(view, assigned=available_attrs(view))(page_view)
+    return decorator
+
+def _metric_page_etag(request, metric_name):
+    return _page_etag(request)
+
+def _metric_page_last_modified(request, metric_name):
+    return _page_last_modified(request)
+
+def _target_page_etag(request, machine_name, partition_name, tree_name, testset_name):
+    return _page_etag(request, machine_name + '/' + partition_name + '/' + tree_name + '/' + testset_name)
+
+def _target_page_last_modified(request, machine_name, partition_name, tree_name, testset_name):
+    return _page_last_modified(request, machine_name + '/' + partition_name + '/' + tree_name + '/' + testset_name)
+
+def _time_range(target_name=None):
+    # The range of pull times of the reports without errors, for one
+    # target or all of them
+    qs = TargetStatus.objects.all()
+    if target_name is not None:
+        qs = qs.filter(target__name=target_name)
+    time_range = qs.aggregate(min=Min('first_good_time'), max=Max('last_good_time'))
+    if time_range['min'] is None:
+        time_range['min'] = time_range['max'] = timezone.now()
+    return time_range
 
+@_cached_page(_page_etag, _page_last_modified)
 def home(request):
     t = loader.get_template('metrics/home.html')
 
-    time_range = Report.objects \
-         .filter(error='') \
-         .aggregate(min=Min('pull_time'), max=Max('pull_time'));
-    if time_range['min'] is None:
-        time_range['min'] = time_range['max'] = timezone.now()
+    time_range = _time_range()
 
     c = Context({
         'page_name': 'home',
+        'config_generation': settings.CONFIG.generation,
         'metrics': config.Metric.all(),
         'min_time': unix_time(time_range['min']),
         'max_time': unix_time(time_range['max']),
@@ -49,6 +148,49 @@ def home(request):
 def machines(request):
     return HttpResponse("MACHINES")
 
+def _optional_unix_time(dt):
+    return unix_time(dt) if dt is not None else None
+
+@_cached_page(_page_etag, _page_last_modified)
+def status(request):
+    # The result looks like:
+    #
+    #  { 'targets': [{ 'name': <target name>, 'machine': <machine name>,
+    #                  'first_good_time': <time>, 'last_good_time': <time>,
+    #                  'last_report_time': <time>, 'last_revision': <revision>,
+    #                  'last_error_report': <report id>, 'last_error_time': <time>,
+    #                  'good_count': <count>, 'error_count': <count> }, ...],
+    #    'machines': [{ 'name': <machine name>, 'last_report_time': <time>,
+    #                   'report_count': <count> }, ...] }
+    #
+    # Times are seconds since the epoch, or null if there's no such report
+    targets = []
+    for target_status in TargetStatus.objects.select_related('target').order_by('target__name'):
+        targets.append({
+            'name': target_status.target.name,
+            'machine': target_status.target.machine,
+            'first_good_time': _optional_unix_time(target_status.first_good_time),
+            'last_good_time': _optional_unix_time(target_status.last_good_time),
+            'last_report_time': _optional_unix_time(target_status.last_report_time),
+            'last_revision': target_status.last_revision,
+            'last_error_report': target_status.last_error_report_id,
+            'last_error_time': _optional_unix_time(target_status.last_error_time),
+            'good_count': target_status.good_count,
+            'error_count': target_status.error_count
+        })
+
+    machines = []
+    for machine_status in MachineStatus.objects.order_by('machine'):
+        machines.append({
+            'name': machine_status.machine,
+            'last_report_time': _optional_unix_time(machine_status.last_report_time),
+            'report_count': machine_status.report_count
+        })
+
+    return HttpResponse(json.dumps({ 'targets': targets, 'machines': machines }),
+                        content_type='application/json')
+
+@_cached_page(_metric_page_etag, _metric_page_last_modified)
 def metric(request, metric_name):
     try:
         metric = config.Metric.get(metric_name)
@@ -56,14 +198,11 @@ def metric(request, metric_name):
         return HttpResponseNotFound("No such metric")
 
     t = loader.get_template('metrics/metric.html')
-    time_range = Report.objects \
-                       .filter(error='') \
-                       .aggregate(min=Min('pull_time'), max=Max('pull_time'));
-    if time_range['min'] is None:
-        time_range['min'] = time_range['max'] = timezone.now()
+    time_range = _time_range()
 
     c = Context({
         'page_name': 'metric',
+        'config_generation': settings.CONFIG.generation,
         'metric': metric,
         'min_time': unix_time(time_range['min']),
         'max_time': unix_time(time_range['max']),
@@ -71,6 +210,7 @@ def metric(request, metric_name):
     })
     return HttpResponse(t.render(c))
 
+@_cached_page(_target_page_etag, _target_page_last_modified)
 def target(request, machine_name, partition_name, tree_name, testset_name):
     target_name = machine_name + '/' + partition_name + '/' + tree_name + '/' + testset_name
     try:
@@ -79,22 +219,21 @@ def target(request, machine_name, partition_name, tree_name, testset_name):
         return HttpResponseNotFound("No such target")
 
     t = loader.get_template('metrics/target.html')
-    time_range = Report.objects \
-                   .filter(target__name=target.name, error='') \
-                   .aggregate(min=Min('pull_time'), max=Max('pull_time'));
-    if time_range['min'] is None:
-        time_range['min'] = time_range['max'] = timezone.now()
+    time_range = _time_range(target_name)
 
     error_report = None
     error_time = None
     try:
-        error_report = Report.objects.filter(target__name=target_name).exclude(error='').latest('pull_time')
-        error_time = unix_time(error_report.pull_time)
+        status = TargetStatus.objects.select_related('last_error_report__target').get(target__name=target_name)
+        if status.last_error_report is not None:
+            error_report = status.last_error_report
+            error_time = unix_time(error_report.pull_time)
     except ObjectDoesNotExist:
         pass
 
     c = Context({
         'page_name': 'target',
+        'config_generation': settings.CONFIG.generation,
         'target': target,
         'machine': target.partition.machine,
         'partition': target.partition,
@@ -117,171 +256,572 @@ _SUMMARY_CLASSES = {
     'month': SummaryMonth
 }
 
-def values(request):
-    target = None
+def _parse_date(date_str):
+    m = re.match(r'(\d\d\d\d)-(\d\d)-(\d\d)$', date_str)
+    if m is not None:
+        try:
+            return datetime(int(m.group(1)), int(m.group(2)), int(m.group(3)), tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    return None
+
+class ValuesQuery(object):
+    pass
+
+def _values_format(request):
+    if 'application/octet-stream' in request.META.get('HTTP_ACCEPT', ''):
+        default_format = 'binary'
+    else:
+        default_format = 'json'
+    return request.GET.get('format', default_format)
+
+def _parse_values_query(request):
+    # Returns (query, None) or (None, error_response)
+    query = ValuesQuery()
+
+    query.target = None
     target_name = request.GET.get('target', None)
     if target_name is not None:
         try:
-            target = config.Target.get(target_name)
+            query.target = config.Target.get(target_name)
         except KeyError:
-            return HttpResponseNotFound("No such target")
+            return None, HttpResponseNotFound("No such target")
 
-    metric = None
+    query.metric = None
     metric_name = request.GET.get('metric', None)
     if metric_name is not None:
         try:
-            metric = config.Metric.get(metric_name)
+            query.metric = config.Metric.get(metric_name)
         except KeyError:
-            return HttpResponseNotFound("No such metric")
+            return None, HttpResponseNotFound("No such metric")
 
-    start = None
+    query.start = None
     start_str = request.GET.get('start', None)
     if start_str:
-        m = re.match(r'(\d\d\d\d)-(\d\d)-(\d\d)$', start_str)
-        if m is not None:
-            try:
-                start = datetime(int(m.group(1)), int(m.group(2)), int(m.group(3)), tzinfo=timezone.utc)
-            except ValueError:
-                pass
-        if start is None:
-            return HttpResponseBadRequest("Invalid start date")
+        query.start = _parse_date(start_str)
+        if query.start is None:
+            return None, HttpResponseBadRequest("Invalid start date")
 
-    end = None
+    query.end = None
     end_str = request.GET.get('end', None)
     if end_str:
-        m = re.match(r'(\d\d\d\d)-(\d\d)-(\d\d)$', end_str)
-        if m is not None:
-            try:
-                end = datetime(int(m.group(1)), int(m.group(2)), int(m.group(3)), tzinfo=timezone.utc) + timedelta(hours=24)
-            except ValueError:
-                pass
-        if end is None:
-            return HttpResponseBadRequest("Invalid end date")
-
-    group = request.GET.get('group', 'none')
-    if not group in _SUMMARY_CLASSES:
-        return HttpResponseBadRequest("Invalid group type")
-
-    result = {}
-    result['metrics'] = metrics = []
-
-    summaryCls = _SUMMARY_CLASSES[group]
-    if summaryCls is None:
-        target_map = {}
-
-        qs = Value.objects.all()
-        qs = Value.filter_and_order(qs, start, end, metric, target)
-
-        last_metric = None
-        last_target = None
-
-        a = dict()
-        for value in qs:
-            metric_name = value.metric.name
-            if metric_name != last_metric:
-                metric_data = {
-                    'name': metric_name,
-                    'targets': []
-                }
-                metrics.append(metric_data)
-                last_metric = metric_name
-                last_target = None
-
-            target_name = value.report.target.name
-
-            if target_name != last_target:
-                target_data = {
-                    'name': target_name,
-                    'values': []
-                }
-                metric_data['targets'].append(target_data)
-                last_target = target_name
-
-                if target_name in target_map:
-                    revisions = target_map[target_name]
+        query.end = _parse_date(end_str)
+        if query.end is None:
+            return None, HttpResponseBadRequest("Invalid end date")
+        query.end += timedelta(hours=24)
+
+    query.group = request.GET.get('group', 'none')
+    if not query.group in _SUMMARY_CLASSES and query.group != 'auto':
+        return None, HttpResponseBadRequest("Invalid group type")
+
+    query.format = _values_format(request)
+    if not query.format in _VALUES_FORMATS:
+        return None, HttpResponseBadRequest("Invalid format")
+
+    query.max_points = None
+    max_points_str = request.GET.get('max_points', None)
+    if max_points_str:
+        try:
+            query.max_points = int(max_points_str)
+        except ValueError:
+            query.max_points = 0
+        if query.max_points < 3:
+            return None, HttpResponseBadRequest("Invalid max_points")
+
+    return query, None
+
+# Number of rows fetched from the database at a time
+_QUERY_CHUNK_SIZE = 5000
+
+# Series are yielded as (metric_name, target_name, rows), where rows is an
+# iterator that must be used up before going on to the next series.
+#
+# Rows for group=none are (metric_name, target_name, time, value, revision)
+def _iter_value_series(query):
+    qs = Value.objects.all()
+    qs = Value.filter_and_order(qs, query.start, query.end, query.metric, query.target)
+
+    metric_names = dict(Metric.objects.values_list('id', 'name'))
+    target_names = dict(Target.objects.values_list('id', 'name'))
+
+    def iter_rows(metric_name, target_name, series_qs):
+        for _, _, time, value, revision, _ in iter_value_rows(series_qs, chunk_size=_QUERY_CHUNK_SIZE):
+            yield (metric_name, target_name, time, value, revision)
+
+    pairs = qs.values_list('metric', 'target').order_by('metric', 'target').distinct()
+    for metric_id, target_id in pairs:
+        metric_name = metric_names[metric_id]
+        target_name = target_names[target_id]
+        yield (metric_name, target_name,
+               iter_rows(metric_name, target_name,
+                         qs.filter(metric=metric_id, target=target_id)))
+
+# Rows for summaries are (metric_name, target_name, time, <columns>), with
+# the columns in _SUMMARY_COLUMNS; the last three are None if they aren't
+# known for the summary
+_SUMMARY_COLUMNS = ('avg', 'min', 'max', 'p50', 'p90', 'stddev')
+
+def _iter_summary_series(query):
+    summaryCls = _SUMMARY_CLASSES[query.group]
+    qs = summaryCls.get_saved_summaries(query.start, query.end, query.target, query.metric)
+
+    # The unsaved summaries are only the ones after the last saved
+    # summary, so there aren't many of them
+    unsaved = {}
+    for summary in summaryCls.get_unsaved_summaries(query.start, query.end, query.target, query.metric):
+        unsaved.setdefault((summary.metric_id, summary.target_id), []).append(summary_row(summary))
+
+    metric_names = dict(Metric.objects.values_list('id', 'name'))
+    target_names = dict(Target.objects.values_list('id', 'name'))
+
+    def iter_rows(metric_name, target_name, series_qs, series_unsaved):
+        for rows in (iter_summary_rows(series_qs, chunk_size=_QUERY_CHUNK_SIZE), series_unsaved):
+            for _, _, time, avg_value, min_value, max_value, count, sum_squares, histogram, _ in rows:
+                if histogram is not None:
+                    histogram = LogHistogram.decode(histogram)
+                    p50 = histogram.quantile(0.5)
+                    p90 = histogram.quantile(0.9)
                 else:
-                    revisions = target_map[target_name] = {}
-
-            pull_time_str = str(unix_time(value.report.pull_time))
-            if not pull_time_str in revisions:
-                revisions[pull_time_str] = value.report.revision
+                    p50 = p90 = None
+                yield (metric_name, target_name, time, avg_value, min_value, max_value,
+                       p50, p90, stddev(count, avg_value, sum_squares))
+
+    pairs = set(qs.values_list('metric', 'target').order_by('metric', 'target').distinct())
+    pairs.update(unsaved.iterkeys())
+    for metric_id, target_id in sorted(pairs):
+        metric_name = metric_names[metric_id]
+        target_name = target_names[target_id]
+        yield (metric_name, target_name,
+               iter_rows(metric_name, target_name,
+                         qs.filter(metric=metric_id, target=target_id),
+                         unsaved.get((metric_id, target_id), [])))
+
+def _iter_query_series(query):
+    # Yields the series for the query, downsampling series with more
+    # than query.max_points points
+    if _SUMMARY_CLASSES[query.group] is None:
+        series = _iter_value_series(query)
+    else:
+        series = _iter_summary_series(query)
+
+    for metric_name, target_name, rows in series:
+        if query.max_points is not None:
+            # Downsample on the time and the value or average; this needs
+            # the whole series
+            rows = list(rows)
+            if len(rows) > query.max_points:
+                rows = lttb(rows, query.max_points, x=2, y=3)
+        yield metric_name, target_name, rows
+
+# Point budget per series for group=auto when max_points isn't given
+_AUTO_MAX_POINTS = 2000
+
+# Approximate length of the buckets of each group, finest first
+_GROUP_SECONDS = (
+    ('none', None),
+    ('hour6', 6 * 3600),
+    ('day', 24 * 3600),
+    ('week', 7 * 24 * 3600)
+)
+
+def _resolve_auto_group(query):
+    # Replaces group=auto with the finest group that gives no more than
+    # the point budget for any series. The number of values in each
+    # series comes from the month summaries, counting the part of each
+    # month within the query's range in proportion to its length; the
+    # number of buckets for each group is estimated from the time range
+    # covered.
+    max_points = query.max_points if query.max_points is not None else _AUTO_MAX_POINTS
+
+    series = {}
+    for summary in SummaryMonth.get_summaries(query.start, query.end, query.target, query.metric):
+        key = (summary.metric_id, summary.target_id)
+        month_start = summary.time
+        month_end = SummaryMonth.time_next(summary.time)
+        overlap_start = max(month_start, query.start) if query.start is not None else month_start
+        overlap_end = min(month_end, query.end) if query.end is not None else month_end
+        count = summary.count * float(unix_time(overlap_end) - unix_time(overlap_start)) \
+                              / (unix_time(month_end) - unix_time(month_start))
+        if key in series:
+            (total, first, last) = series[key]
+            series[key] = (total + count, min(first, month_start), max(last, month_end))
+        else:
+            series[key] = (count, month_start, month_end)
+
+    for group, seconds in _GROUP_SECONDS:
+        fits = True
+        for count, first, last in series.itervalues():
+            points = count
+            if seconds is not None:
+                start = max(first, query.start) if query.start is not None else first
+                end = min(last, query.end) if query.end is not None else last
+                points = min(count, unix_time(end) // seconds - unix_time(start) // seconds + 1)
+            if points > max_points:
+                fits = False
+                break
+        if fits:
+            query.group = group
+            return
+
+    query.group = 'month'
+
+def _values_json(query):
+    # The result looks like:
+    #
+    #  { 'group': <group>,
+    #    'metrics': [{ 'name': <metric name>,
+    #                  'targets': [{ 'name': <target name>, 'values': [...] }, ...] }, ...],
+    #    'targets': [{ 'name': <target name>, 'revisions': { <time>: <revision> } }, ...] }
+    #
+    # but is written out series by series.
+    yield '{"group": ' + json.dumps(query.group) + ', "metrics": ['
+
+    target_map = {}
+    last_metric = None
+    for metric_name, target_name, rows in _iter_query_series(query):
+        if metric_name != last_metric:
+            if last_metric is not None:
+                yield ']}, '
+            yield '{"name": ' + json.dumps(metric_name) + ', "targets": ['
+            last_metric = metric_name
+        else:
+            yield ', '
 
-            target_data['values'].append({
-                'time': unix_time(value.report.pull_time),
-                'value': value.value
-            })
+        yield '{"name": ' + json.dumps(target_name) + ', "values": ['
 
-        result['targets'] = targets = []
-        for name, revisions in target_map.iteritems():
-            targets.append({'name': name,
-                            'revisions': revisions});
+        if query.group == 'none':
+            if target_name in target_map:
+                revisions = target_map[target_name]
+            else:
+                revisions = target_map[target_name] = {}
+
+            first = True
+            for _, _, time, value, revision in rows:
+                pull_time_str = str(time)
+                if not pull_time_str in revisions:
+                    revisions[pull_time_str] = revision
+                yield ('{"time": %s, "value": %s}' if first else ', {"time": %s, "value": %s}') % \
+                    (json.dumps(time), json.dumps(value))
+                first = False
+        else:
+            first = True
+            for row in rows:
+                point = { 'time': row[2] }
+                for name, value in zip(_SUMMARY_COLUMNS, row[3:]):
+                    point[name] = value
+                yield ('' if first else ', ') + json.dumps(point)
+                first = False
+
+        yield ']}'
+
+    if last_metric is not None:
+        yield ']}'
+    yield ']'
+
+    if query.group == 'none':
+        targets = [{'name': name, 'revisions': revisions}
+                   for name, revisions in target_map.iteritems()]
+        yield ', "targets": ' + json.dumps(targets)
+
+    yield '}'
+
+def _delta_encode(times):
+    # The first time is absolute, the rest are relative to the previous time
+    result = []
+    last = 0
+    for time in times:
+        result.append(time - last)
+        last = time
+    return result
+
+class _RevisionTable(object):
+    # Assigns indices to revisions in the order they are first seen
+    def __init__(self):
+        self.revisions = []
+        self._indices = {}
+
+    def index(self, revision):
+        index = self._indices.get(revision, None)
+        if index is None:
+            index = self._indices[revision] = len(self.revisions)
+            self.revisions.append(revision)
+        return index
+
+_NAN = float('nan')
+
+def _series_columns(query, rows, revision_table):
+    # Returns the columns of a series: (times, values, revision indices)
+    # for group=none, times followed by _SUMMARY_COLUMNS otherwise, with
+    # NaN for unknown values
+    if query.group == 'none':
+        times = []
+        values = array('d')
+        indices = []
+        for _, _, time, value, revision in rows:
+            times.append(time)
+            values.append(value)
+            indices.append(revision_table.index(revision))
+        return times, values, indices
     else:
-        summaries = summaryCls.get_summaries(start, end, target, metric)
-
-        last_metric = None
-        last_target = None
-
-        a = dict()
-        for summary in summaries:
-            metric_name = summary.metric.name
-            if metric_name != last_metric:
-                metric_data = {
-                    'name': metric_name,
-                    'targets': []
-                }
-                metrics.append(metric_data)
-                last_metric = metric_name
-                last_target = None
-
-            target_name = summary.target.name
-            if target_name != last_target:
-                target_data = {
-                    'name': target_name,
-                    'values': []
-                }
-                metric_data['targets'].append(target_data)
-                last_target = target_name
-
-            target_data['values'].append({
-                'time': unix_time(summary.time),
-                'avg': summary.avg_value,
-                'min': summary.min_value,
-                'max': summary.max_value,
-            })
-
-    return HttpResponse(json.dumps(result), "application/json")
-
-# Encoding detection for JSON rfc4627, section 3. The RFC doesn't mention
-# the possibility of starting with a BOM, but in pratice that's likely
-# if the input data is UTF-16.
-def application_json_to_unicode(raw):
-    bom = True
-    if raw[0:2] == '\xfe\xff':
-        encoding = 'UTF-16BE'
-    elif raw[0:2] == '\xff\xfe':
-        encoding = 'UTF-16LE'
-    elif raw[0:3] == '\xef\xbb\xbf':
-        encoding = 'UTF-8'
-    elif raw[0:4] == '\x00\x00\xfe\xff':
-        encoding = 'UTF-32BE'
-    elif raw[0:4] == '\xff\xfe\x00\x00':
-        encoding = 'UTF-32LE'
+        times = []
+        columns = [array('d') for name in _SUMMARY_COLUMNS]
+        for row in rows:
+            times.append(row[2])
+            for column, value in zip(columns, row[3:]):
+                column.append(value if value is not None else _NAN)
+        return [times] + columns
+
+# Columnar format:
+#
+# {
+#   'group': <group>,
+#   'series': [{
+#      'metric': <metric name>,
+#      'target': <target name>,
+#      'times': [<time deltas>],            (first entry is absolute)
+#      'values': [<values>],                (group=none)
+#      'revisions': [<index into revisions>],  (group=none)
+#      'avg': [...], 'min': [...], 'max': [...],
+#      'p50': [...], 'p90': [...], 'stddev': [...]  (summaries; null if unknown)
+#    }, ...],
+#   'revisions': [<revision>, ...]         (group=none only)
+# }
+#
+# Written out a series at a time.
+def _values_columnar(query):
+    yield '{"group":' + json.dumps(query.group) + ',"series":['
+
+    revision_table = _RevisionTable()
+    first = True
+    for metric_name, target_name, rows in _iter_query_series(query):
+        columns = _series_columns(query, rows, revision_table)
+        series_data = {
+            'metric': metric_name,
+            'target': target_name,
+            'times': _delta_encode(columns[0])
+        }
+
+        if query.group == 'none':
+            series_data['values'] = columns[1].tolist()
+            series_data['revisions'] = columns[2]
+        else:
+            for name, column in zip(_SUMMARY_COLUMNS, columns[1:]):
+                series_data[name] = [value if not math.isnan(value) else None for value in column]
+
+        yield ('' if first else ',') + json.dumps(series_data, separators=(',', ':'))
+        first = False
+
+    yield ']'
+    if query.group == 'none':
+        yield ',"revisions":' + json.dumps(revision_table.revisions, separators=(',', ':'))
+    yield '}'
+
+if array('l').itemsize == 8:
+    _INT64_TYPECODE = 'l'
+else:
+    _INT64_TYPECODE = None
+
+def _pack_int64(values):
+    if _INT64_TYPECODE is not None:
+        a = array(_INT64_TYPECODE, values)
+        if sys.byteorder != 'little':
+            a.byteswap()
+        return a.tostring()
     else:
-        bom = False
-        null_patterns = {
-            'NNNX': 'UTF-32BE',
-            'NXNX': 'UTF-16BE',
-            'XNNN': 'UTF-32LE',
-            'XNXN': 'UTF-16LE'
-        };
-
-        nullPattern = re.sub(r'[^\x00]', 'X', raw[0:4])
-        nullPattern = re.sub(r'\x00', 'N', nullPattern)
-
-        if nullPattern in null_patterns:
-            encoding = encodings[nullPattern]
+        return struct.pack('<%dq' % len(values), *values)
+
+def _pack_float64(values):
+    a = array('d', values)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a.tostring()
+
+def _pack_uint32(values):
+    return struct.pack('<%dI' % len(values), *values)
+
+def _pad8(data):
+    return data + '\0' * (-len(data) % 8)
+
+def _binary_block(header, offset=0):
+    # u32 length, then JSON padded with spaces so the block ends 8-byte
+    # aligned when it starts at offset
+    data = json.dumps(header, separators=(',', ':'))
+    data += ' ' * (-(offset + 4 + len(data)) % 8)
+    return struct.pack('<I', len(data)) + data
+
+# Binary format, all little-endian:
+#
+#  'PWV2'
+#  header block: { 'group': <group> }
+#
+#  for each series:
+#    header block:
+#     { 'metric': <metric name>, 'target': <target name>,
+#       'count': <number of points>,
+#       'columns': ['value'] or ['avg', 'min', 'max', 'p50', 'p90', 'stddev'],
+#       'revisions': [<revision>, ...] }    (group=none only)
+#    int64[count]: times
+#    float64[count]: for each column in 'columns', NaN where not known
+#    uint32[count]: index for each point into the revisions from all the
+#                   series so far (group=none only), padded with zeros
+#                   to a multiple of 8 bytes
+#
+#  u32: 0, padded with zeros to 8 bytes
+#
+# A header block is a u32 length followed by that many bytes of JSON,
+# padded with spaces so the data after it is 8-byte aligned; the 'revisions'
+# of a series header are the ones not seen in earlier series. The arrays
+# are aligned so that the client can create typed array views directly on
+# the response, and the response is written out a series at a time.
+def _values_binary(query):
+    yield 'PWV2' + _binary_block({ 'group': query.group }, offset=4)
+
+    revision_table = _RevisionTable()
+    for metric_name, target_name, rows in _iter_query_series(query):
+        seen_revisions = len(revision_table.revisions)
+        columns = _series_columns(query, rows, revision_table)
+        series_data = {
+            'metric': metric_name,
+            'target': target_name,
+            'count': len(columns[0])
+        }
+
+        if query.group == 'none':
+            series_data['columns'] = ['value']
+            series_data['revisions'] = revision_table.revisions[seen_revisions:]
+            yield _binary_block(series_data)
+            yield _pack_int64(columns[0])
+            yield _pack_float64(columns[1])
+            yield _pad8(_pack_uint32(columns[2]))
         else:
-            encoding = 'UTF-8'
+            series_data['columns'] = list(_SUMMARY_COLUMNS)
+            yield _binary_block(series_data)
+            yield _pack_int64(columns[0])
+            for column in columns[1:]:
+                yield _pack_float64(column)
+
+    yield _pad8(struct.pack('<I', 0))
+
+# format => (content type, function returning an iterator over the content)
+_VALUES_FORMATS = {
+    'json': ('application/json', _values_json),
+    'columnar': ('application/json', _values_columnar),
+    'binary': ('application/octet-stream', _values_binary)
+}
+
+# Size of the pieces a streamed response is written out in
+_STREAM_CHUNK_SIZE = 64 * 1024
+
+def _iter_buffered(chunks):
+    # Joins small chunks into bigger ones
+    buf = []
+    size = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= _STREAM_CHUNK_SIZE:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    if size > 0:
+        yield ''.join(buf)
+
+def _iter_caching(chunks, cache, key, content_type):
+    # Streams the response, storing it in the values cache at the end
+    # unless it's bigger than VALUES_CACHE_MAX_BYTES
+    max_bytes = settings.VALUES_CACHE_MAX_BYTES
+    body = []
+    size = 0
+    for chunk in _iter_buffered(chunks):
+        if body is not None:
+            size += len(chunk)
+            if max_bytes is not None and size > max_bytes:
+                body = None
+            else:
+                body.append(chunk)
+        yield chunk
+
+    if body is not None:
+        body = ''.join(body)
+        if settings.VALUES_CACHE_GZIP:
+            body = _gzip(body)
+        cache.set(key, (content_type, body, settings.VALUES_CACHE_GZIP))
+
+def _values_etag(request):
+    version = _data_version(request, request.GET.get('target', None))
+    if version is None:
+        return None
+    # The URL covers the rest of the query, but not the format picked by
+    # the Accept header
+    return version[0] + '-' + _values_format(request)
+
+def _values_last_modified(request):
+    version = _data_version(request, request.GET.get('target', None))
+    return version[1] if version is not None else None
+
+# target=MACHINE/PARTITION/TREE/TESTSET, metric=METRIC, start=YYYY-MM-YY, end=YYYY-MM-YY,
+# group=none|hour6|day|week|month|auto, format=json|columnar|binary, max_points=N
+
+def _values_cache_key(query):
+    # Summaries are returned from the start of the bucket containing
+    # query.start, which may be in an earlier month
+    cls = _SUMMARY_CLASSES[query.group]
+    start = query.start
+    if cls is not None and start is not None:
+        start = cls.time_truncate(start)
+
+    generations = get_values_generations(query.target.name if query.target else None,
+                                         start, query.end)
+
+    key = repr((query.target.name if query.target else None,
+                query.metric.name if query.metric else None,
+                query.start, query.end, query.group, query.format,
+                query.max_points, generations))
+    return 'values:' + hashlib.md5(key).hexdigest()
+
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def _cached_values_response(request, content_type, body, compressed):
+    if not compressed:
+        return HttpResponse(body, content_type)
+
+    if _accepts_gzip(request):
+        response = HttpResponse(body, content_type)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(zlib.decompress(body, 16 + zlib.MAX_WBITS), content_type)
+    response['Vary'] = 'Accept-Encoding'
+    return response
+
+# The format defaults to what the Accept header asks for, so caches have
+# to keep the responses apart; this covers 304 responses too
+@vary_on_headers('Accept')
+@condition(etag_func=_values_etag, last_modified_func=_values_last_modified)
+def values(request):
+    query, error_response = _parse_values_query(request)
+    if error_response is not None:
+        return error_response
+
+    if query.group == 'auto':
+        _resolve_auto_group(query)
+
+    content_type, encode = _VALUES_FORMATS[query.format]
+    if settings.VALUES_CACHE is None:
+        return StreamingHttpResponse(_iter_buffered(encode(query)), content_type)
+
+    cache = _get_cache(settings.VALUES_CACHE)
+    key = _values_cache_key(query)
+    cached = cache.get(key)
+    if cached is not None:
+        return _cached_values_response(request, *cached)
+
+    return StreamingHttpResponse(_iter_caching(encode(query), cache, key, content_type),
+                                 content_type)
+
+def application_json_to_unicode(raw):
+    encoding, bom = detect_encoding(raw)
 
     # json module can't handle initial bom, so strip if we found it
     decoded = raw.decode(encoding)
@@ -320,8 +860,12 @@ def child_array(parent, key):
     else:
         return val
 
-def process_report(data, machine_name):
-    # We validate everything before we start updating the database
+class ParsedReport(object):
+    pass
+
+def parse_report(data, machine_name):
+    # Validates a report without touching the database; the result is
+    # handed to store_reports()
 
     if not isinstance(data, dict):
         raise ValidationError("Report toplevel should be an object")
@@ -360,13 +904,17 @@ def process_report(data, machine_name):
 
     error = None
     log = None
-    metrics_data = None
+    metric_values = None
     if 'error' in data:
         error = child_string(data, 'error')
-        log = child_array(data, 'log')
+        # When streaming the upload, the log has already been written
+        # to a LogWriter
+        log = child(data, 'log')
+        if not isinstance(log, (list, LogWriter)):
+            raise ValidationError("'log' is not a array")
     else:
-        metrics_data = child_array(data, 'metrics')
-        for metric_data in metrics_data:
+        metric_values = []
+        for metric_data in child_array(data, 'metrics'):
             if not isinstance(metric_data, dict):
                 raise ValidationError("metric is not an object")
 
@@ -377,89 +925,404 @@ def process_report(data, machine_name):
                 raise ValidationError("unknown metric '%s'" % metric_name)
 
             metric_value = child_number(metric_data, 'value')
+            metric_values.append((metric_name, metric_value))
+
+    parsed = ParsedReport()
+    parsed.machine_name = machine_name
+    parsed.partition_name = partition_name
+    parsed.tree_name = tree.name
+    parsed.testset_name = testset_name
+    parsed.target_name = target_name
+    parsed.revision = revision
+    parsed.pull_time = pull_time
+    parsed.error = error
+    parsed.log = log
+    parsed.metric_values = metric_values
+
+    return parsed
+
+# Maximum number of rows we insert with a single statement; SQLite
+# limits the number of variables in a statement to 999
+_BULK_BATCH_SIZE = 100
+
+def _bulk_create(cls, objs):
+    for i in xrange(0, len(objs), _BULK_BATCH_SIZE):
+        cls.objects.bulk_create(objs[i:i + _BULK_BATCH_SIZE])
+
+def _write_log(parsed):
+    if isinstance(parsed.log, LogWriter):
+        writer = parsed.log
+    else:
+        writer = LogWriter()
 
-    # Now actually store into the database
-
-    (target_dbobj, _) = Target.objects.get_or_create(name=target_name,
-                                                     defaults= {
-                                                         'machine': machine_name,
-                                                         'partition': partition_name,
-                                                         'tree': tree.name,
-                                                         'testset': testset_name
-                                                     })
-    report = Report(target=target_dbobj,
-                    revision=revision,
-                    pull_time=pull_time,
-                    error=error if error is not None else '')
-    report.save()
-    if log is not None:
-        log_dir = os.path.join(settings.LOG_ROOT, target_name.replace('/', '-'))
-        if not os.path.exists(log_dir):
-            os.makedirs(log_dir)
-        log_path = os.path.join(log_dir,
-                                pull_time.strftime('%Y-%m-%d-%H:%M:%S') + '-' + revision + '.json')
-        with open(log_path, 'w') as fp:
-            json.dump(log, fp)
-
-    if metrics_data is not None:
-        for metric_data in metrics_data:
-            metric_name = child_string(metric_data, 'name')
-            metric = config.Metric.get(metric_name)
-            metric_value = child_number(metric_data, 'value')
+    try:
+        if writer is not parsed.log:
+            for record in parsed.log:
+                writer.write_record(record)
 
-            (metric_dbobj, _) = Metric.objects.get_or_create(name=metric_name)
+        path = log_path(parsed.target_name, parsed.pull_time, parsed.revision)
+        writer.commit(path)
+    finally:
+        # Remove the temporary file if anything failed
+        writer.discard()
 
-            value = Value(report=report,
-                          metric=metric_dbobj,
-                          value=metric_value)
-            value.save()
+    return path
 
-@require_POST
-@csrf_exempt
-def upload(request):
+def _remove_log(path):
+    for p in [path] + sidecar_paths(path):
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+def _create_reports(reports):
+    # Inserts the reports, setting their IDs. bulk_create() doesn't give
+    # back the IDs, and reading them back by content would be ambiguous
+    # when the same report is being uploaded twice at once.
+    if len(reports) == 1 or not connection.vendor in ('postgresql', 'sqlite'):
+        for report in reports:
+            report.save()
+    elif connection.vendor == 'postgresql':
+        # RETURNING gives the IDs in the order of the VALUES rows
+        qn = connection.ops.quote_name
+        fields = [Report._meta.get_field(name) for name in ('target', 'revision', 'pull_time', 'error')]
+        cursor = connection.cursor()
+        for i in xrange(0, len(reports), _BULK_BATCH_SIZE):
+            batch = reports[i:i + _BULK_BATCH_SIZE]
+            params = []
+            for report in batch:
+                params.extend(field.get_db_prep_save(getattr(report, field.attname), connection=connection)
+                              for field in fields)
+            row_sql = '(' + ', '.join(['%s'] * len(fields)) + ')'
+            cursor.execute('INSERT INTO %s (%s) VALUES %s RETURNING %s' %
+                           (qn(Report._meta.db_table),
+                            ', '.join(qn(field.column) for field in fields),
+                            ', '.join([row_sql] * len(batch)),
+                            qn(Report._meta.pk.column)),
+                           params)
+            for report, (report_id,) in zip(batch, cursor.fetchall()):
+                report.id = report_id
+    else:
+        # SQLite has a single writer: once we've written to the database,
+        # we hold the lock on it until the transaction ends, and new rowids
+        # count up from the highest; so ours are the highest IDs, in order.
+        # We check that the rows there are ours rather than rely on it.
+        _bulk_create(Report, reports)
+        last_id = Report.objects.aggregate(Max('id'))['id__max']
+        first_id = last_id - len(reports) + 1
+        stored = list(Report.objects.filter(id__gte=first_id).order_by('id')
+                                    .values_list('id', 'target', 'revision', 'pull_time', 'error'))
+        if stored != [(first_id + i, report.target_id, report.revision, report.pull_time, report.error)
+                      for i, report in enumerate(reports)]:
+            raise DatabaseError("Inserted reports don't have the highest IDs")
+        for i, report in enumerate(reports):
+            report.id = first_id + i
+
+def store_reports(parsed_reports):
+    # Stores a list of reports returned from parse_report() in a single
+    # transaction, using bulk inserts for the Report and Value rows. If
+    # the transaction fails, the logs it wrote are removed again.
+    written_logs = []
+    try:
+        with transaction.commit_on_success():
+            return _store_reports(parsed_reports, written_logs)
+    except:
+        for path in written_logs:
+            _remove_log(path)
+        raise
+
+def _store_reports(parsed_reports, written_logs):
+    target_dbobjs = {}
+    metric_dbobjs = dict((m.name, m) for m in Metric.objects.all())
+
+    for parsed in parsed_reports:
+        if not parsed.target_name in target_dbobjs:
+            (target_dbobj, _) = Target.objects.get_or_create(name=parsed.target_name,
+                                                             defaults= {
+                                                                 'machine': parsed.machine_name,
+                                                                 'partition': parsed.partition_name,
+                                                                 'tree': parsed.tree_name,
+                                                                 'testset': parsed.testset_name
+                                                             })
+            target_dbobjs[parsed.target_name] = target_dbobj
+
+        if parsed.metric_values is not None:
+            for metric_name, metric_value in parsed.metric_values:
+                if not metric_name in metric_dbobjs:
+                    (metric_dbobj, _) = Metric.objects.get_or_create(name=metric_name)
+                    metric_dbobjs[metric_name] = metric_dbobj
+
+    reports = [Report(target=target_dbobjs[parsed.target_name],
+                      revision=parsed.revision,
+                      pull_time=parsed.pull_time,
+                      error=parsed.error if parsed.error is not None else '')
+               for parsed in parsed_reports]
+
+    _create_reports(reports)
+
+    update_statuses(reports)
+
+    values = []
+    for parsed, report in zip(parsed_reports, reports):
+        if parsed.log is not None:
+            written_logs.append(_write_log(parsed))
+
+        if parsed.metric_values is not None:
+            for metric_name, metric_value in parsed.metric_values:
+                values.append(Value(report=report,
+                                    metric=metric_dbobjs[metric_name],
+                                    value=metric_value,
+                                    target_id=report.target_id,
+                                    pull_time=report.pull_time))
+
+    _bulk_create(Value, values)
+
+    summary_values = [(value.target_id, value.metric_id,
+                       value.pull_time, value.value)
+                      for value in values]
+    if settings.INCREMENTAL_SUMMARIES:
+        update_summaries(summary_values)
+    else:
+        mark_dirty_summaries(summary_values)
+
+    bump_data_version(target.id for target in target_dbobjs.itervalues())
+    bump_values_generations((target_id, time)
+                            for target_id, metric_id, time, value in summary_values)
+
+    return reports
+
+def process_report(data, machine_name):
+    # We validate everything before we start updating the database
+    parsed = parse_report(data, machine_name)
+    store_reports([parsed])
+
+_public_keys = PublicKeyRegistry(os.path.join(settings.CONFIG_ROOT, 'machines'))
+
+def _too_large_response():
+    return HttpResponse("Upload too large", status=413)
+
+def _start_upload(request):
+    # Returns (machine_name, reader, None) on success, or
+    # (None, None, error_response). The body must be read from reader
+    # and reader.verify() called before the data is used.
     machine_name = request.GET.get('machine', None)
     if machine_name is None:
-        return HttpResponseBadRequest("No machine= parameter in URL")
+        return None, None, HttpResponseBadRequest("No machine= parameter in URL")
 
     try:
         machine = config.Machine.get(machine_name)
     except KeyError:
-        return HttpResponseNotFound("No such machine")
+        return None, None, HttpResponseNotFound("No such machine")
 
-    pubkey_path = os.path.join(settings.CONFIG_ROOT, 'machines', machine.name + '.pubkey')
+    # Nothing in the body can be trusted until the whole of it has been
+    # read and checked, so we don't take more than we're willing to hold;
+    # the reader enforces that on what is actually read, and we check the
+    # length the request claims here so as to fail early
+    if settings.UPLOAD_MAX_BYTES is not None:
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH', 0))
+        except ValueError:
+            content_length = 0
+        if content_length > settings.UPLOAD_MAX_BYTES:
+            return None, None, _too_large_response()
 
     try:
-        check_signature(request, pubkey_path)
+        reader = SignedBodyReader(request, _public_keys.get(machine.name),
+                                  max_bytes=settings.UPLOAD_MAX_BYTES)
     except BadSignature, e:
-        return HttpResponseBadRequest("Signature check failed: " + e.message)
+        return None, None, HttpResponseBadRequest("Signature check failed: " + e.message)
 
-    toload = application_json_to_unicode(request.body)
+    return machine_name, reader, None
+
+def _read_signed_body(reader):
+    # Returns (body, None) or (None, error_response)
     try:
-        data = json.loads(toload)
+        body = reader.read()
+        reader.verify()
+    except BadSignature, e:
+        return None, HttpResponseBadRequest("Signature check failed: " + e.message)
+    except BodyTooLarge:
+        return None, _too_large_response()
+
+    return body, None
+
+# Size of the chunks we copy an upload body to a temporary file in
+_SPOOL_CHUNK_SIZE = 64 * 1024
+
+def _spool_signed_body(reader):
+    # Like _read_signed_body(), but the body is written to an anonymous
+    # temporary file rather than held in memory; returns (file, None),
+    # with the file positioned at the start, or (None, error_response)
+    fp = tempfile.TemporaryFile()
+    try:
+        while True:
+            buf = reader.read(_SPOOL_CHUNK_SIZE)
+            if buf == '':
+                break
+            fp.write(buf)
+        reader.verify()
+    except BadSignature, e:
+        fp.close()
+        return None, HttpResponseBadRequest("Signature check failed: " + e.message)
+    except BodyTooLarge:
+        fp.close()
+        return None, _too_large_response()
+    except:
+        fp.close()
+        raise
+
+    fp.seek(0)
+    return fp, None
+
+def _read_streamed_report(reader):
+    # Parses the toplevel of a report, streaming the 'log' array of an
+    # error report to disk record by record rather than loading it into
+    # memory; data['log'] is then a LogWriter
+    stream = JSONStreamReader(reader)
+    data = {}
+    try:
+        for key in stream.iter_object():
+            if isinstance(data.get(key, None), LogWriter):
+                data[key].discard()
+
+            if key == 'log' and stream.peek() == '[':
+                writer = data[key] = LogWriter()
+                for record in stream.iter_array():
+                    writer.write_record(record)
+            else:
+                data[key] = stream.read_value()
+        stream.end()
+    except:
+        if isinstance(data.get('log', None), LogWriter):
+            data['log'].discard()
+        raise
+
+    return data
+
+@require_POST
+@csrf_exempt
+def upload(request):
+    machine_name, reader, error_response = _start_upload(request)
+    if error_response is not None:
+        return error_response
+
+    # The body is checked before anything is parsed out of it, so logs
+    # only get written to LOG_ROOT for signed uploads
+    body_fp, error_response = _spool_signed_body(reader)
+    if error_response is not None:
+        return error_response
+
+    try:
+        data = _read_streamed_report(body_fp)
     except ValueError, e:
         return HttpResponseBadRequest("Can't parse data")
+    finally:
+        body_fp.close()
 
     try:
-        process_report(data, machine_name)
-    except ValidationError, e:
-        return HttpResponseBadRequest(e.message)
+        try:
+            process_report(data, machine_name)
+        except ValidationError, e:
+            return HttpResponseBadRequest(e.message)
+    finally:
+        # If the log wasn't stored, remove the temporary file
+        if isinstance(data.get('log', None), LogWriter):
+            data['log'].discard()
 
     return HttpResponse("OK\n")
 
-_PRIORITY_RE = re.compile('^[0-7]$')
-_LINE_RE = re.compile('^([^\n]*(?:\n[^\n]*){2})\n')
-_ESCAPE_RE = re.compile(r'\0x1b[0-9;]+m')
-# C0 and C1 control characters, DEL, except for \t\n
-_UNICODE_CONTROL_RE = re.compile(r'[\x00-\x08\x0A-\x1F\x7F-\x9F]')
-
-def escape_character(m):
-    c = m.group(0)
-    if c == '\n':
-        return '\\n'
-    elif c == '\r':
-        return '\\r'
+# Accepts a JSON array of reports, in the same format as for upload(),
+# and stores all the valid reports in a single transaction. The result
+# is a JSON object with a 'results' array that has an entry for each
+# report of the form {'status': 'ok'} or {'status': 'error', 'error': <message>}
+@require_POST
+@csrf_exempt
+def upload_batch(request):
+    machine_name, reader, error_response = _start_upload(request)
+    if error_response is not None:
+        return error_response
+
+    body, error_response = _read_signed_body(reader)
+    if error_response is not None:
+        return error_response
+
+    toload = application_json_to_unicode(body)
+    del body
+    try:
+        data = json.loads(toload)
+    except ValueError, e:
+        return HttpResponseBadRequest("Can't parse data")
+
+    if not isinstance(data, list):
+        return HttpResponseBadRequest("Batch toplevel should be an array")
+
+    results = []
+    to_store = []
+    for report_data in data:
+        try:
+            to_store.append(parse_report(report_data, machine_name))
+            # Filled in once the reports are stored
+            results.append(None)
+        except ValidationError, e:
+            results.append({'status': 'error',
+                            'error': e.message})
+
+    status = 200
+    stored_result = {'status': 'ok'}
+    if len(to_store) > 0:
+        try:
+            store_reports(to_store)
+        except (DatabaseError, EnvironmentError), e:
+            # The transaction was rolled back, so none of them are stored
+            status = 500
+            stored_result = {'status': 'error',
+                             'error': "Storing reports failed: %s" % e}
+
+    results = [result if result is not None else stored_result for result in results]
+    return HttpResponse(json.dumps({'results': results}), "application/json", status=status)
+
+def _accepts_gzip(request):
+    # Whether the Accept-Encoding header allows gzip, by name or as '*';
+    # a q-value of 0 means it isn't acceptable
+    qvalues = {}
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = coding.split(';')
+        name = params[0].strip().lower()
+        qvalue = 1.
+        for param in params[1:]:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.
+        qvalues[name] = qvalue
+
+    if 'gzip' in qvalues:
+        return qvalues['gzip'] > 0
+    return qvalues.get('*', 0) > 0
+
+# Serves a gzip-compressed file, passing the compressed data through if
+# the client accepts it. Raises IOError if the file doesn't exist.
+def _compressed_file_response(request, path, content_type):
+    if _accepts_gzip(request):
+        if settings.LOG_SENDFILE_HEADER is not None:
+            # Let the front-end web server send the file, if it's there
+            if not os.path.isfile(path):
+                raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            response = HttpResponse(content_type=content_type)
+            response[settings.LOG_SENDFILE_HEADER] = \
+                settings.LOG_SENDFILE_ROOT + path[len(settings.LOG_ROOT):]
+        else:
+            fp = open(path, 'rb')
+            response = StreamingHttpResponse(iter_file(fp), content_type=content_type)
+            response['Content-Length'] = str(os.fstat(fp.fileno()).st_size)
+        response['Content-Encoding'] = 'gzip'
     else:
-        return '\\x%02x' % ord(c)
+        response = StreamingHttpResponse(iter_file(gzip.open(path, 'rb')), content_type=content_type)
+
+    response['Vary'] = 'Accept-Encoding'
+    return response
 
 def log(request, machine_name, partition_name, tree_name, testset_name, report_id, format):
     target_name = machine_name + '/' + partition_name + '/' + tree_name + '/' + testset_name
@@ -474,143 +1337,63 @@ def log(request, machine_name, partition_name, tree_name, testset_name, report_i
     except ObjectDoesNotExist:
         return HttpResponseNotFound("No such log")
 
-    log_path = os.path.join(settings.LOG_ROOT,
-                            target.name.replace('/', '-'),
-                            report.pull_time.strftime('%Y-%m-%d-%H:%M:%S') + '-' + report.revision + '.json')
-    try:
-        fp = open(log_path, 'r')
-    except IOError, e:
-        return HttpResponseNotFound("Log has been purged")
-
-    if format == 'json':
-        # Could using StreamingHttpResponse; as below Django will just
-        # pile the chunks up in an array
-        response = HttpResponse(content_type="application/json")
-        while True:
-            buf = fp.read(32*1024)
-            if buf == '':
-                break
-            response.write(buf)
+    title = '%s - %s' % (report.pull_time.strftime('%Y-%m-%d %H:%M:%S'), target_name)
+    if format == 'html':
+        content_type = "text/html; charset=utf-8"
+    elif format == 'txt':
+        content_type = "text/plain; charset=utf-8"
     else:
-        if format == 'html':
-            response = HttpResponse(content_type="text/html; charset=utf-8")
-            response.write('''<!DOCTYPE html><html>
-<head>
-  <title>%s - %s</title>
-  <style type="text/css">
-     .error { color: red; }
-     .notice { font-weight: bold; }
-  </style>
-</head>
-<body><pre>''' % (report.pull_time.strftime('%Y-%m-%d %H:%M:%S'), target_name))
-        else:
-            response = HttpResponse(content_type="text/plain; charset=utf-8")
-        log = json.load(fp)
-        for record in log:
-            # We write out log records in roughly the same format as
-            # the journalctl -o iso-short format
-            try:
-                time = long(record['_SOURCE_REALTIME_TIMESTAMP'])
-            except KeyError:
-                time = 0
-            if time == 0:
-                for f in record['__CURSOR'].split(';'):
-                    if f.startswith('t='):
-                        time = long(f[2:], 16)
-            dt = datetime.utcfromtimestamp(time/1000000)
-            # This is like journalctl -o short-iso; default is '%b %d %H:%M:%S'
-            response.write(dt.strftime('%Y-%m-%dT%H:%M:%S%z '))
-
-            # journalctl shows the hostname here - that isn't interesting for us
-            #
-            # try:
-            #    response.write(record['_HOSTNAME'])
-            # except KeyError:
-            #    pass
-            #
-            # response.write(' ')
-
-            try:
-                response.write(record['SYSLOG_IDENTIFIER'])
-            except KeyError:
-                response.write(record['_COMM'])
-
-            pid = None
-            try:
-                pid = record['_PID']
-            except KeyError:
-                try:
-                    pid = record['_SYSLOG_PID']
-                except KeyError:
-                    pass
-            if pid != None:
-                response.write('[')
-                response.write(pid)
-                response.write(']')
-
-            response.write(': ')
+        content_type = "application/json"
+
+    # offset=N: skip the first N records, or if N is negative, show
+    #   the last -N records
+    # limit=N: show at most N records
+    # priority=N: only show records with PRIORITY <= N
+    # identifier=NAME: only show records with SYSLOG_IDENTIFIER=NAME
+    selection = {}
+    try:
+        for param in ('offset', 'limit', 'priority'):
+            if request.GET.get(param, ''):
+                selection[param] = int(request.GET[param])
+    except ValueError:
+        return HttpResponseBadRequest("Invalid log selection")
+    if selection.get('limit', 0) < 0 or not 0 <= selection.get('priority', 0) <= 7:
+        return HttpResponseBadRequest("Invalid log selection")
+    if request.GET.get('identifier', ''):
+        selection['identifier'] = request.GET['identifier']
 
-            message = record['MESSAGE']
+    if len(selection) > 0:
+        try:
+            records = iter_log_records(target.name, report.pull_time, report.revision, **selection)
+        except IOError, e:
+            return HttpResponseNotFound("Log has been purged")
 
-            # If the message was an escaped blob, try to convert it to text
-            if type(message) == list:
-                message = ''.join((chr(x) for x in message))
-                try:
-                    message = unicode(message, 'UTF-8')
-                except UnicodeDecodeError:
-                    # journalctl falls back to printing the bytes, this seems more useful
-                    message = repr(message)[1:-1]
-
-            # 300 characters or 3 lines, whichever is less; journalctl does
-            # a more sophisticated approach to ellipsization where it ellipsizes
-            # middle lines
-            if len(message) > 300:
-                message = message[0:300] + "..."
-            m = _LINE_RE.match(message)
-            if m:
-                message = m.group(1) + "..."
-
-            # For multi-line log messages, journalctl indents subsequent lines
-            # with spaces to have the same indent as the first line has
-            # pre-message text, but multi-line log messages are quite rare
-            # so we skip that
-
-            # Remove ANSI color escapes and replace tabs with 8 spaces
-            message = _ESCAPE_RE.sub('', message)
-            message = message.replace("\t", "        ")
-
-            # Escape control characters; again journalctl would just print
-            # the message as bytes
-            message = _UNICODE_CONTROL_RE.sub(escape_character, message)
-
-            # For HTML mode, use bold/red to mark different priorities
-            if format == 'html':
-                priority = 6 # Info
-                try:
-                    priority_str = record['PRIORITY']
-                    if _PRIORITY_RE.match(priority_str):
-                        priority = int(priority_str)
-                except KeyError:
-                    pass
-
-                if priority <= 3: # error
-                    response.write('<span class="error">');
-                    response.write(message)
-                    response.write('</span>')
-                elif priority <= 5:  #notice
-                    response.write('<span class="notice">');
-                    response.write(message)
-                    response.write('</span>')
-                else:
-                    response.write(message)
-            else:
-                response.write(message)
+        if format == 'json':
+            content = iter_json_records(records)
+        else:
+            content = iter_rendered_records(records, format, title)
+        return StreamingHttpResponse(content, content_type=content_type)
 
-            response.write('\n')
+    path = log_path(target.name, report.pull_time, report.revision)
+    if format == 'json':
+        serve_path = path
+    else:
+        serve_path = rendered_path(path, format)
 
-        if format == 'html':
-            response.write('</pre></body')
+    try:
+        return _compressed_file_response(request, serve_path, content_type)
+    except IOError, e:
+        pass
 
-    fp.close()
+    try:
+        fp = open_log(target.name, report.pull_time, report.revision)
+    except IOError, e:
+        return HttpResponseNotFound("Log has been purged")
 
-    return response
+    if format == 'json':
+        # Stored before we compressed logs
+        return StreamingHttpResponse(iter_file(fp), content_type=content_type)
+    else:
+        # The rendering is saved for next time, as the log never changes
+        return StreamingHttpResponse(iter_rendered_log(fp, format, title, cache_path=serve_path),
+                                     content_type=content_type)
@@ -166,3 +166,54 @@ except Exception:
     raise
 
 LOG_ROOT = os.path.join(MODULE_ROOT, 'logs')
+
+# Settings below have defaults, but can be overridden in local_settings.py
+
+# If True, each upload updates the summary tables directly; if False,
+# summaries are only saved by 'manage.py summarize' and queries compute
+# the part that hasn't been saved yet on the fly. Uploads only add to the
+# buckets they touch, so when turning this on for a database with values,
+# run 'manage.py upgradedb' (or 'manage.py summarize --rebuild') before
+# accepting uploads to save the rest.
+INCREMENTAL_SUMMARIES = globals().get('INCREMENTAL_SUMMARIES', True)
+
+# Largest upload body accepted, in bytes, or None for no limit. The
+# signature covers the whole body, so an upload is spooled to a
+# temporary file before it's checked; this bounds what that can take.
+UPLOAD_MAX_BYTES = globals().get('UPLOAD_MAX_BYTES', 256 * 1024 * 1024)
+
+# If set, compressed logs and cached log renderings are sent by the
+# front-end web server rather than through Django: the response carries
+# this header (e.g. 'X-Sendfile' for Apache mod_xsendfile, or
+# 'X-Accel-Redirect' for nginx) with the file's path, where LOG_ROOT is
+# replaced by LOG_SENDFILE_ROOT.
+LOG_SENDFILE_HEADER = globals().get('LOG_SENDFILE_HEADER', None)
+LOG_SENDFILE_ROOT = globals().get('LOG_SENDFILE_ROOT', LOG_ROOT)
+
+# Log retention, applied by 'manage.py prunelogs'. We keep at most
+# LOG_RETAIN_COUNT logs per target; None means no limit for the others.
+LOG_RETAIN_COUNT = globals().get('LOG_RETAIN_COUNT', 5)
+LOG_MAX_AGE_DAYS = globals().get('LOG_MAX_AGE_DAYS', None)
+LOG_MAX_TARGET_BYTES = globals().get('LOG_MAX_TARGET_BYTES', None)
+LOG_MAX_TOTAL_BYTES = globals().get('LOG_MAX_TOTAL_BYTES', None)
+
+# Name of the cache in CACHES used for /api/values responses, or None to
+# not cache them. Entries are invalidated by uploads and resummarizing;
+# metrics.cache.LRUCache is an in-process cache with a size limit.
+# Responses are stored gzip-compressed if VALUES_CACHE_GZIP is True.
+# They're streamed to the client as they're generated, and only kept if
+# they're at most VALUES_CACHE_MAX_BYTES (uncompressed; None for no limit).
+VALUES_CACHE = globals().get('VALUES_CACHE', None)
+VALUES_CACHE_GZIP = globals().get('VALUES_CACHE_GZIP', True)
+VALUES_CACHE_MAX_BYTES = globals().get('VALUES_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+
+# Name of the cache in CACHES used for the rendered home, metric and
+# target pages (and /api/status), or None to not cache them. Pages are
+# cached under their ETag, so uploads and configuration changes never
+# leave a stale page behind. The parts of the pages rendered only from
+# the configuration are cached in the default cache either way.
+PAGE_CACHE = globals().get('PAGE_CACHE', None)
+# max-age sent for those pages in Cache-Control, letting a front-end
+# proxy serve them for that many seconds before revalidating; None to
+# not send Cache-Control
+PAGE_MAX_AGE = globals().get('PAGE_MAX_AGE', 60)
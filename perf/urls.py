@@ -10,7 +10,11 @@ urlpatterns = patterns('',
     url(r'^metric/(?P<metric_name>[^/]+)$', 'metrics.views.metric'),
     url(r'^target/(?P<machine_name>[^/]+)/(?P<partition_name>[^/]+)/(?P<tree_name>[^/]+)/(?P<testset_name>[^/]+)$', 'metrics.views.target'),
     url(r'^log/(?P<machine_name>[^/]+)/(?P<partition_name>[^/]+)/(?P<tree_name>[^/]+)/(?P<testset_name>[^/]+)/(?P<report_id>\d+).(?P<format>txt|json|html)$', 'metrics.views.log'),
-    # target=MACHINE/PARTITION/TREE/TESTSET, metric=METRIC, start=YYYY-MM-YY, end=YYYY-MM-YY, group=none|hour6|day|week|month
+    # target=MACHINE/PARTITION/TREE/TESTSET, metric=METRIC, start=YYYY-MM-YY, end=YYYY-MM-YY, group=none|hour6|day|week|month|auto,
+    # format=json|columnar|binary (binary is also selected by Accept: application/octet-stream),
+    # max_points=N (downsample each series to at most N points)
     url(r'^api/values$', 'metrics.views.values'),
-    url(r'^api/upload$', 'metrics.views.upload')
+    url(r'^api/status$', 'metrics.views.status'),
+    url(r'^api/upload$', 'metrics.views.upload'),
+    url(r'^api/upload_batch$', 'metrics.views.upload_batch')
 )
@@ -1380,6 +1380,65 @@ PerfDisplay.prototype.load = function() {
     }
 }
 
+// Decodes the format=binary response of /api/values; see _values_binary()
+// in metrics/views.py for the layout. Returns { group, revisions, series },
+// with each series having 'times' and an array for each of its columns.
+function decodeBinaryValues(buffer) {
+    var view = new DataView(buffer);
+    var pos = 4;
+
+    function readBlock() {
+        var length = view.getUint32(pos, true);
+        var bytes = new Uint8Array(buffer, pos + 4, length);
+        pos += 4 + length;
+        if (length == 0)
+            return null;
+
+        var text = '';
+        for (var i = 0; i < bytes.length; i += 4096)
+            text += String.fromCharCode.apply(null, bytes.subarray(i, i + 4096));
+        // The block is UTF-8, but JSON.parse wants a string of characters
+        return JSON.parse(decodeURIComponent(escape(text)));
+    }
+
+    var result = readBlock();
+    result.revisions = [];
+    result.series = [];
+
+    while (true) {
+        var series = readBlock();
+        if (series == null)
+            break;
+
+        var count = series.count;
+
+        // Times are 64-bit integers; split each into 32-bit halves
+        var timeWords = new Int32Array(buffer, pos, 2 * count);
+        var times = new Array(count);
+        for (var k = 0; k < count; k++)
+            times[k] = (timeWords[2 * k] >>> 0) + timeWords[2 * k + 1] * 4294967296;
+        series.times = times;
+        pos += 8 * count;
+
+        for (var j = 0; j < series.columns.length; j++) {
+            series[series.columns[j]] = new Float64Array(buffer, pos, count);
+            pos += 8 * count;
+        }
+
+        if (result.group == 'none') {
+            // Revisions first seen in this series are added to the table
+            for (var k = 0; k < series.revisions.length; k++)
+                result.revisions.push(series.revisions[k]);
+            series.revisions = new Uint32Array(buffer, pos, count);
+            pos += 8 * Math.ceil(count / 2);
+        }
+
+        result.series.push(series);
+    }
+
+    return result;
+}
+
 PerfDisplay.prototype._loadRange = function(group, start, end) {
     var startDate = new Date(start * 1000);
     TIME_OPS['day'].truncate(startDate);
@@ -1389,7 +1448,7 @@ PerfDisplay.prototype._loadRange = function(group, start, end) {
     // Make the day-range closed, as the API requires
     endDate.setTime(endDate.getTime() - DAY_MSECS);
 
-    var url = '/api/values?start=' + formatDay(startDate) + '&end=' + formatDay(endDate) + '&group=' + group;
+    var url = '/api/values?start=' + formatDay(startDate) + '&end=' + formatDay(endDate) + '&group=' + group + '&format=binary';
     if (this.target != null)
         url += '&target=' + encodeURIComponent(this.target);
     if (this.metric != null)
@@ -1403,91 +1462,77 @@ PerfDisplay.prototype._loadRange = function(group, start, end) {
 
     this.pendingLoads.push(loadInfo);
 
-    $.ajax({datatype: "json",
-            url: url,
-            success:
-              function(data) {
-                  var addedData = false;
-
-                  this.pendingLoads.splice(this.pendingLoads.indexOf(loadInfo), 1);
-
-                  var timeOffset = TIME_OFFSETS[group];
-
-                  if (group != this.loadedGroup) {
-                      this.data = {};
-                      this.loadedRanges = new TimeRanges();
-                      this.loadedGroup = group;
-                  }
-
-                  this.loadedRanges.add(start, end);
-
-                  var metrics = data.metrics;
-                  for (var i = 0; i < metrics.length; i++) {
-                      var metricData = metrics[i];
-                      if (!(metricData.name in this.data))
-                          this.data[metricData.name] = {};
-
-                      for (var j = 0; j < metricData.targets.length; j++) {
-                          var targetData = metricData.targets[j];
-
-                          var valuesData = targetData.values;
-
-                          if (valuesData.length > 0)
-                              addedData = true;
-                          else
-                              continue;
-
-                          var values = new ValueBuffer(valuesData.length);
-                          if (group == 'none') {
-                              for (var k = 0; k < valuesData.length; k++) {
-                                  var value = valuesData[k];
-                                  values.append(value.time, value.value);
-                              }
-                          } else {
-                              for (var k = 0; k < valuesData.length; k++) {
-                                  var value = valuesData[k];
-                                  values.append(value.time + timeOffset, value.avg);
-                              }
-                          }
-
-                          if (targetData.name in this.data[metricData.name])
-                              this.data[metricData.name][targetData.name].merge(values);
-                          else
-                              this.data[metricData.name][targetData.name] = values;
-
-                          if (!(targetData.name in this.allTargets))
-                              this.allTargets[targetData.name] = { revisions: {} };
-                      }
-                  }
-
-                  if (data.targets != null) {
-                      var targets = data.targets;
-                      for (var i = 0; i < targets.length; i++) {
-                          var targetData = targets[i];
-                          if (!(targetData.name in this.allTargets))
-                              this.allTargets[targetData.name] = { revisions: {} };
-
-                          var revisions = this.allTargets[targetData.name].revisions;
-                          var newRevisions = targetData.revisions;
-                          for (var time in newRevisions)
-                              revisions[time] = newRevisions[time];
-                      }
-                  }
-
-                  if (!addedData)
-                      return;
-
-                  this.allTargetsSorted = [];
-                  for (var target in this.allTargets)
-                      theDisplay.allTargetsSorted.push(target);
-                  this.allTargetsSorted.sort();
-
-                  this.refresh();
-              }.bind(this),
-            error:
-              function() {
-                  this.pendingLoads.splice(this.pendingLoads.indexOf(loadInfo), 1);
-             }});
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', url);
+    xhr.responseType = 'arraybuffer';
+    xhr.onload = function() {
+        this.pendingLoads.splice(this.pendingLoads.indexOf(loadInfo), 1);
+        if (xhr.status != 200)
+            return;
+
+        var data = decodeBinaryValues(xhr.response);
+        var addedData = false;
+
+        var timeOffset = TIME_OFFSETS[group];
+
+        if (group != this.loadedGroup) {
+            this.data = {};
+            this.loadedRanges = new TimeRanges();
+            this.loadedGroup = group;
+        }
+
+        this.loadedRanges.add(start, end);
+
+        var revisionTable = data.revisions;
+        var series = data.series;
+        for (var i = 0; i < series.length; i++) {
+            var seriesData = series[i];
+            if (!(seriesData.metric in this.data))
+                this.data[seriesData.metric] = {};
+
+            if (!(seriesData.target in this.allTargets))
+                this.allTargets[seriesData.target] = { revisions: {} };
+
+            var times = seriesData.times;
+            if (times.length > 0)
+                addedData = true;
+            else
+                continue;
+
+            var values = new ValueBuffer(times.length);
+            if (group == 'none') {
+                var revisions = this.allTargets[seriesData.target].revisions;
+                for (var k = 0; k < times.length; k++) {
+                    values.append(times[k], seriesData.value[k]);
+                    // Keep the first revision for a time, as for JSON
+                    if (!(times[k] in revisions))
+                        revisions[times[k]] = revisionTable[seriesData.revisions[k]];
+                }
+            } else {
+                for (var k = 0; k < times.length; k++)
+                    values.append(times[k] + timeOffset, seriesData.avg[k]);
+            }
+
+            if (seriesData.target in this.data[seriesData.metric])
+                this.data[seriesData.metric][seriesData.target].merge(values);
+            else
+                this.data[seriesData.metric][seriesData.target] = values;
+        }
+
+        if (!addedData)
+            return;
+
+        this.allTargetsSorted = [];
+        for (var target in this.allTargets)
+            theDisplay.allTargetsSorted.push(target);
+        this.allTargetsSorted.sort();
+
+        this.refresh();
+    }.bind(this);
+    xhr.onerror = function() {
+        this.pendingLoads.splice(this.pendingLoads.indexOf(loadInfo), 1);
+    }.bind(this);
+    xhr.send();
 }
 
 PerfDisplay.prototype.updateElementsForRange = function() {